@@ -17,12 +17,12 @@ install_requires = [
     'openapi-spec-validator==0.5.7',
     'tabulate>=0.7.5',
     'setuptools',
-    'pytz',
     'tzlocal',
 ]
 
 tests_require = [
     'moto',
+    'pytz',
 ]
 
 config = {
@@ -1,101 +1,233 @@
-import time
+import importlib
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from boto.exception import BotoServerError
 
+from stacks.cache import conn_key, lookup_cache, stack_version
+from stacks.scheduler import scheduler
+
+# Config keys of connections templates and commands use, by boto module name
+CONNECTIONS = {
+    'ec2_conn': 'boto.ec2',
+    'vpc_conn': 'boto.vpc',
+    'cf_conn': 'boto.cloudformation',
+    'r53_conn': 'boto.route53',
+    's3_conn': 'boto.s3',
+}
+
+# Regions of other partitions, which commercial credentials can not use
+OTHER_PARTITION_PREFIXES = ('cn-', 'us-gov-')
+
+
+# Lazy connections by (region, profile, access key ID), reused by every
+# command a server runs with the same credentials
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Inventory stack lookups are answered from before asking AWS, set by --from-inventory
+inventory = None
+
+
+def connect(region, profile):
+    """Return a dict of config key to lazy connection for every CONNECTIONS entry
+
+    Credentials given by environment variables are part of the key, so a server
+    does not run a command with the credentials of an earlier one.
+    """
+    key = region, profile, access_key_id()
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = {name: LazyConnection(module_name, region, profile)
+                                 for name, module_name in CONNECTIONS.items()}
+        return dict(_connections[key])
+
+
+def forget_connections():
+    """Drop connections inherited from a parent process
+
+    Forked workers must not share the parent's sockets, nor wait on a lock
+    another thread of the parent held when forking.
+    """
+    global _connections, _connections_lock
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+
+def access_key_id():
+    """Return the access key ID the environment gives, which boto prefers to profiles"""
+    return os.environ.get('AWS_ACCESS_KEY_ID')
+
+
+def regions():
+    """Return names of the commercial regions CloudFormation is available in
+
+    The list is the one bundled with boto 2.49, which boto can connect to. It
+    lacks regions opened since, like eu-west-3, eu-north-1, ap-northeast-3,
+    ap-east-1, me-south-1 and af-south-1.
+    """
+    cloudformation = importlib.import_module('boto.cloudformation')
+    return sorted(r.name for r in cloudformation.regions() if not r.name.startswith(OTHER_PARTITION_PREFIXES))
+
+
+class LazyConnection(object):
+    """Connection to an AWS service which is opened on first use
+
+    Attribute access is passed through to the connection, which is made once
+    and shared by all threads. The boto service module is imported then too.
+    Lookups are cached by lookup_key, which needs no connection.
+    """
+
+    def __init__(self, module_name, region, profile):
+        self._module_name = module_name
+        self._region = region
+        self._profile = profile
+        self._conn = None
+        self._lock = threading.Lock()
+        self.lookup_key = (module_name, region, profile, access_key_id())
+
+    def _connection(self):
+        with self._lock:
+            if self._conn is None:
+                try:
+                    module = importlib.import_module(self._module_name)
+                    self._conn = module.connect_to_region(self._region, profile_name=self._profile)
+                # TODO(alekna): Fix too broad exception
+                except:
+                    print(sys.exc_info()[1])
+                    sys.exit(1)
+                if self._conn is None:
+                    print('Unable to connect to {} in region {}.'.format(self._module_name, self._region))
+                    sys.exit(1)
+            return self._conn
+
+    def __getattr__(self, name):
+        # Only called for attributes the instance lacks, like ours before
+        # __init__ when copied or unpickled
+        if name.startswith('__') or name in ('_module_name', '_region', '_profile', '_conn', '_lock', 'lookup_key'):
+            raise AttributeError(name)
+        return getattr(self._connection(), name)
+
+    def close(self):
+        """Close the connection if it was opened"""
+        if self._conn is not None:
+            self._conn.close()
+
+
+def iter_pages(func, *args):
+    """Yield result pages of a paginated boto call
+
+    The next_token is passed as the last positional argument. The next page is
+    requested in the background while the caller consumes the current one.
+    """
+    call = partial(scheduler.call, func)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(call, *args)
+        while future:
+            page = future.result()
+            next_token = getattr(page, 'next_token', None)
+            future = executor.submit(call, *args, next_token) if next_token else None
+            yield page
 
-def throttling_retry(func):
-    """Retry when AWS is throttling API calls"""
 
-    def retry_call(*args, **kwargs):
-        retries = 0
-        while True:
-            try:
-                retval = func(*args)
-                return retval
-            except BotoServerError as err:
-                if (err.code == 'Throttling' or err.code == 'RequestLimitExceeded') and retries <= 3:
-                    sleep = 3 * (2 ** retries)
-                    print('Being throttled. Retrying after {} seconds..'.format(sleep))
-                    time.sleep(sleep)
-                    retries += 1
-                else:
-                    raise err
-
-    return retry_call
-
-
-@throttling_retry
 def get_ami_id(conn, name):
     """Return the first AMI ID given its name"""
-    images = conn.get_all_images(filters={'name': name})
-    conn.close()
-    if len(images) != 0:
-        return images[0].id
+    ami_id = lookup_cache.get(('ami', conn_key(conn), name), _find_ami_id, conn, name)
+    if ami_id:
+        return ami_id
     else:
         raise RuntimeError('{} AMI not found'.format(name))
 
 
-@throttling_retry
+def _find_ami_id(conn, name):
+    images = scheduler.call(conn.get_all_images, filters={'name': name})
+    return images[0].id if images else None
+
+
 def get_zone_id(conn, name):
     """Return the first Route53 zone ID given its name"""
-    zone = conn.get_zone(name)
-    conn.close()
-    if zone:
-        return zone.id
+    zone_id = lookup_cache.get(('zone', conn_key(conn), name), _find_zone_id, conn, name)
+    if zone_id:
+        return zone_id
     else:
         raise RuntimeError('{} zone not found'.format(name))
 
 
-@throttling_retry
+def _find_zone_id(conn, name):
+    zone = scheduler.call(conn.get_zone, name)
+    return zone.id if zone else None
+
+
 def get_vpc_id(conn, name):
     """Return the first VPC ID given its name and region"""
-    vpcs = conn.get_all_vpcs(filters={'tag:Name': name})
-    conn.close()
-    if len(vpcs) == 1:
-        return vpcs[0].id
+    vpc_ids = lookup_cache.get(('vpc', conn_key(conn), name), _find_vpc_ids, conn, name)
+    if len(vpc_ids) == 1:
+        return vpc_ids[0]
     else:
         raise RuntimeError('{} VPC not found'.format(name))
 
 
-@throttling_retry
-def get_stack_output(conn, name, key):
-    """Return stack output key value"""
-    result = conn.describe_stacks(name)
+def _find_vpc_ids(conn, name):
+    return [vpc.id for vpc in scheduler.call(conn.get_all_vpcs, filters={'tag:Name': name})]
+
+
+def _describe_stack(conn, name):
+    """Return cached outputs and tags of a stack, from the inventory when set"""
+    if inventory is not None:
+        stack = inventory.stack(conn, name)
+        if stack is not None:
+            return _stack_info(stack)
+    return lookup_cache.get(('stack', conn_key(conn), name), _find_stack, conn, name)
+
+
+def _find_stack(conn, name):
+    result = scheduler.call(conn.describe_stacks, name)
     if len(result) != 1:
         raise RuntimeError('{} stack not found'.format(name))
-    outputs = [s.outputs for s in result][0]
-    for output in outputs:
-        if output.key == key:
-            return output.value
+    return _stack_info(result[0])
+
+
+def _stack_info(stack):
+    return {
+        'version': stack_version(stack),
+        'outputs': {o.key: o.value for o in stack.outputs},
+        'tags': dict(stack.tags or {}),
+    }
+
+
+def get_stack_output(conn, name, key):
+    """Return stack output key value"""
+    outputs = _describe_stack(conn, name)['outputs']
+    if key in outputs:
+        return outputs[key]
     raise RuntimeError('{} output not found'.format(key))
 
 
-@throttling_retry
 def get_stack_tag(conn, name, tag):
     """Return stack tag"""
-    result = conn.describe_stacks(name)
-    if len(result) != 1:
-        raise RuntimeError('{} stack not found'.format(name))
-    tags = [s.tags for s in result][0]
-    return tags.get(tag, '')
+    return _describe_stack(conn, name)['tags'].get(tag, '')
 
 
-@throttling_retry
 def get_stack_resource(conn, stack_name, logical_id):
     """Return a physical_resource_id given its logical_id"""
-    resources = conn.describe_stack_resources(stack_name_or_id=stack_name)
-    for r in resources:
-        # TODO: would be nice to check for resource_status
-        if r.logical_resource_id == logical_id:
-            return r.physical_resource_id
-    return None
+    resources = lookup_cache.get(('stack_resources', conn_key(conn), stack_name),
+                                 _find_stack_resources, conn, stack_name)
+    # TODO: would be nice to check for resource_status
+    return resources.get(logical_id)
+
+
+def _find_stack_resources(conn, stack_name):
+    return {r.logical_resource_id: r.physical_resource_id
+            for page in iter_pages(conn.list_stack_resources, stack_name) for r in page}
 
 
-@throttling_retry
 def get_stack_template(conn, stack_name):
     """Return a template body of live stack"""
     try:
-        template = conn.get_template(stack_name)
+        template = scheduler.call(conn.get_template, stack_name)
         return template['GetTemplateResponse']['GetTemplateResult']['TemplateBody'], []
     except BotoServerError as e:
         return None, [e.message]
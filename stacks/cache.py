@@ -0,0 +1,182 @@
+"""
+Caching of AWS lookups used by templates
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.environ.get('HOME', '') + '/.cache'), 'stacks')
+
+# Seconds a lookup stays valid, by lookup kind. Kinds which are not listed
+# here are kept in memory only, for the life of the process.
+CACHE_TTLS = {
+    'ami': 24 * 3600,
+    'vpc': 3600,
+    'zone': 3600,
+    'stack': 300,
+    'stack_resources': 300,
+}
+# Kinds written to a persistent store. Stacks change whenever any job updates
+# them, which this process would not notice, so their lookups stay in memory.
+PERSISTED_KINDS = ['ami', 'vpc', 'zone']
+
+
+class LookupCache(object):
+    """Memoize lookups by key for the life of a process
+
+    Keys are tuples starting with the lookup kind. Lookups of kinds listed in
+    CACHE_TTLS expire after their TTL, which matters to long running servers.
+    When a persistent store is set, lookups of PERSISTED_KINDS are also read
+    from and written to it.
+    None values (failed lookups) are not cached.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._values = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func, *args, **kwargs):
+        """Return cached value for key, calling func(*args, **kwargs) on a miss"""
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if self.store and key[0] in PERSISTED_KINDS:
+                value = self.store.get(key, CACHE_TTLS[key[0]])
+                if value is not None:
+                    self.hits += 1
+                    self._values[key] = value, time.time()
+                    return value
+            self.misses += 1
+        value = func(*args, **kwargs)
+        if value is not None:
+            with self._lock:
+                self._values[key] = value, time.time()
+                if self.store and key[0] in PERSISTED_KINDS:
+                    self.store.set(key, value)
+        return value
+
+    def _get(self, key):
+        value, stored = self._values.get(key, (None, None))
+        if value is not None and key[0] in CACHE_TTLS and time.time() - stored >= CACHE_TTLS[key[0]]:
+            del self._values[key]
+            return None
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            if self.store and key[0] in PERSISTED_KINDS:
+                self.store.delete(key)
+
+    def invalidate_stack(self, conn, stack_name):
+        """Drop all cached lookups of a stack"""
+        for kind in ('stack', 'stack_resources'):
+            self.invalidate((kind, conn_key(conn), stack_name))
+
+    def observe_stack(self, conn, stack_name, version):
+        """Drop cached lookups of a stack if it changed since they were made
+
+        version is what stack_version() returns for a freshly described stack.
+        """
+        key = ('stack', conn_key(conn), stack_name)
+        with self._lock:
+            cached = self._get(key)
+        if cached is not None and cached['version'] != version:
+            self.invalidate_stack(conn, stack_name)
+
+    def reset(self):
+        """Drop lookups and the lock inherited from a parent process, keeping the store"""
+        self._values = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class DiskCache(object):
+    """JSON file backed store of lookup results
+
+    Entries are loaded once and written back by save(). With refresh set,
+    stored entries are ignored but new results are still saved.
+    """
+
+    def __init__(self, fname, refresh=False):
+        self.fname = fname
+        self.entries = {}
+        self.dirty = False
+        if not refresh:
+            try:
+                with open(fname) as f:
+                    self.entries = json.load(f)
+            except (FileNotFoundError, PermissionError, ValueError):
+                pass
+
+    def get(self, key, ttl):
+        entry = self.entries.get(_dump_key(key))
+        if entry and time.time() - entry['time'] < ttl:
+            return entry['value']
+        return None
+
+    def set(self, key, value):
+        self.entries[_dump_key(key)] = {'time': time.time(), 'value': value}
+        self.dirty = True
+
+    def delete(self, key):
+        if self.entries.pop(_dump_key(key), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Atomically write entries back, dropping the ones nothing can use"""
+        if not self.dirty:
+            return
+        now = time.time()
+        max_ttl = max(CACHE_TTLS.values())
+        entries = {k: v for k, v in self.entries.items() if now - v['time'] < max_ttl}
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.fname))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.fname)
+        except OSError as err:
+            print('Unable to save lookup cache: {}'.format(err))
+
+
+def _dump_key(key):
+    return json.dumps(key)
+
+
+def conn_key(conn):
+    """Return a key identifying the service, region and credentials of a connection
+
+    Credentials are identified by the access key ID, so accounts which use the
+    same or no profile are kept apart. Lazy connections provide their own key,
+    so they are not opened just to build one.
+    """
+    lookup_key = getattr(conn, 'lookup_key', None)
+    if isinstance(lookup_key, tuple):
+        return lookup_key
+    region = getattr(getattr(conn, 'region', None), 'name', None)
+    return (conn.__class__.__name__, region, getattr(conn, 'profile_name', None),
+            getattr(conn, 'aws_access_key_id', None))
+
+
+def stack_version(stack):
+    """Return a value that changes whenever a described stack changes"""
+    updated = getattr(stack, 'LastUpdatedTime', None) or str(stack.creation_time)
+    return '{}/{}'.format(updated, stack.stack_status)
+
+
+lookup_cache = LookupCache()
@@ -1,47 +1,116 @@
 """
 Cloudformation related functions
+
+jinja2, yaml, tabulate and tzlocal are slow to import and only needed by some
+commands, so they are imported by the functions using them.
 """
 import builtins
-import difflib
+import contextlib
 import hashlib
+import io
 import json
+import os
+import queue
+import re
 import sys
+import tempfile
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from fnmatch import fnmatch
+from functools import partial
 from operator import attrgetter
 from os import path
 from typing import Mapping, Sequence, Set
 
 import boto
-import jinja2
-import pytz
-import tzlocal
-import yaml
 from boto.exception import BotoServerError
-from jinja2 import meta
-from tabulate import tabulate
 
-from stacks.aws import get_stack_tag, get_stack_template, throttling_retry
-from stacks.helpers import intrinsics_multi_constructor
-from stacks.states import (COMPLETE_STACK_STATES, FAILED_STACK_STATES,
-                           IN_PROGRESS_STACK_STATES, ROLLBACK_STACK_STATES)
+from stacks import __about__, aws
+from stacks.aws import get_stack_template, iter_pages
+from stacks.cache import CACHE_DIR, lookup_cache, stack_version
+from stacks.diff import diff_templates, format_diff, parse_template
+from stacks.scheduler import scheduler
+from stacks.states import ACTIVE_STACK_STATES, COMPLETE_STACK_STATES, IN_PROGRESS_STACK_STATES
 
 YES = ['y', 'Y', 'yes', 'YES', 'Yes']
 
+# CloudFormation template limits
+MAX_RESOURCES = 500
+MAX_DESCRIPTION_BYTES = 1024
+# Larger templates are uploaded to S3, which takes them up to MAX_TEMPLATE_URL_BYTES
+MAX_TEMPLATE_BODY_BYTES = 51200
+MAX_TEMPLATE_URL_BYTES = 1048576
+# Types of parsed template values which hold other values
+CONTAINER_TYPES = (dict, list, tuple, set, frozenset)
+
+# Compiled Jinja templates are cached on disk across invocations
+JINJA_CACHE_DIR = os.path.join(CACHE_DIR, 'jinja')
+# Rendered templates are cached on disk by render_cache_key()
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, 'render')
+# Bump when gen_template results change for the same input
+RENDER_CACHE_VERSION = 2
+# Seconds after which unused renders and compiled templates are evicted
+TEMPLATE_CACHE_MAX_AGE = 30 * 24 * 3600
+# Cleared by --no-cache, templates are then compiled and rendered every time
+template_cache = True
+# Evicting is done once per process
+_template_caches_pruned = False
+# Jinja environments by template directory
+_jinja_envs = {}
+# Compiled templates, variables and templates they reference by
+# (environment, name, source checksum)
+_templates = {}
+
+# How long a looked up stack status is reused within one invocation
+STACK_STATUS_TTL = 2
+_stack_status_cache = {}
+
+# Templates buckets by (S3 connection, bucket name)
+_template_buckets = {}
+
+# Bounds of the adaptive stack events poll interval in seconds
+EVENTS_POLL_MIN = 2
+EVENTS_POLL_MAX = 20
+# Most stacks polled for events at the same time
+EVENTS_MAX_WORKERS = 10
+
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+# Most nested stacks listed at the same time by iter_stack_resources()
+RESOURCES_MAX_WORKERS = 10
+# Keys of json resource and output rows
+RESOURCE_FIELDS = ['stack', 'logical_id', 'physical_id', 'type', 'status']
+OUTPUT_FIELDS = ['key', 'value']
+
+# Most live templates fetched at the same time by diff_stacks()
+DIFF_FETCH_WORKERS = 10
+# Config templates are rendered with in a diff_stacks() worker process
+_render_config = None
+
 
 def gen_template(tpl_file, config):
-    """Return a tuple of json string template and options dict"""
+    """Return a tuple of json string template and options dict
+
+    Results are cached on disk by render_cache_key().
+    """
+    import yaml
+    from stacks.helpers import load_template_docs
+
     tpl_path, tpl_fname = path.split(tpl_file.name)
-    env = _new_jinja_env(tpl_path)
+    env = _jinja_env(tpl_path)
+    source = tpl_file.read()
+    tpl, required_properties, _ = _compile_template(env, tpl_fname, source)
+
+    _check_missing_vars(required_properties, config)
 
-    _check_missing_vars(env, tpl_file, config)
+    key = render_cache_key(env, tpl_fname, source, config)
+    cached = _load_rendered(key)
+    if cached:
+        return cached
 
-    tpl = env.get_template(tpl_fname)
     rendered = tpl.render(config)
     try:
-        yaml.SafeLoader.add_multi_constructor("!", intrinsics_multi_constructor)
-        docs = list(yaml.safe_load_all(rendered))
+        docs = load_template_docs(rendered)
     except yaml.parser.ParserError as err:
         print(err)
         sys.exit(1)
@@ -52,14 +121,13 @@ def gen_template(tpl_file, config):
         tpl, metadata = docs[0], None
 
     errors = validate_template(tpl)
-    return json.dumps(tpl, indent=2, sort_keys=True), metadata, errors
+    result = json.dumps(tpl, indent=2, sort_keys=True), metadata, errors
+    _save_rendered(key, result)
+    return result
 
 
-def _check_missing_vars(env, tpl_file, config):
-    """Check for missing variables in a template string"""
-    tpl_str = tpl_file.read()
-    ast = env.parse(tpl_str)
-    required_properties = meta.find_undeclared_variables(ast)
+def _check_missing_vars(required_properties, config):
+    """Check for variables a template needs missing in config"""
     missing_properties = required_properties - config.keys() - set(dir(builtins))
 
     if len(missing_properties) > 0:
@@ -67,9 +135,171 @@ def _check_missing_vars(env, tpl_file, config):
         sys.exit(1)
 
 
+def render_cache_key(env, tpl_fname, source, config):
+    """Return a key identifying the render of a template with config
+
+    The key covers sources of the template and of all templates it includes or
+    imports, and values of config variables they use. None is returned when the
+    render depends on anything else, like AWS lookups or templates named at
+    render time.
+    """
+    import jinja2
+
+    sources = {}
+    variables = set()
+    pending = [(tpl_fname, source)]
+    while pending:
+        name, src = pending.pop()
+        if name in sources:
+            continue
+        sources[name] = hashlib.sha1(src.encode()).hexdigest()
+        _, tpl_variables, referenced = _compile_template(env, name, src)
+        if None in referenced:
+            return None
+        variables |= tpl_variables
+        for ref in referenced:
+            try:
+                pending.append((ref, env.loader.get_source(env, ref)[0]))
+            except jinja2.TemplateNotFound:
+                return None
+
+    values = {k: config[k] for k in variables if k in config}
+    try:
+        data = json.dumps([__about__.__version__, RENDER_CACHE_VERSION, sources, values], sort_keys=True)
+    except TypeError:
+        return None
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _load_rendered(key):
+    if key is None or not template_cache:
+        return None
+    fname = path.join(RENDER_CACHE_DIR, key + '.json')
+    try:
+        with open(fname) as f:
+            result = tuple(json.load(f))
+        # Renders in use are not evicted
+        os.utime(fname)
+        return result
+    except (OSError, ValueError):
+        return None
+
+
+def _save_rendered(key, result):
+    if key is None or not template_cache:
+        return
+    try:
+        data = json.dumps(result)
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=RENDER_CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path.join(RENDER_CACHE_DIR, key + '.json'))
+    except (OSError, TypeError, ValueError):
+        pass
+    _prune_template_caches()
+
+
+def _prune_template_caches():
+    """Delete renders and compiled templates older than TEMPLATE_CACHE_MAX_AGE"""
+    global _template_caches_pruned
+    if _template_caches_pruned:
+        return
+    _template_caches_pruned = True
+    expired = time.time() - TEMPLATE_CACHE_MAX_AGE
+    for dirname in (RENDER_CACHE_DIR, JINJA_CACHE_DIR):
+        try:
+            entries = list(os.scandir(dirname))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < expired:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def _compile_template(env, tpl_fname, source):
+    """Return a compiled template, names of variables it needs from config and
+    names of templates it includes or imports
+
+    Source is parsed once for all three. Templates are compiled once per
+    process, later processes load them from the bytecode cache.
+    """
+    from jinja2 import meta
+
+    key = (env, tpl_fname, hashlib.sha1(source.encode()).hexdigest())
+    if key not in _templates:
+        filename = path.join(env.loader.searchpath[0], tpl_fname)
+        bucket = None
+        info = None
+        if env.bytecode_cache:
+            bucket = env.bytecode_cache.get_bucket(env, tpl_fname, filename, source)
+            info = _load_template_info(bucket)
+
+        if bucket and bucket.code is not None and info is not None:
+            code = bucket.code
+            variables, referenced = info
+        else:
+            ast = env.parse(source, tpl_fname, filename)
+            variables = meta.find_undeclared_variables(ast)
+            referenced = list(meta.find_referenced_templates(ast))
+            code = env.compile(ast, tpl_fname, filename)
+            if bucket:
+                bucket.code = code
+                _save_bytecode(bucket, variables, referenced)
+
+        tpl = env.template_class.from_code(env, code, env.make_globals(None))
+        _templates[key] = tpl, variables, referenced
+    return _templates[key]
+
+
+def _template_info_file(bucket):
+    return path.join(bucket.environment.bytecode_cache.directory, '{}.info.json'.format(bucket.key))
+
+
+def _load_template_info(bucket):
+    try:
+        with open(_template_info_file(bucket)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('checksum') != bucket.checksum:
+        return None
+    return set(cached['variables']), cached['templates']
+
+
+def _save_bytecode(bucket, variables, referenced):
+    try:
+        bucket.environment.bytecode_cache.set_bucket(bucket)
+        with open(_template_info_file(bucket), 'w') as f:
+            json.dump({'checksum': bucket.checksum, 'variables': sorted(variables), 'templates': referenced}, f)
+    except OSError:
+        pass
+
+
+def _jinja_env(tpl_path):
+    """Return the Jinja environment of a template directory, shared for the
+    life of the process"""
+    key = tpl_path, template_cache
+    if key not in _jinja_envs:
+        _jinja_envs[key] = _new_jinja_env(tpl_path)
+    return _jinja_envs[key]
+
+
 def _new_jinja_env(tpl_path):
+    import jinja2
+
     loader = jinja2.loaders.FileSystemLoader(tpl_path)
-    env = jinja2.Environment(loader=loader)
+    bytecode_cache = None
+    if template_cache:
+        try:
+            os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR)
+        except OSError:
+            pass
+    env = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
     return env
 
 
@@ -77,96 +307,261 @@ def _new_jinja_env(tpl_path):
 # a connection to S3 is being made from a different region than the one a bucket
 # was created in.
 def upload_template(config, tpl, stack_name):
-    """Upload a template to S3 bucket and returns S3 key url"""
-    bn = config.get('templates_bucket_name', '{}-stacks-{}'.format(config['env'], config['region']))
+    """Upload a template to S3 bucket and returns S3 key url
+
+    Keys are addressed by template MD5, so the upload is skipped when a key with
+    matching content already exists.
+    """
+    b = _templates_bucket(config)
+    h = _calc_md5(tpl)
+    key_name = '{}/{}/{}'.format(config['env'], stack_name, h)
 
     try:
-        b = config['s3_conn'].get_bucket(bn)
+        k = scheduler.call(b.get_key, key_name)
+        if k is None or k.etag.strip('"') != h:
+            k = b.new_key(key_name)
+            scheduler.call(k.set_contents_from_string, tpl)
     except boto.exception.S3ResponseError as err:
         if err.code == 'NoSuchBucket':
-            print('Bucket {} does not exist.'.format(bn))
+            print('Bucket {} does not exist.'.format(b.name))
         else:
             print(err)
         sys.exit(1)
 
-    h = _calc_md5(tpl)
-    k = boto.s3.key.Key(b)
-    k.key = '{}/{}/{}'.format(config['env'], stack_name, h)
-    k.set_contents_from_string(tpl)
     url = k.generate_url(expires_in=30)
     return url
 
 
-def stack_resources(conn, stack_name, logical_resource_id=None):
-    """List stack resources"""
+def prune_templates(config, stack_name=None, keep=5):
+    """Delete all but the keep most recently uploaded templates of each stack
+
+    Only keys named like upload_template() names them, {env}/{stack}/{md5}, are
+    considered, other objects in the bucket are left alone.
+    """
+    b = _templates_bucket(config)
+    prefix = '{}/{}'.format(config['env'], stack_name + '/' if stack_name else '')
+    uploaded_key = re.compile(re.escape(config['env']) + '/([^/]+)/[0-9a-f]{32}')
+
+    uploaded = {}
+    marker = ''
+    try:
+        while True:
+            keys = scheduler.call(b.get_all_keys, prefix=prefix, marker=marker)
+            for k in keys:
+                match = uploaded_key.fullmatch(k.name)
+                if match:
+                    uploaded.setdefault(match.group(1), []).append(k)
+            if not keys.is_truncated:
+                break
+            marker = keys[-1].name
+    except boto.exception.S3ResponseError as err:
+        print(err)
+        sys.exit(1)
+
+    expired = []
+    for keys in uploaded.values():
+        keys.sort(key=attrgetter('last_modified'), reverse=True)
+        expired.extend(k.name for k in keys[keep:])
+    # A multi-object delete takes at most 1000 keys
+    for i in range(0, len(expired), 1000):
+        scheduler.call(b.delete_keys, expired[i:i + 1000], quiet=True)
+    return expired
+
+
+def _templates_bucket(config):
+    """Return the templates bucket, reused for the life of the process"""
+    bn = config.get('templates_bucket_name', '{}-stacks-{}'.format(config['env'], config['region']))
+    key = (id(config['s3_conn']), bn)
+    if key not in _template_buckets:
+        _template_buckets[key] = config['s3_conn'].get_bucket(bn, validate=False)
+    return _template_buckets[key]
+
+
+def stack_resources(conn, stack_name, logical_resource_id=None, recursive=False):
+    """List stack resources
+
+    Without a logical_resource_id, all resources are listed page by page, and
+    with recursive set resources of nested stacks too.
+    """
+    from tabulate import tabulate
+
     try:
-        result = conn.describe_stack_resources(stack_name_or_id=stack_name,
-                                               logical_resource_id=logical_resource_id)
+        resources = stack_resource_rows(conn, stack_name, logical_resource_id, recursive)
     except BotoServerError as err:
         print(err.message)
         sys.exit(1)
-    resources = []
-    if logical_resource_id:
-        resources.append([r.physical_resource_id for r in result])
-    else:
-        for r in result:
-            columns = [
-                r.logical_resource_id,
-                r.physical_resource_id,
-                r.resource_type,
-                r.resource_status,
-            ]
-            resources.append(columns)
-
-    if len(result) >= 1:
+    if not logical_resource_id and not recursive:
+        resources = [columns[1:] for columns in resources]
+
+    if len(resources) >= 1:
         return tabulate(resources, tablefmt='plain')
     return None
 
 
-def stack_outputs(conn, stack_name, output_name):
-    """List stacks outputs"""
+def stack_resource_rows(conn, stack_name, logical_resource_id=None, recursive=False):
+    """Return [physical ID] of a logical resource, or RESOURCE_FIELDS columns of all resources"""
+    if logical_resource_id:
+        result = scheduler.call(conn.describe_stack_resources, stack_name_or_id=stack_name,
+                                logical_resource_id=logical_resource_id)
+        return [[r.physical_resource_id] for r in result]
+    return [[name] + _resource_columns(r) for name, r in iter_stack_resources(conn, stack_name, recursive)]
+
+
+def print_stack_resources(conn, stack_name, output_format='text', recursive=False):
+    """Print stack resources, rows of json and tsv output as soon as their page arrives
+
+    json output is one object per line, tsv columns are the stack name,
+    logical and physical IDs, type and status.
+    """
+    if output_format == 'text':
+        output = stack_resources(conn, stack_name, recursive=recursive)
+        if output:
+            print(output)
+        return
+
+    try:
+        for name, r in iter_stack_resources(conn, stack_name, recursive):
+            print(_format_row(RESOURCE_FIELDS, [name] + _resource_columns(r), output_format), flush=True)
+    except BotoServerError as err:
+        print(err.message)
+        sys.exit(1)
+
+
+def iter_stack_resources(conn, stack_name, recursive=False):
+    """Yield (stack name, resource summary) of every resource of a stack
+
+    Resources are yielded as their pages arrive. With recursive set, nested
+    stacks are listed too, concurrently, and their resources yielded as they
+    arrive interleaved with the rest.
+    """
+    if not recursive:
+        for page in iter_pages(conn.list_stack_resources, stack_name):
+            for r in page:
+                yield stack_name, r
+        return
+
+    rows = queue.Queue()
+
+    def walk(stack_id):
+        try:
+            for page in iter_pages(conn.list_stack_resources, stack_id):
+                for r in page:
+                    rows.put((_stack_name_from_id(stack_id), r))
+        except Exception as err:
+            rows.put(err)
+        rows.put(None)
+
+    with ThreadPoolExecutor(max_workers=RESOURCES_MAX_WORKERS) as executor:
+        executor.submit(walk, stack_name)
+        pending = 1
+        while pending:
+            row = rows.get()
+            if row is None:
+                pending -= 1
+            elif isinstance(row, Exception):
+                raise row
+            else:
+                yield row
+                r = row[1]
+                if r.resource_type == NESTED_STACK_TYPE and r.physical_resource_id \
+                        and r.resource_status != 'DELETE_COMPLETE':
+                    executor.submit(walk, r.physical_resource_id)
+                    pending += 1
+
+
+def _stack_name_from_id(stack_id):
+    """Return the stack name of a stack ID (ARN) or name"""
+    if stack_id.startswith('arn:'):
+        return stack_id.split(':', 5)[5].split('/')[1]
+    return stack_id
+
+
+def _resource_columns(r):
+    return [r.logical_resource_id, r.physical_resource_id, r.resource_type, r.resource_status]
+
+
+def _format_row(fields, columns, output_format):
+    """Return a line of json or tsv output"""
+    if output_format == 'json':
+        return json.dumps(dict(zip(fields, columns)))
+    return '\t'.join('' if c is None else str(c).replace('\t', ' ').replace('\n', ' ') for c in columns)
+
+
+def stack_outputs(conn, stack_name, output_name, output_format='text', inventory=None):
+    """List stacks outputs
+
+    json output is one object per line, tsv columns are the key and value.
+    Stacks found in an inventory are not described.
+    """
+    from tabulate import tabulate
+
     try:
-        result = conn.describe_stacks(stack_name)
+        outputs = stack_output_rows(conn, stack_name, output_name, inventory)
     except BotoServerError as err:
         print(err.message)
         sys.exit(1)
 
-    outputs = []
-    outs = [s.outputs for s in result][0]
-    for o in outs:
-        if not output_name:
-            columns = [o.key, o.value]
-            outputs.append(columns)
-        elif output_name and o.key == output_name:
-            outputs.append([o.value])
-
-    if len(result) >= 1:
-        return tabulate(outputs, tablefmt='plain')
+    if output_format != 'text':
+        fields = OUTPUT_FIELDS if not output_name else OUTPUT_FIELDS[1:]
+        return '\n'.join(_format_row(fields, columns, output_format) for columns in outputs) or None
+    return tabulate(outputs, tablefmt='plain')
+
+
+def stack_output_rows(conn, stack_name, output_name=None, inventory=None):
+    """Return [key, value] of every output of a stack, or [value] of the named one"""
+    stack = inventory.stack(conn, stack_name) if inventory else None
+    if stack is None:
+        stack = scheduler.call(conn.describe_stacks, stack_name)[0]
+
+    if output_name:
+        return [[o.value] for o in stack.outputs if o.key == output_name]
+    return [[o.key, o.value] for o in stack.outputs]
+
+
+def list_stacks(conn, name_filter='*', verbose=False, inventory=None):
+    """List active stacks
+
+    Verbose listing is built from one paginated describe_stacks sweep, which
+    returns tags along with every stack. With an inventory, no AWS calls are
+    made.
+    """
+    from tabulate import tabulate
+
+    stacks = list_stack_rows(conn, name_filter, verbose, inventory)
+    if len(stacks) >= 1:
+        return tabulate(stacks, tablefmt='plain')
     return None
 
 
-def list_stacks(conn, name_filter='*', verbose=False):
-    """List active stacks"""
-    states = FAILED_STACK_STATES + COMPLETE_STACK_STATES + IN_PROGRESS_STACK_STATES + ROLLBACK_STACK_STATES
-    s = conn.list_stacks(states)
+def list_stack_rows(conn, name_filter='*', verbose=False, inventory=None):
+    """Return name and status, and with verbose set env and description, of active stacks"""
+    if inventory:
+        pages = [inventory.stacks(conn)]
+    elif verbose:
+        pages = iter_pages(conn.describe_stacks, None)
+    else:
+        pages = iter_pages(conn.list_stacks, ACTIVE_STACK_STATES)
 
     stacks = []
-    for n in s:
-        if name_filter and fnmatch(n.stack_name, name_filter):
+    for page in pages:
+        for n in page:
+            if n.stack_status not in ACTIVE_STACK_STATES or not (name_filter and fnmatch(n.stack_name, name_filter)):
+                continue
             columns = [n.stack_name, n.stack_status]
             if verbose:
-                env = get_stack_tag(conn, n.stack_name, 'Env')
-                columns.append(env)
-                columns.append(n.template_description)
+                columns.append((n.tags or {}).get('Env', ''))
+                columns.append(n.description)
             stacks.append(columns)
+    return stacks
 
-    if len(stacks) >= 1:
-        return tabulate(stacks, tablefmt='plain')
-    return None
 
+def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, create_on_update=False,
+                 change_set=None):
+    """Create or update CloudFormation stack from a jinja2 template
 
-def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, create_on_update=False):
-    """Create or update CloudFormation stack from a jinja2 template"""
+    With a change_set name, a change set is created instead, which creates or
+    updates the stack once executed.
+    """
     tpl, metadata, errors = gen_template(tpl_file, config)
 
     # Set default tags which cannot be overwritten
@@ -204,7 +599,17 @@ def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, cr
         print('Template size:', tpl_size, file=sys.stderr, flush=True)
         return True
 
-    if tpl_size > 51200:
+    if update:
+        live_tags, live_status = _live_stack_tags(conn, stack_name)
+        if live_tags is None and create_on_update:
+            update = False
+        elif live_status in COMPLETE_STACK_STATES and live_tags == {k: str(v) for k, v in tags.items()}:
+            # Tags include the template MD5Sum, so nothing would change. Stacks
+            # in other states are left to CloudFormation to accept or refuse.
+            print('No updates are to be performed.')
+            sys.exit(0)
+
+    if tpl_size > MAX_TEMPLATE_BODY_BYTES:
         tpl_url = upload_template(config, tpl, stack_name)
         tpl_body = None
     else:
@@ -212,18 +617,18 @@ def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, cr
         tpl_body = tpl
 
     try:
-        if update and create_on_update and not stack_exists(conn, stack_name):
-            conn.create_stack(stack_name, template_url=tpl_url, template_body=tpl_body,
-                              tags=tags, capabilities=['CAPABILITY_IAM'],
-                              disable_rollback=disable_rollback)
+        if change_set:
+            from stacks.changeset import create_change_set
+            create_change_set(conn, stack_name, change_set, template_url=tpl_url, template_body=tpl_body,
+                              tags=tags, change_set_type='UPDATE' if update else 'CREATE')
         elif update:
-            conn.update_stack(stack_name, template_url=tpl_url, template_body=tpl_body,
-                              tags=tags, capabilities=['CAPABILITY_IAM'],
-                              disable_rollback=disable_rollback)
+            scheduler.call(conn.update_stack, stack_name, template_url=tpl_url, template_body=tpl_body,
+                           tags=tags, capabilities=['CAPABILITY_IAM'],
+                           disable_rollback=disable_rollback)
         else:
-            conn.create_stack(stack_name, template_url=tpl_url, template_body=tpl_body,
-                              tags=tags, capabilities=['CAPABILITY_IAM'],
-                              disable_rollback=disable_rollback)
+            scheduler.call(conn.create_stack, stack_name, template_url=tpl_url, template_body=tpl_body,
+                           tags=tags, capabilities=['CAPABILITY_IAM'],
+                           disable_rollback=disable_rollback)
     except BotoServerError as err:
         # Do not exit with 1 when one of the below messages are returned
         non_error_messages = [
@@ -235,9 +640,22 @@ def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, cr
             sys.exit(0)
         print(err.message)
         sys.exit(1)
+    _invalidate_stack_status(conn, stack_name)
     return stack_name
 
 
+def _live_stack_tags(conn, stack_name):
+    """Return (tags, status) of a live stack or (None, None) if it does not exist"""
+    try:
+        stacks = scheduler.call(conn.describe_stacks, stack_name)
+    except BotoServerError as err:
+        if 'does not exist' in err.message:
+            return None, None
+        print(err.message)
+        sys.exit(1)
+    return dict(stacks[0].tags or {}), stacks[0].stack_status
+
+
 def _extract_tags(metadata):
     """Return tags from a metadata"""
     tags = {}
@@ -266,7 +684,8 @@ def delete_stack(conn, stack_name, region, profile, confirm):
 
     if response in YES:
         try:
-            conn.delete_stack(stack_name)
+            scheduler.call(conn.delete_stack, stack_name)
+            _invalidate_stack_status(conn, stack_name)
         except BotoServerError as err:
             if 'does not exist' in err.message:
                 print(err.message)
@@ -281,9 +700,7 @@ def delete_stack(conn, stack_name, region, profile, confirm):
 def get_events(conn, stack_name, next_token):
     """Get stack events"""
     try:
-        events = conn.describe_stack_events(stack_name, next_token)
-        next_token = events.next_token
-        return sorted_events(events), next_token
+        return _describe_events(conn, stack_name, next_token)
     except BotoServerError as err:
         if 'does not exist' in err.message:
             print(err.message)
@@ -293,60 +710,218 @@ def get_events(conn, stack_name, next_token):
             sys.exit(1)
 
 
+def _describe_events(conn, stack_name, next_token):
+    events = scheduler.call(conn.describe_stack_events, stack_name, next_token)
+    return sorted_events(events), events.next_token
+
+
 def sorted_events(events):
     """Sort stack events by timestamp"""
     return sorted(events, key=attrgetter('timestamp'))
 
 
-def print_events(conn, stack_name, follow, lines=100, from_dt=datetime.fromtimestamp(0, tz=pytz.UTC)):
+def print_events(conn, stack_name, follow, lines=100, from_dt=datetime.fromtimestamp(0, tz=timezone.utc)):
     """Prints tabulated list of events"""
+    from tabulate import tabulate
+
+    if follow:
+        return follow_events(conn, stack_name, from_dt)
+
+    try:
+        events_display = stack_event_rows(conn, stack_name, lines)
+    except BotoServerError as err:
+        print(err.message)
+        sys.exit(0 if 'does not exist' in err.message else 1)
+
+    print(tabulate(events_display, tablefmt='plain'), flush=True)
+    return get_stack_status(conn, stack_name)
+
+
+def stack_event_rows(conn, stack_name, lines=100):
+    """Return columns of up to lines of the newest events of a stack"""
     events_display = []
-    seen_ids = set()
     next_token = None
-
     while True:
-        events, next_token = get_events(conn, stack_name, next_token)
-        status = get_stack_status(conn, stack_name)
+        events = scheduler.call(conn.describe_stack_events, stack_name, next_token)
+        next_token = events.next_token
+        events = sorted_events(events)
         normalize_events_timestamps(events)
-        if follow:
-            events_display = [(ev.timestamp.astimezone(tzlocal.get_localzone()), ev.resource_status, ev.resource_type,
-                               ev.logical_resource_id, ev.resource_status_reason) for ev in events
-                              if ev.event_id not in seen_ids and ev.timestamp >= from_dt]
-            if len(events_display) > 0:
-                print(tabulate(events_display, tablefmt='plain'), flush=True)
-                seen_ids |= set([event.event_id for event in events])
-            if status not in IN_PROGRESS_STACK_STATES and next_token is None:
-                break
-            if next_token is None:
-                time.sleep(5)
+        events_display.extend([_event_columns(event) for event in events])
+        if len(events_display) >= lines or next_token is None:
+            break
+    return events_display[:lines]
+
+
+def follow_events(conn, stack_name, from_dt):
+    """Print new stack events until the stack leaves an in progress state"""
+    return follow_many_events(conn, [stack_name], from_dt, prefix=False)[stack_name]
+
+
+def follow_many_events(conn, stack_names, from_dt, prefix=True):
+    """Print new events of stacks as one time ordered stream until all of them
+    leave an in progress state
+
+    Stacks are polled concurrently and event lines are prefixed with the stack
+    name. Stack status is tracked from the stacks' own events. Polling speeds up
+    to EVENTS_POLL_MIN seconds while events keep coming in and slows down to
+    EVENTS_POLL_MAX seconds while stacks are idle. Return a dict of stack name
+    to final status.
+    """
+    from tabulate import tabulate
+
+    marks = {name: (from_dt, set()) for name in stack_names}
+    interval = EVENTS_POLL_MIN
+
+    with ThreadPoolExecutor(max_workers=min(len(stack_names), EVENTS_MAX_WORKERS)) as executor:
+        statuses = dict(zip(stack_names, executor.map(partial(get_stack_status, conn), stack_names)))
+        active = list(stack_names)
+        while True:
+            polls = executor.map(lambda name: get_new_events(conn, name, marks[name]), active)
+            new_events = []
+            deleted = []
+            for name, (events, mark) in zip(active, polls):
+                if events is None:
+                    # Stacks which finished deleting can not be described, the others are still followed
+                    statuses[name] = 'DELETE_COMPLETE'
+                    deleted.append(name)
+                    continue
+                marks[name] = mark
+                for ev in events:
+                    new_events.append((name, ev))
+                    if ev.resource_type == 'AWS::CloudFormation::Stack' and ev.logical_resource_id == name:
+                        statuses[name] = ev.resource_status
+            if new_events:
+                new_events.sort(key=lambda e: e[1].timestamp)
+                rows = [((name,) if prefix else ()) + _event_columns(ev) for name, ev in new_events]
+                print(tabulate(rows, tablefmt='plain'), flush=True)
+                interval = EVENTS_POLL_MIN
+            else:
+                interval = min(EVENTS_POLL_MAX, interval * 1.5)
+            for name in deleted:
+                print('Stack {} does not exist'.format(name), flush=True)
+
+            active = [name for name in active if statuses[name] in IN_PROGRESS_STACK_STATES]
+            if not active:
+                return statuses
+            time.sleep(interval)
+
+
+def match_stack_names(conn, patterns):
+    """Return stack names, expanding unix shell-style patterns to active stacks"""
+    names = []
+    active_names = None
+    for pattern in patterns:
+        if not any(c in pattern for c in '*?['):
+            matched = [pattern]
         else:
-            events_display.extend([(event.timestamp.astimezone(tzlocal.get_localzone()), event.resource_status,
-                                    event.resource_type, event.logical_resource_id, event.resource_status_reason)
-                                   for event in events])
-            if len(events_display) >= lines or next_token is None:
+            if active_names is None:
+                active_names = [s.stack_name for page in iter_pages(conn.list_stacks, ACTIVE_STACK_STATES)
+                                for s in page]
+            matched = sorted(name for name in active_names if fnmatch(name, pattern))
+        names.extend(name for name in matched if name not in names)
+    return names
+
+
+def get_new_events(conn, stack_name, mark):
+    """Return stack events newer than mark, oldest first, and the new mark
+
+    mark is a high-water mark of (timestamp, ids of events at that timestamp).
+    Events come newest first, so paging stops at the first page which reaches
+    back past the mark. Events are None when the stack does not exist.
+    """
+    mark_ts, mark_ids = mark
+    new_events = []
+    next_token = None
+    while True:
+        try:
+            events, next_token = _describe_events(conn, stack_name, next_token)
+        except BotoServerError as err:
+            if 'does not exist' in err.message:
+                return None, mark
+            print(err.message)
+            sys.exit(1)
+        normalize_events_timestamps(events)
+        reached_mark = False
+        for ev in reversed(events):
+            if ev.timestamp < mark_ts:
+                reached_mark = True
                 break
+            if ev.event_id not in mark_ids:
+                new_events.append(ev)
+        if reached_mark or next_token is None:
+            break
 
-    if not follow:
-        print(tabulate(events_display[:lines], tablefmt='plain'), flush=True)
+    if not new_events:
+        return [], mark
+    new_events.reverse()
+    newest_ts = new_events[-1].timestamp
+    newest_ids = {ev.event_id for ev in new_events if ev.timestamp == newest_ts}
+    if newest_ts == mark_ts:
+        newest_ids |= mark_ids
+    return new_events, (newest_ts, newest_ids)
 
-    return status
+
+def _event_columns(ev):
+    import tzlocal
+
+    return (ev.timestamp.astimezone(tzlocal.get_localzone()), ev.resource_status, ev.resource_type,
+            ev.logical_resource_id, ev.resource_status_reason)
 
 
-@throttling_retry
 def get_stack_status(conn, stack_name):
-    """Check stack status"""
-    stacks = []
-    resp = conn.list_stacks()
-    stacks.extend(resp)
-    while resp.next_token:
-        resp = conn.list_stacks(next_token=resp.next_token)
-        stacks.extend(resp)
+    """Check stack status
+
+    A single-stack describe call is used, a filtered list of live stacks is only
+    consulted when describe reports the stack as gone. Results are cached for
+    STACK_STATUS_TTL seconds.
+    """
+    key = (id(conn), stack_name)
+    cached = _stack_status_cache.get(key)
+    if cached and time.monotonic() - cached[0] < STACK_STATUS_TTL:
+        return cached[1]
+
+    status = _describe_stack_status(conn, stack_name)
+    _stack_status_cache[key] = (time.monotonic(), status)
+    return status
+
+
+def _describe_stack_status(conn, stack_name):
+    try:
+        stacks = scheduler.call(conn.describe_stacks, stack_name)
+    except BotoServerError as err:
+        if 'does not exist' not in err.message:
+            raise
+        return _list_stack_status(conn, stack_name)
     for s in stacks:
-        if s.stack_name == stack_name and s.stack_status != 'DELETE_COMPLETE':
+        if s.stack_status != 'DELETE_COMPLETE':
+            lookup_cache.observe_stack(conn, stack_name, stack_version(s))
             return s.stack_status
     return None
 
 
+def _list_stack_status(conn, stack_name):
+    """Look stack_name up among live stacks
+
+    Deleted stacks are filtered out server side, so this never pages through
+    DELETE_COMPLETE history.
+    """
+    next_token = None
+    while True:
+        resp = scheduler.call(conn.list_stacks, ACTIVE_STACK_STATES, next_token)
+        for s in resp:
+            if s.stack_name == stack_name:
+                return s.stack_status
+        next_token = resp.next_token
+        if not next_token:
+            return None
+
+
+def _invalidate_stack_status(conn, stack_name):
+    """Drop cached status and lookups of a stack after mutating it"""
+    _stack_status_cache.pop((id(conn), stack_name), None)
+    lookup_cache.invalidate_stack(conn, stack_name)
+
+
 def stack_exists(conn, stack_name):
     """Check whether stack_name exists
 
@@ -361,7 +936,7 @@ def stack_exists(conn, stack_name):
 
 def normalize_events_timestamps(events):
     for ev in events:
-        ev.timestamp = ev.timestamp.replace(tzinfo=pytz.UTC)
+        ev.timestamp = ev.timestamp.replace(tzinfo=timezone.utc)
 
 
 def traverse_template(obj, obj_path=(), memo=None):
@@ -387,13 +962,51 @@ def traverse_template(obj, obj_path=(), memo=None):
 
 
 def validate_template(tpl):
+    """Return a list of errors found in a template
+
+    The template is walked once with an explicit stack. Every container is
+    linked to its parent, so paths are only built for offending values.
+    """
     errors = []
-    for k, v in traverse_template(tpl):
-        if v is None:
-            errors.append(
-                "/{} 'null' values are not allowed in templates".format('/'.join(map(str, k)))
-            )
-    return errors
+    if isinstance(tpl, dict):
+        if len(tpl.get('Resources') or ()) > MAX_RESOURCES:
+            errors.append('/Resources more than {} resources are not allowed in templates'.format(MAX_RESOURCES))
+        description = tpl.get('Description')
+        if isinstance(description, str) and len(description.encode()) > MAX_DESCRIPTION_BYTES:
+            errors.append('/Description longer than {} bytes is not allowed in templates'.format(
+                MAX_DESCRIPTION_BYTES))
+
+    if tpl is None:
+        errors.append("/ 'null' values are not allowed in templates")
+    seen = set()
+    stack = [(tpl, None)] if isinstance(tpl, CONTAINER_TYPES) else []
+    while stack:
+        obj, link = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, dict):
+            items = obj.items()
+            if 'Ref' in obj and (not isinstance(obj['Ref'], str) or not obj['Ref']):
+                errors.append("{} 'Ref' target must be a non-empty string".format(_template_path(link)))
+        else:
+            items = enumerate(obj)
+        for key, value in items:
+            if value is None:
+                errors.append("{} 'null' values are not allowed in templates".format(
+                    _template_path((link, key))))
+            elif isinstance(value, CONTAINER_TYPES):
+                stack.append((value, (link, key)))
+    return sorted(errors)
+
+
+def _template_path(link):
+    """Return a /separated path from a chain of (parent link, key) links"""
+    components = []
+    while link is not None:
+        link, key = link
+        components.append(str(key))
+    return '/' + '/'.join(reversed(components))
 
 
 def print_stack_diff(conn, stack_name, tpl_file, config):
@@ -418,7 +1031,152 @@ def print_stack_diff(conn, stack_name, tpl_file, config):
             print('ERROR: ' + err)
             sys.exit(1)
 
-    if local_template == live_template:
-        return
-    for line in difflib.ndiff(live_template.split('\n'), local_template.split('\n')):
+    changes = diff_templates(parse_template(live_template), json.loads(local_template))
+    for line in format_diff(changes):
         print(line)
+
+
+def diff_stacks(conn, templates, config, profile=None, jobs=None):
+    """Return a dict of template file name to (stack name, changes, errors)
+
+    Templates are rendered in a pool of jobs processes and the live template of
+    each rendered stack is fetched in a thread pool as soon as it is rendered,
+    so diffing many stacks takes about as long as the slowest one. Lookups of
+    all workers share the request budget of one process. Changes are None when
+    a template could not be rendered or its stack fetched.
+    """
+    worker_config = {k: v for k, v in config.items() if k not in aws.CONNECTIONS}
+    workers = _render_workers(jobs, len(templates))
+    results = {}
+    fetches = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(worker_config, profile, workers)) as renderers, \
+            ThreadPoolExecutor(max_workers=DIFF_FETCH_WORKERS) as fetchers:
+        for future in as_completed([renderers.submit(_render_for_diff, t) for t in templates]):
+            tpl_fname, name, local_template, errors = future.result()
+            if local_template is None:
+                results[tpl_fname] = name, None, errors
+            else:
+                fetches[fetchers.submit(get_stack_template, conn, name)] = tpl_fname, name, local_template, errors
+
+        for future in as_completed(fetches):
+            tpl_fname, name, local_template, errors = fetches[future]
+            live_template, fetch_errors = future.result()
+            if fetch_errors:
+                results[tpl_fname] = name, None, errors + fetch_errors
+            else:
+                changes = diff_templates(parse_template(live_template), json.loads(local_template))
+                results[tpl_fname] = name, changes, errors
+    return results
+
+
+def _render_workers(jobs, tasks):
+    """Return the number of render processes, jobs or the CPU count, at most one per task"""
+    return max(1, min(jobs or os.cpu_count() or 1, tasks))
+
+
+def _init_render_worker(config, profile, workers):
+    global _render_config
+    # Workers are forked from a process which may have connected and cached
+    # lookups already, possibly from another thread of a server. Their lookups
+    # share the request budget of one process.
+    aws.forget_connections()
+    lookup_cache.reset()
+    scheduler.reset(workers)
+    _stack_status_cache.clear()
+    _render_config = dict(config, **aws.connect(config.get('region'), profile))
+
+
+def _render_for_diff(tpl_fname):
+    """Return (template file name, stack name, rendered template, errors)"""
+    try:
+        with open(tpl_fname) as tpl_file:
+            local_template, metadata, errors = gen_template(tpl_file, _render_config)
+    except SystemExit:
+        return tpl_fname, None, None, ['unable to render template']
+    except Exception as err:
+        # Undefined variables, failed lookups and the like fail this template only
+        return tpl_fname, None, None, [str(err) or err.__class__.__name__]
+
+    name = metadata.get('name') if metadata else None
+    if not name:
+        return tpl_fname, None, None, ['stack name must be set in stack metadata']
+    return tpl_fname, name, local_template, errors
+
+
+def render_envs(tpl_fname, configs, profile=None, jobs=None):
+    """Return a dict of env to (stack name, template size, errors) of a template
+    rendered with the config of every env
+
+    Envs are rendered concurrently in a pool of jobs processes, which open
+    their own connections for lookups. Size is None when the template could
+    not be rendered.
+    """
+    region = next(iter(configs.values())).get('region') if configs else None
+    workers = _render_workers(jobs, len(configs))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=({'region': region}, profile, workers)) as renderers:
+        futures = {env: renderers.submit(_render_for_env, tpl_fname, config) for env, config in configs.items()}
+        return {env: future.result() for env, future in futures.items()}
+
+
+def _render_for_env(tpl_fname, config):
+    """Return (stack name, template size, errors) of a template rendered with config"""
+    output = io.StringIO()
+    try:
+        with open(tpl_fname) as tpl_file, contextlib.redirect_stdout(output):
+            tpl, metadata, errors = gen_template(tpl_file, dict(config, **_render_config))
+    except SystemExit:
+        return None, None, output.getvalue().splitlines() or ['unable to render template']
+    except Exception as err:
+        return None, None, [str(err) or err.__class__.__name__]
+
+    size = len(tpl)
+    if size > MAX_TEMPLATE_URL_BYTES:
+        errors = errors + ['template larger than {} bytes'.format(MAX_TEMPLATE_URL_BYTES)]
+    return metadata.get('name') if metadata else None, size, errors
+
+
+def print_env_renders(tpl_fname, configs, profile=None, jobs=None):
+    """Print validation errors and sizes of a template rendered for every env
+
+    Return True when it rendered without errors for all envs.
+    """
+    from tabulate import tabulate
+
+    results = render_envs(tpl_fname, configs, profile, jobs)
+    summary = []
+    for env in configs:
+        name, size, errors = results[env]
+        for err in errors:
+            print('ERROR: {}: {}'.format(env, err))
+        summary.append([env, name or '', '' if size is None else size, len(errors)])
+
+    print(tabulate(summary, headers=['Env', 'Stack', 'Size', 'Errors'], tablefmt='plain'))
+    return all(not results[env][2] for env in configs)
+
+
+def print_stacks_diff(conn, templates, config, profile=None, jobs=None):
+    """Print diffs of many templates against their live stacks and a summary
+
+    Return True when all templates could be diffed.
+    """
+    from tabulate import tabulate
+
+    results = diff_stacks(conn, templates, config, profile, jobs)
+    summary = []
+    for tpl_fname in templates:
+        name, changes, errors = results[tpl_fname]
+        for err in errors:
+            print('ERROR: {}: {}'.format(tpl_fname, err))
+        if changes:
+            for line in format_diff(changes, name, tpl_fname):
+                print(line)
+        if changes is None:
+            status = 'error'
+        else:
+            status = 'changed' if changes else 'unchanged'
+        summary.append([name or '', tpl_fname, status, len(changes or [])])
+
+    print(tabulate(summary, headers=['Stack', 'Template', 'Status', 'Changes'], tablefmt='plain'))
+    return all(row[2] != 'error' for row in summary)
@@ -0,0 +1,242 @@
+"""
+CloudFormation change sets
+
+boto2 has no change set calls, so the API actions are called through the
+connection's JSON request helper, the way its own stack calls are made.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from boto.exception import BotoServerError
+
+from stacks import cf
+from stacks.scheduler import scheduler
+
+# Change sets made by stacks are named with this prefix and a timestamp
+CHANGE_SET_PREFIX = 'stacks-'
+# Bounds of the shared change set poll interval in seconds
+CHANGE_SET_POLL_MIN = 2
+CHANGE_SET_POLL_MAX = 20
+# Most change sets created, described or executed at the same time
+CHANGE_SET_MAX_WORKERS = 10
+CHANGE_SET_DONE_STATES = ['CREATE_COMPLETE', 'FAILED', 'DELETE_COMPLETE']
+# Status reasons of change sets which failed because nothing would change
+NO_CHANGES_REASONS = ["didn't contain changes", 'No updates are to be performed']
+
+
+def change_set_name():
+    """Return a new change set name"""
+    return CHANGE_SET_PREFIX + datetime.now(tz=timezone.utc).strftime('%Y%m%d%H%M%S')
+
+
+def create_change_set(conn, stack_name, name, template_url=None, template_body=None, tags=None,
+                      change_set_type='UPDATE'):
+    """Create a change set, return its ID"""
+    params = {
+        'ContentType': 'JSON',
+        'StackName': stack_name,
+        'ChangeSetName': name,
+        'ChangeSetType': change_set_type,
+        'Capabilities.member.1': 'CAPABILITY_IAM',
+    }
+    if template_body:
+        params['TemplateBody'] = template_body
+    else:
+        params['TemplateURL'] = template_url
+    for i, (key, value) in enumerate((tags or {}).items(), 1):
+        params['Tags.member.{}.Key'.format(i)] = key
+        params['Tags.member.{}.Value'.format(i)] = value
+    body = _call(conn, 'CreateChangeSet', params)
+    return body['CreateChangeSetResponse']['CreateChangeSetResult']['Id']
+
+
+def describe_change_set(conn, stack_name, name):
+    """Return a change set as a dict, with the changes of all pages"""
+    params = {'ContentType': 'JSON', 'StackName': stack_name, 'ChangeSetName': name}
+    changes = []
+    while True:
+        result = _call(conn, 'DescribeChangeSet', params)['DescribeChangeSetResponse']['DescribeChangeSetResult']
+        changes.extend(result.get('Changes') or [])
+        if not result.get('NextToken'):
+            result['Changes'] = changes
+            return result
+        params['NextToken'] = result['NextToken']
+
+
+def list_change_sets(conn, stack_name):
+    """Return summaries of all change sets of a stack"""
+    params = {'ContentType': 'JSON', 'StackName': stack_name}
+    summaries = []
+    while True:
+        result = _call(conn, 'ListChangeSets', params)['ListChangeSetsResponse']['ListChangeSetsResult']
+        summaries.extend(result.get('Summaries') or [])
+        if not result.get('NextToken'):
+            return summaries
+        params['NextToken'] = result['NextToken']
+
+
+def execute_change_set(conn, stack_name, name):
+    _call(conn, 'ExecuteChangeSet', {'ContentType': 'JSON', 'StackName': stack_name, 'ChangeSetName': name})
+
+
+def delete_change_set(conn, stack_name, name):
+    _call(conn, 'DeleteChangeSet', {'ContentType': 'JSON', 'StackName': stack_name, 'ChangeSetName': name})
+
+
+def _call(conn, action, params):
+    # pylint: disable=protected-access
+    return scheduler.call(conn._do_request, action, params, '/', 'POST')
+
+
+def latest_change_set(conn, stack_name):
+    """Return the name of the newest executable change set stacks made, or None"""
+    available = [s for s in list_change_sets(conn, stack_name)
+                 if s['ChangeSetName'].startswith(CHANGE_SET_PREFIX) and s.get('ExecutionStatus') == 'AVAILABLE']
+    if not available:
+        return None
+    return max(available, key=lambda s: s['CreationTime'])['ChangeSetName']
+
+
+def wait_change_sets(conn, stack_names, name):
+    """Return a dict of stack name to described change set once all are ready
+
+    Pending change sets are described together in rounds, which back off from
+    CHANGE_SET_POLL_MIN to CHANGE_SET_POLL_MAX seconds, so many stacks share
+    one poll loop. Change sets without changes are deleted. Change sets which
+    can not be described are returned as failed, with the error as reason.
+    """
+    results = {}
+    pending = list(stack_names)
+    interval = CHANGE_SET_POLL_MIN
+    with ThreadPoolExecutor(max_workers=CHANGE_SET_MAX_WORKERS) as executor:
+        while pending:
+            described = executor.map(lambda stack_name: _describe_or_fail(conn, stack_name, name), pending)
+            for stack_name, change_set in zip(pending, described):
+                if change_set['Status'] in CHANGE_SET_DONE_STATES:
+                    results[stack_name] = change_set
+            pending = [n for n in pending if n not in results]
+            if pending:
+                time.sleep(interval)
+                interval = min(CHANGE_SET_POLL_MAX, interval * 2)
+
+    for stack_name, change_set in results.items():
+        if _has_no_changes(change_set):
+            delete_change_set(conn, stack_name, name)
+    return results
+
+
+def _describe_or_fail(conn, stack_name, name):
+    try:
+        return describe_change_set(conn, stack_name, name)
+    except BotoServerError as err:
+        return {'StackName': stack_name, 'ChangeSetName': name, 'Status': 'FAILED', 'StatusReason': err.message,
+                'Changes': []}
+
+
+def _has_no_changes(change_set):
+    reason = change_set.get('StatusReason') or ''
+    return change_set['Status'] == 'FAILED' and any(r in reason for r in NO_CHANGES_REASONS)
+
+
+def plan(conn, templates, config, jobs=CHANGE_SET_MAX_WORKERS):
+    """Create change sets for templates concurrently and wait for them
+
+    Return the change set name and a dict of template file name to
+    (stack name, described change set). Stack name is False when the stack
+    would not change and None when its change set could not be created.
+    """
+    name = change_set_name()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        stack_names = dict(zip(templates, executor.map(lambda t: _prepare(conn, t, config, name), templates)))
+
+    change_sets = wait_change_sets(conn, [n for n in stack_names.values() if n], name)
+    results = {}
+    for tpl_fname, stack_name in stack_names.items():
+        results[tpl_fname] = stack_name, change_sets.get(stack_name)
+    return name, results
+
+
+def _prepare(conn, tpl_fname, config, name):
+    """Create a change set for a template, return its stack name like plan()"""
+    try:
+        with open(tpl_fname) as tpl_file:
+            return cf.create_stack(conn, None, tpl_file, dict(config), update=True, create_on_update=True,
+                                   change_set=name)
+    except SystemExit as err:
+        # create_stack exits with 0 when there is nothing to update
+        return None if err.code else False
+    except Exception as err:
+        # Lookups of the template may fail, change sets of others are still made
+        print('{}: {}'.format(tpl_fname, str(err) or err.__class__.__name__))
+        return None
+
+
+def change_rows(change_set):
+    """Return (action, logical ID, resource type, replacement) of every resource change"""
+    rows = []
+    for change in change_set.get('Changes') or []:
+        rc = change.get('ResourceChange') or {}
+        replacement = rc.get('Replacement') if rc.get('Action') == 'Modify' else ''
+        rows.append((rc.get('Action'), rc.get('LogicalResourceId'), rc.get('ResourceType'),
+                     {'True': 'Replace', 'Conditional': 'Maybe replace'}.get(replacement, '')))
+    return rows
+
+
+def print_change_set(stack_name, change_set):
+    """Print a compact summary of a change set, return False if it failed"""
+    from tabulate import tabulate
+
+    if change_set is None or _has_no_changes(change_set):
+        print('{}: no changes'.format(stack_name))
+        return True
+    if change_set['Status'] != 'CREATE_COMPLETE':
+        print('{}: {} {}'.format(stack_name, change_set['Status'], change_set.get('StatusReason') or ''))
+        return False
+
+    rows = change_rows(change_set)
+    counts = {}
+    for row in rows:
+        action = 'Replace' if row[3] == 'Replace' else row[0]
+        counts[action] = counts.get(action, 0) + 1
+    print('{}: {}'.format(stack_name, ', '.join('{} {}'.format(v, k.lower()) for k, v in sorted(counts.items()))))
+    if rows:
+        print(tabulate(rows, tablefmt='plain'))
+    return True
+
+
+def print_plan(results):
+    """Print change set summaries of plan() results, return False if any failed"""
+    ok = True
+    for tpl_fname in sorted(results):
+        stack_name, change_set = results[tpl_fname]
+        if stack_name is None:
+            print('{}: unable to create change set'.format(tpl_fname))
+            ok = False
+        else:
+            ok = print_change_set(stack_name or tpl_fname, change_set) and ok
+    return ok
+
+
+def apply(conn, stack_names):
+    """Execute the newest change set stacks made of every stack
+
+    Return names of stacks a change set was executed for.
+    """
+    def execute(stack_name):
+        try:
+            name = latest_change_set(conn, stack_name)
+            if name is None:
+                print('{}: no change set to apply'.format(stack_name), flush=True)
+                return False
+            execute_change_set(conn, stack_name, name)
+        except BotoServerError as err:
+            print('{}: {}'.format(stack_name, err.message), flush=True)
+            return False
+        cf._invalidate_stack_status(conn, stack_name)
+        print('{}: executing {}'.format(stack_name, name), flush=True)
+        return True
+
+    with ThreadPoolExecutor(max_workers=CHANGE_SET_MAX_WORKERS) as executor:
+        executed = list(executor.map(execute, stack_names))
+    return [n for n, ok in zip(stack_names, executed) if ok]
@@ -5,15 +5,32 @@ import configargparse
 from stacks import __about__
 
 
-def parse_options():
+def parse_options(argv=None):
     """Handle command-line options
 
     Return parser object and list of arguments
     """
     parser = configargparse.ArgumentParser()
-    parser.add_argument('-p', '--profile', required=False)
-    parser.add_argument('-r', '--region', required=False)
+    parser.add_argument('-p', '--profile', required=False,
+                        help='Profile, or comma separated profiles or all for list, outputs, resources and events')
+    parser.add_argument('-r', '--region', required=False,
+                        help='Region, or comma separated regions or all for list, outputs, resources and events. '
+                             'all is the regions boto 2 knows, which lacks regions opened since 2017, '
+                             'like eu-west-3 or eu-north-1')
     parser.add_argument('--version', action='version', version=__about__.__version__)
+    # noinspection PyArgumentList
+    parser.add_argument('--cache', action='store_true', env_var='STACKS_CACHE',
+                        help='Cache AMI, VPC and zone lookups on disk between runs')
+    parser.add_argument('--no-cache', action='store_true', env_var='STACKS_NO_CACHE',
+                        help='Do not use the lookup, config and template caches')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='Ignore cached lookups and store fresh results')
+    # noinspection PyArgumentList
+    parser.add_argument('--socket', env_var='STACKS_SOCKET', required=False,
+                        help='Unix socket of a stacks server to run commands with')
+    parser.add_argument('--from-inventory', action='store_true',
+                        help='Answer list, outputs and stack lookups from the inventory refreshed by '
+                             '`stacks inventory`')
     subparsers = parser.add_subparsers(title='available subcommands', dest='subcommand')
 
     # resources subparser
@@ -21,12 +38,19 @@ def parse_options():
     parser_resources.add_argument('name', help='Stack name')
     parser_resources.add_argument('logical_id', nargs='?', default=None,
                                   help='Logical resource id. Returns physical_resource_id.')
+    parser_resources.add_argument('-o', '--output', default='text', choices=['text', 'json', 'tsv'],
+                                  dest='output_format',
+                                  help='Output format, json and tsv print a line per resource as it arrives')
+    parser_resources.add_argument('--recursive', action='store_true',
+                                  help='Include resources of nested stacks')
 
     # outputs subparser
     parser_outputs = subparsers.add_parser('outputs', help='List stack outputs')
     parser_outputs.add_argument('name', help='Stack name')
     parser_outputs.add_argument('output_name', nargs='?', default=None,
                                 help='Output name. Returns output value.')
+    parser_outputs.add_argument('-o', '--output', default='text', choices=['text', 'json', 'tsv'],
+                                dest='output_format', help='Output format, json prints an object per line')
 
     # config subparser
     parser_config = subparsers.add_parser('config', help='Print config properties')
@@ -66,6 +90,10 @@ def parse_options():
     parser_create.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
     parser_create.add_argument('-P', '--property', required=False, action='append')
     parser_create.add_argument('-d', '--dry-run', action='store_true')
+    parser_create.add_argument('--all-envs', action='store_true',
+                               help='Render and validate the template for every env in config, implies --dry-run')
+    parser_create.add_argument('-j', '--jobs', default=None, type=int,
+                               help='Number of envs to render at the same time with --all-envs, CPU count by default')
     parser_create.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
 
     # update subparser
@@ -84,10 +112,17 @@ def parse_options():
     parser_update.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
     parser_update.add_argument('-P', '--property', required=False, action='append')
     parser_update.add_argument('-d', '--dry-run', action='store_true')
+    parser_update.add_argument('--all-envs', action='store_true',
+                               help='Render and validate the template for every env in config, implies --dry-run')
+    parser_update.add_argument('-j', '--jobs', default=None, type=int,
+                               help='Number of envs to render at the same time with --all-envs, CPU count by default')
     parser_update.add_argument('--create', dest='create_on_update',
                                help='Create if stack does not exist.',
                                action='store_true')
     parser_update.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
+    parser_update.add_argument('--change-set', action='store_true',
+                               help='Create a change set and print its changes instead of updating, '
+                                    'see the apply subcommand')
 
     # delete subparser
     parser_delete = subparsers.add_parser('delete', help='Delete an existing stack')
@@ -97,14 +132,15 @@ def parse_options():
 
     # events subparser
     parser_events = subparsers.add_parser('events', help='List events from a stack')
-    parser_events.add_argument('name')
+    parser_events.add_argument('name', nargs='+', help='Stack names or unix shell-style patterns')
     parser_events.add_argument('-f', '--follow', dest='events_follow', action='store_true',
                                help='Poll for new events until stopped (overrides -n)')
     parser_events.add_argument('-n', '--lines', default=100, type=int)
 
     # diff subparser
     parser_create = subparsers.add_parser('diff', help='Print diff of current vs compiled template')
-    parser_create.add_argument('-t', '--template', required=True, type=configargparse.FileType())
+    parser_create.add_argument('-t', '--template', required=True, action='append',
+                               help='Template file or directory of templates, can be given many times')
     # noinspection PyArgumentList
     parser_create.add_argument('-c', '--config', default='config.yaml',
                                env_var='STACKS_CONFIG', required=False,
@@ -117,8 +153,80 @@ def parse_options():
     # noinspection PyArgumentList
     parser_create.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
     parser_create.add_argument('-P', '--property', required=False, action='append')
-
-    return parser, parser.parse_args()
+    parser_create.add_argument('-j', '--jobs', default=None, type=int,
+                               help='Templates rendered at the same time when diffing many')
+
+    # deploy subparser
+    parser_deploy = subparsers.add_parser('deploy', help='Create or update many stacks in dependency order')
+    parser_deploy.add_argument('templates', nargs='*', help='Template files or directories of templates')
+    parser_deploy.add_argument('-m', '--manifest', type=configargparse.FileType(),
+                               help='YAML list of template paths relative to the manifest')
+    # noinspection PyArgumentList
+    parser_deploy.add_argument('-c', '--config', default='config.yaml',
+                               env_var='STACKS_CONFIG', required=False,
+                               type=_is_file)
+    # noinspection PyArgumentList
+    parser_deploy.add_argument('--config-dir', default='config.d',
+                               env_var='STACKS_CONFIG_DIR', required=False,
+                               type=_is_dir)
+    # noinspection PyArgumentList
+    parser_deploy.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
+    parser_deploy.add_argument('-P', '--property', required=False, action='append')
+    parser_deploy.add_argument('-j', '--jobs', default=4, type=int, help='Stacks deployed at the same time')
+    parser_deploy.add_argument('-d', '--dry-run', action='store_true', help='Print deployment order and exit')
+
+    # plan subparser
+    parser_plan = subparsers.add_parser('plan', help='Create change sets of many stacks and print their changes')
+    parser_plan.add_argument('templates', nargs='*', help='Template files or directories of templates')
+    parser_plan.add_argument('-m', '--manifest', type=configargparse.FileType(),
+                             help='YAML list of template paths relative to the manifest')
+    # noinspection PyArgumentList
+    parser_plan.add_argument('-c', '--config', default='config.yaml',
+                             env_var='STACKS_CONFIG', required=False,
+                             type=_is_file)
+    # noinspection PyArgumentList
+    parser_plan.add_argument('--config-dir', default='config.d',
+                             env_var='STACKS_CONFIG_DIR', required=False,
+                             type=_is_dir)
+    # noinspection PyArgumentList
+    parser_plan.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
+    parser_plan.add_argument('-P', '--property', required=False, action='append')
+    parser_plan.add_argument('-j', '--jobs', default=10, type=int, help='Change sets created at the same time')
+
+    # apply subparser
+    parser_apply = subparsers.add_parser('apply', help='Execute change sets made by update --change-set or plan')
+    parser_apply.add_argument('name', nargs='+', help='Stack names or unix shell-style patterns')
+    parser_apply.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
+
+    # prune-templates subparser
+    parser_prune = subparsers.add_parser('prune-templates',
+                                         help='Delete old templates uploaded to the templates bucket')
+    # noinspection PyArgumentList
+    parser_prune.add_argument('-c', '--config', default='config.yaml',
+                              env_var='STACKS_CONFIG', required=False,
+                              type=_is_file)
+    # noinspection PyArgumentList
+    parser_prune.add_argument('--config-dir', default='config.d',
+                              env_var='STACKS_CONFIG_DIR', required=False,
+                              type=_is_dir)
+    # noinspection PyArgumentList
+    parser_prune.add_argument('-e', '--env', env_var='STACKS_ENV', required=False, default=None)
+    parser_prune.add_argument('--keep-uploaded', default=5, type=int,
+                              help='Number of most recent templates to keep per stack')
+    parser_prune.add_argument('name', nargs='?', default=None, help='Stack name, all stacks by default')
+
+    # inventory subparser
+    parser_inventory = subparsers.add_parser('inventory', help='Refresh the local inventory of stacks')
+    parser_inventory.add_argument('--regions', nargs='+', default=None,
+                                  help='Regions to refresh, the current region by default')
+    parser_inventory.add_argument('-j', '--jobs', type=int, default=10,
+                                  help='Number of stacks to describe at the same time per region')
+
+    # serve subparser
+    subparsers.add_parser('serve', help='Serve commands of clients given --socket, keeping connections '
+                                        'and caches warm')
+
+    return parser, parser.parse_args(argv)
 
 
 def _is_file(fname):
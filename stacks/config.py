@@ -1,27 +1,99 @@
+import hashlib
 import json
 import os
+import pickle
 import sys
+import tempfile
+import time
 
-import boto
 import yaml
 
+from stacks.cache import CACHE_DIR
+from stacks.helpers import ConfigLoader
+
 AWS_CONFIG_FILE = os.environ.get('HOME', '') + '/.aws/config'
 AWS_CREDENTIALS_FILE = os.environ.get('HOME', '') + '/.aws/credentials'
 RESERVED_PROPERTIES = ['region', 'profile', 'env']
 
+# Parsed config files and merged configs are cached here between runs
+CONFIG_CACHE_FILE = os.path.join(CACHE_DIR, 'config.pickle')
+# Most merged configs kept, by env and set of files
+CONFIG_CACHE_MERGED = 32
+# Files modified this recently are hashed even if their size and mtime did
+# not change, as they may have been written again within the same mtime tick
+CONFIG_CACHE_RACY_SECONDS = 2
+# Cleared by --no-cache, config files are then parsed every time
+config_cache = True
+# Config cache of this process, read from CONFIG_CACHE_FILE on first use
+_config_cache = None
+
 
 def config_load(env, config_file=None, config_dir=None):
-    """Load stack configuration files"""
-    config = {}
+    """Load stack configuration files
+
+    The merged config is cached by env and the hashes of all files. Files are
+    only parsed again when their content changed, which is checked by size and
+    mtime first and by hash when those changed.
+    """
+    conf_files = _config_files(config_file, config_dir)
+
+    cache = _load_config_cache()
+    files = [_cached_config_file(cache, f) for f in conf_files]
+    key = hashlib.sha1(json.dumps([env, [digest for digest, _ in files]]).encode()).hexdigest()
+
+    merged = cache['merged'].pop(key, None)
+    if merged is None:
+        config = _merge_files([pickle.loads(data) if data else None for _, data in files], env)
+        merged = pickle.dumps(config, pickle.HIGHEST_PROTOCOL)
+        cache['dirty'] = True
+    # Most recently used last
+    cache['merged'][key] = merged
+    while len(cache['merged']) > CONFIG_CACHE_MERGED:
+        del cache['merged'][next(iter(cache['merged']))]
+    _save_config_cache(cache)
+    return pickle.loads(merged)
+
+
+def config_load_envs(config_file=None, config_dir=None):
+    """Return a dict of env name to merged config of every env config files define
+
+    Files are read once and every env is merged from the same parsed content.
+    Envs are the sections next to `common`, files without one define none.
+    """
+    cache = _load_config_cache()
+    parsed = [pickle.loads(data) if data else None
+              for _, data in (_cached_config_file(cache, f) for f in _config_files(config_file, config_dir))]
+    _save_config_cache(cache)
+
+    envs = []
+    for c in parsed:
+        envs.extend(env for env in _env_names(c) if env not in envs)
+    return {env: _merge_files(parsed, env) for env in envs}
+
+
+def _config_files(config_file, config_dir):
     conf_files = list_files(config_dir)
     if config_file:
         conf_files.insert(0, config_file)
-    for f in conf_files:
-        config.update(config_merge(env, f))
+    return conf_files
+
+
+def _merge_files(parsed, env):
+    """Return the config of env merged from parsed config files"""
+    config = {}
+    for c in parsed:
+        if c:
+            config.update(_merge(c, env))
     config['env'] = env
     return config
 
 
+def _env_names(config):
+    if not isinstance(config, dict) or 'common' not in config:
+        return []
+    return [k for k, v in config.items() if isinstance(v, dict) and k != 'common']
+
+
 def config_merge(env, config_file=None):
     """Merge stacks configuration file environments"""
     c = _load_yaml(config_file)
@@ -71,10 +143,71 @@ def _merge(config, env):
     return c
 
 
+def _cached_config_file(cache, fname):
+    """Return (hash, pickled content) of a config file, parsing it if it changed"""
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None, None
+    path = os.path.abspath(fname)
+    entry = cache['files'].get(path)
+    if entry and entry[:2] == [st.st_mtime_ns, st.st_size] and time.time() - st.st_mtime > CONFIG_CACHE_RACY_SECONDS:
+        return entry[2:]
+
+    try:
+        with open(fname, 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return None, None
+    digest = hashlib.sha1(raw).hexdigest()
+    if not entry or entry[2] != digest:
+        try:
+            c = yaml.load(raw, Loader=ConfigLoader)
+        except yaml.YAMLError:
+            c = None
+        entry = [st.st_mtime_ns, st.st_size, digest, pickle.dumps(c, pickle.HIGHEST_PROTOCOL)]
+    else:
+        entry = [st.st_mtime_ns, st.st_size] + entry[2:]
+    cache['files'][path] = entry
+    cache['dirty'] = True
+    return entry[2:]
+
+
+def _load_config_cache():
+    global _config_cache
+    if not config_cache:
+        return {'files': {}, 'merged': {}, 'dirty': False}
+    if _config_cache is None:
+        try:
+            with open(CONFIG_CACHE_FILE, 'rb') as f:
+                _config_cache = pickle.load(f)
+            _config_cache['dirty'] = False
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+            _config_cache = {'files': {}, 'merged': {}, 'dirty': False}
+    return _config_cache
+
+
+def _save_config_cache(cache):
+    """Write the cache back, dropping files which no longer exist"""
+    if not cache['dirty'] or not config_cache:
+        return
+    cache['dirty'] = False
+    for path in [p for p in cache['files'] if not os.path.exists(p)]:
+        del cache['files'][path]
+    try:
+        os.makedirs(os.path.dirname(CONFIG_CACHE_FILE), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CONFIG_CACHE_FILE))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'files': cache['files'], 'merged': cache['merged']}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, CONFIG_CACHE_FILE)
+    except OSError:
+        pass
+
+
 def _load_yaml(fname):
     try:
         with open(fname) as f:
-            return yaml.full_load(f)
+            return yaml.load(f, Loader=ConfigLoader)
     except (FileNotFoundError, PermissionError, yaml.YAMLError):
         return None
 
@@ -84,6 +217,8 @@ def get_region_name(profile):
 
     Return region name
     """
+    import boto
+
     if os.path.isfile(AWS_CREDENTIALS_FILE):
         boto.config.load_credential_file(AWS_CREDENTIALS_FILE)
 
@@ -99,6 +234,8 @@ def get_default_region_name():
 
     Return region name
     """
+    import boto
+
     if os.path.isfile(AWS_CONFIG_FILE):
         boto.config.load_credential_file(AWS_CONFIG_FILE)
 
@@ -111,6 +248,8 @@ def get_default_region_name():
 
 def profile_exists(profile):
     """Return True if profile exists in AWS_CREDENTIALS_FILE"""
+    import boto
+
     if os.path.isfile(AWS_CREDENTIALS_FILE):
         boto.config.load_credential_file(AWS_CREDENTIALS_FILE)
         if boto.config.get(profile, 'region'):
@@ -120,6 +259,26 @@ def profile_exists(profile):
     return False
 
 
+def list_profiles():
+    """Return names of profiles in AWS_CREDENTIALS_FILE and AWS_CONFIG_FILE"""
+    import configparser
+
+    profiles = []
+    for fname, prefix in [(AWS_CREDENTIALS_FILE, ''), (AWS_CONFIG_FILE, 'profile ')]:
+        parser = configparser.RawConfigParser()
+        parser.read(fname)
+        for section in parser.sections():
+            if section.startswith(prefix):
+                profile = section[len(prefix):]
+            elif section == 'default':
+                profile = section
+            else:
+                continue
+            if profile not in profiles:
+                profiles.append(profile)
+    return profiles
+
+
 def validate_properties(props_arg):
     properties = dict(p.split('=') for p in props_arg)
     reserved = [i for i in RESERVED_PROPERTIES if i in properties.keys()]
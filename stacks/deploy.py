@@ -0,0 +1,192 @@
+"""
+Deploy many stacks concurrently in dependency order
+"""
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import jinja2
+import yaml
+from jinja2 import nodes
+
+from stacks import cf
+from stacks.cache import lookup_cache
+from stacks.states import FAILED_STACK_STATES, IN_PROGRESS_STACK_STATES, ROLLBACK_STACK_STATES
+
+# Template functions taking a stack name as their second argument
+STACK_LOOKUPS = ['get_stack_output', 'get_stack_resource']
+POLL_INTERVAL = 5
+FAILED_STATES = FAILED_STACK_STATES + ROLLBACK_STACK_STATES + ['FAILED', 'SKIPPED']
+
+
+def find_templates(paths, manifest=None):
+    """Return template file names from files, directories and a manifest
+
+    A manifest is a YAML list of template paths relative to the manifest.
+    """
+    paths = list(paths)
+    if manifest:
+        base = os.path.dirname(manifest.name)
+        paths.extend(os.path.join(base, p) for p in yaml.safe_load(manifest) or [])
+
+    templates = []
+    for p in paths:
+        if os.path.isdir(p):
+            templates.extend(sorted(os.path.join(p, f) for f in os.listdir(p)
+                                    if f.endswith('.yaml') and os.path.isfile(os.path.join(p, f))))
+        else:
+            templates.append(p)
+    return templates
+
+
+def template_dependencies(tpl_fname, config):
+    """Return names of stacks a template looks up outputs or resources of
+
+    Calls are found in the template AST, so lookups in branches which are not
+    rendered count too. Stack name arguments are evaluated against config;
+    names which cannot be resolved, e.g. loop variables, are ignored.
+    """
+    env = jinja2.Environment()
+    with open(tpl_fname) as f:
+        ast = env.parse(f.read())
+
+    deps = set()
+    for call in ast.find_all(nodes.Call):
+        if not isinstance(call.node, nodes.Name) or call.node.name not in STACK_LOOKUPS or len(call.args) < 2:
+            continue
+        expr = nodes.Template([nodes.Output([call.args[1]])], lineno=1)
+        tpl = env.template_class.from_code(env, env.compile(expr), env.make_globals(None))
+        try:
+            name = tpl.render(config)
+        except jinja2.exceptions.TemplateError:
+            continue
+        if name:
+            deps.add(name)
+    return deps
+
+
+def _stack_name(tpl_fname, config):
+    """Return stack name from template metadata, rendered without AWS lookups"""
+    discovery_config = dict(config)
+    for f in STACK_LOOKUPS + ['get_ami_id', 'get_vpc_id', 'get_zone_id']:
+        discovery_config[f] = lambda *args: '-'.join(str(a) for a in args[1:])
+    try:
+        with open(tpl_fname) as tpl_file:
+            _, metadata, _ = cf.gen_template(tpl_file, discovery_config)
+    except Exception as err:
+        print('{}: {}'.format(tpl_fname, str(err) or err.__class__.__name__))
+        sys.exit(1)
+    name = metadata.get('name') if metadata else None
+    if not name:
+        print('{}: stack name must be set in stack metadata.'.format(tpl_fname))
+        sys.exit(1)
+    return name
+
+
+def build_graph(templates, config):
+    """Return a dict of stack name to (template, names of stacks it depends on)
+
+    Only dependencies on stacks deployed together are kept, others are
+    expected to exist already.
+    """
+    graph = {}
+    for tpl_fname in templates:
+        name = _stack_name(tpl_fname, config)
+        if name in graph:
+            print('Stack {} is defined by both {} and {}'.format(name, graph[name][0], tpl_fname))
+            sys.exit(1)
+        graph[name] = (tpl_fname, template_dependencies(tpl_fname, config))
+
+    for name, (tpl_fname, deps) in graph.items():
+        deps.intersection_update(graph.keys())
+        deps.discard(name)
+    _check_cycles(graph)
+    return graph
+
+
+def _check_cycles(graph):
+    done, visiting = set(), []
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            cycle = visiting[visiting.index(name):] + [name]
+            print('Dependency cycle: {}'.format(' -> '.join(cycle)))
+            sys.exit(1)
+        visiting.append(name)
+        for dep in sorted(graph[name][1]):
+            visit(dep)
+        visiting.pop()
+        done.add(name)
+
+    for n in sorted(graph):
+        visit(n)
+
+
+def print_plan(graph):
+    """Print stacks grouped by the order they can be deployed in"""
+    remaining = dict(graph)
+    done = set()
+    level = 1
+    while remaining:
+        ready = sorted(n for n, (_, deps) in remaining.items() if deps <= done)
+        print('Stage {}:'.format(level))
+        for n in ready:
+            print('  {} ({})'.format(n, remaining.pop(n)[0]))
+        done.update(ready)
+        level += 1
+
+
+def deploy(conn, graph, config, jobs=4):
+    """Create or update stacks of graph, independent ones concurrently
+
+    A stack starts as soon as all stacks it depends on completed. Dependents of
+    failed stacks are skipped. Return a dict of stack name to final status.
+    """
+    results = {}
+    pending = dict(graph)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for name, (tpl_fname, deps) in sorted(pending.items()):
+                if any(d in results and results[d] in FAILED_STATES for d in deps):
+                    print('{}: skipped, a dependency failed'.format(name), flush=True)
+                    results[name] = 'SKIPPED'
+                    del pending[name]
+                elif all(d in results for d in deps):
+                    running[executor.submit(_deploy_stack, conn, name, tpl_fname, config)] = name
+                    del pending[name]
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                results[name] = future.result()
+                print('{}: {}'.format(name, results[name]), flush=True)
+    return results
+
+
+def _deploy_stack(conn, name, tpl_fname, config):
+    print('{}: deploying {}'.format(name, tpl_fname), flush=True)
+    try:
+        with open(tpl_fname) as tpl_file:
+            cf.create_stack(conn, name, tpl_file, dict(config), update=True, create_on_update=True)
+    except SystemExit as err:
+        # create_stack exits with 0 when there is nothing to update
+        if err.code:
+            return 'FAILED'
+    except Exception as err:
+        # Lookups of the template may fail, other stacks carry on
+        print('{}: {}'.format(name, str(err) or err.__class__.__name__), flush=True)
+        return 'FAILED'
+
+    status = cf.get_stack_status(conn, name)
+    while status in IN_PROGRESS_STACK_STATES:
+        time.sleep(POLL_INTERVAL)
+        status = cf.get_stack_status(conn, name)
+    # Dependents must see the new outputs
+    lookup_cache.invalidate_stack(conn, name)
+    return status
@@ -0,0 +1,66 @@
+"""
+Structural diff of CloudFormation templates
+"""
+import json
+
+ADDED = '+'
+REMOVED = '-'
+CHANGED = '~'
+
+# Marks a key or index missing on one side
+_MISSING = object()
+
+
+def parse_template(body):
+    """Return a parsed template from a JSON or YAML body or an already parsed one"""
+    if not isinstance(body, str):
+        return body
+    try:
+        return json.loads(body)
+    except ValueError:
+        from stacks.helpers import load_template_docs
+        docs = load_template_docs(body)
+        return docs[-1] if docs else None
+
+
+def diff_templates(old, new):
+    """Return a list of (change, path, old value, new value) between templates
+
+    Mappings are compared key by key and lists index by index, so every value
+    is visited once. Paths are tuples of keys and indexes.
+    """
+    changes = []
+    stack = [((), old, new)]
+    while stack:
+        path, a, b = stack.pop()
+        if a is _MISSING:
+            changes.append((ADDED, path, None, b))
+        elif b is _MISSING:
+            changes.append((REMOVED, path, a, None))
+        elif isinstance(a, dict) and isinstance(b, dict):
+            for key in sorted(a.keys() | b.keys(), key=str, reverse=True):
+                stack.append((path + (key,), a.get(key, _MISSING), b.get(key, _MISSING)))
+        elif isinstance(a, list) and isinstance(b, list):
+            for i in reversed(range(max(len(a), len(b)))):
+                stack.append((path + (i,), a[i] if i < len(a) else _MISSING, b[i] if i < len(b) else _MISSING))
+        elif a != b or type(a) is not type(b):
+            changes.append((CHANGED, path, a, b))
+    return changes
+
+
+def format_diff(changes, old_name='live', new_name='local'):
+    """Return unified diff style lines describing changes"""
+    if not changes:
+        return []
+    lines = ['--- ' + old_name, '+++ ' + new_name]
+    for change, path, old, new in changes:
+        lines.append('@@ {} {} @@'.format(change, '/'.join(str(p) for p in path) or '/'))
+        if change != ADDED:
+            lines.extend('-' + line for line in _dump(old))
+        if change != REMOVED:
+            lines.extend('+' + line for line in _dump(new))
+    return lines
+
+
+def _dump(value):
+    return json.dumps(value, indent=2, sort_keys=True).split('\n')
@@ -0,0 +1,90 @@
+"""
+Run read commands against many regions and profiles at once
+
+Every (region, profile) pair is queried with its own pooled connection in a
+thread pool, and the rows are merged into one table with region and profile
+columns.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from boto.exception import BotoServerError
+
+from stacks import aws, cf
+
+# Most (region, profile) pairs queried at the same time
+FANOUT_MAX_WORKERS = 24
+FANOUT_SUBCOMMANDS = ['list', 'outputs', 'resources', 'events']
+TARGET_FIELDS = ['region', 'profile']
+EVENT_FIELDS = ['stack', 'timestamp', 'status', 'type', 'logical_id', 'reason']
+
+
+def is_many(value):
+    """Return True if a --region or --profile value names more than one"""
+    return bool(value) and (value == 'all' or ',' in value)
+
+
+def expand(value, all_values):
+    """Return the names a comma separated value stands for, all_values() for `all`"""
+    if value == 'all':
+        return all_values()
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def fan_out(targets, func, jobs=FANOUT_MAX_WORKERS):
+    """Call func with the CloudFormation connection of every (region, profile)
+
+    Return a list of (region, profile, rows) in targets order, where rows is
+    the error message when the call failed.
+    """
+    def call(target):
+        try:
+            return func(aws.connect(*target)['cf_conn'])
+        except BotoServerError as err:
+            return err.message
+
+    with ThreadPoolExecutor(max_workers=min(len(targets), jobs) or 1) as executor:
+        return [tuple(target) + (rows,) for target, rows in zip(targets, executor.map(call, targets))]
+
+
+def command(args, inventory=None):
+    """Return the fields and the function of a connection returning rows of a read command"""
+    if args.subcommand == 'list':
+        fields = ['name', 'status'] + (['env', 'description'] if args.verbose else [])
+        return fields, lambda conn: cf.list_stack_rows(conn, args.name, args.verbose, inventory)
+    if args.subcommand == 'outputs':
+        fields = cf.OUTPUT_FIELDS[1:] if args.output_name else cf.OUTPUT_FIELDS
+        return fields, lambda conn: cf.stack_output_rows(conn, args.name, args.output_name, inventory)
+    if args.subcommand == 'resources':
+        fields = ['physical_id'] if args.logical_id else cf.RESOURCE_FIELDS
+        return fields, lambda conn: cf.stack_resource_rows(conn, args.name, args.logical_id, args.recursive)
+    if args.subcommand == 'events':
+        def events(conn):
+            return [[name] + list(columns) for name in cf.match_stack_names(conn, args.name)
+                    for columns in cf.stack_event_rows(conn, name, args.lines)]
+        return EVENT_FIELDS, events
+    raise ValueError('{} can not be fanned out'.format(args.subcommand))
+
+
+def print_results(results, fields, output_format='text'):
+    """Print fan_out() results as one table, return False if any pair failed
+
+    Failed pairs are reported after the table.
+    """
+    from tabulate import tabulate
+
+    rows = []
+    errors = []
+    for region, profile, result in results:
+        if isinstance(result, str):
+            errors.append('{}/{}: {}'.format(region, profile or 'default', result))
+        else:
+            rows.extend([region, profile or ''] + list(columns) for columns in result)
+
+    if output_format != 'text':
+        for row in rows:
+            print(cf._format_row(TARGET_FIELDS + fields, row, output_format))
+    elif rows:
+        print(tabulate(rows, headers=[f.replace('_', ' ').title() for f in TARGET_FIELDS + fields]))
+    for error in errors:
+        print(error)
+    return not errors
@@ -1,6 +1,15 @@
+import yaml
 # noinspection PyProtectedMember
 from yaml.resolver import ScalarNode, SequenceNode
 
+# Use libyaml based loaders when PyYAML was built with it
+try:
+    from yaml import CFullLoader as BaseFullLoader
+    from yaml import CSafeLoader as BaseSafeLoader
+except ImportError:
+    from yaml import FullLoader as BaseFullLoader
+    from yaml import SafeLoader as BaseSafeLoader
+
 
 # noinspection PyUnusedLocal
 def intrinsics_multi_constructor(loader, tag_prefix, node):
@@ -38,3 +47,19 @@ def intrinsics_multi_constructor(loader, tag_prefix, node):
         value = loader.construct_mapping(node)
 
     return {cfntag: value}
+
+
+class TemplateLoader(BaseSafeLoader):
+    """Safe YAML loader which understands CloudFormation intrinsic tags"""
+
+
+TemplateLoader.add_multi_constructor("!", intrinsics_multi_constructor)
+
+
+class ConfigLoader(BaseFullLoader):
+    """YAML loader for config files"""
+
+
+def load_template_docs(stream):
+    """Return a list of YAML documents in a rendered template"""
+    return list(yaml.load_all(stream, Loader=TemplateLoader))
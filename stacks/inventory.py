@@ -0,0 +1,161 @@
+"""
+Local SQLite snapshot of stacks
+
+The inventory holds status, tags, outputs and last updated time of every
+active stack by profile and region. Refreshing it describes only stacks which
+changed since the last refresh, and list, outputs and template lookups can be
+answered from it instead of calling AWS.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from boto.exception import BotoServerError
+
+from stacks.aws import iter_pages
+from stacks.cache import CACHE_DIR, conn_key, stack_version
+from stacks.scheduler import scheduler
+from stacks.states import ACTIVE_STACK_STATES
+
+INVENTORY_FILE = os.path.join(CACHE_DIR, 'inventory.sqlite')
+# Most stacks described at the same time by a refresh
+INVENTORY_MAX_WORKERS = 10
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stacks (
+    profile TEXT NOT NULL,
+    region TEXT NOT NULL,
+    name TEXT NOT NULL,
+    stack_id TEXT,
+    status TEXT,
+    description TEXT,
+    last_updated TEXT,
+    version TEXT,
+    tags TEXT,
+    outputs TEXT,
+    refreshed REAL,
+    PRIMARY KEY (profile, region, name)
+)
+'''
+COLUMNS = ['name', 'stack_id', 'status', 'description', 'last_updated', 'version', 'tags', 'outputs']
+
+
+class Inventory(object):
+    """Stacks of every account and region refreshed into one SQLite file
+
+    Stacks are keyed by the profile and region of the connection they were
+    listed with. Rows are returned as objects with the attributes of described
+    boto stacks that stacks uses.
+    """
+
+    def __init__(self, fname=INVENTORY_FILE):
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute(SCHEMA)
+
+    def refresh(self, conn, jobs=INVENTORY_MAX_WORKERS):
+        """Bring stacks of a connection's account and region up to date
+
+        Stacks are listed, and only the ones whose last updated time or status
+        changed are described. Return numbers of (stacks, described, removed).
+        """
+        account = _account(conn)
+        summaries = {s.stack_name: s for page in iter_pages(conn.list_stacks, ACTIVE_STACK_STATES)
+                     for s in page if s.stack_status in ACTIVE_STACK_STATES}
+        with self.lock:
+            known = dict(self.db.execute('SELECT name, version FROM stacks WHERE profile = ? AND region = ?',
+                                         account))
+
+        changed = [name for name, s in summaries.items() if known.get(name) != stack_version(s)]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            described = [s for s in executor.map(lambda name: _describe(conn, name), changed) if s]
+        removed = [name for name in known if name not in summaries]
+
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM stacks WHERE profile = ? AND region = ? AND name = ?',
+                                [account + (name,) for name in removed])
+            self.db.executemany('INSERT OR REPLACE INTO stacks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [account + _row(s) + (now,) for s in described])
+        return len(summaries), len(described), len(removed)
+
+    def stack(self, conn, name):
+        """Return a stack of the connection's account and region, or None"""
+        with self.lock:
+            row = self.db.execute('SELECT {} FROM stacks WHERE profile = ? AND region = ? AND name = ?'
+                                  .format(', '.join(COLUMNS)), _account(conn) + (name,)).fetchone()
+        return _stack(row) if row else None
+
+    def stacks(self, conn):
+        """Return all stacks of the connection's account and region, by name"""
+        with self.lock:
+            rows = self.db.execute('SELECT {} FROM stacks WHERE profile = ? AND region = ? ORDER BY name'
+                                   .format(', '.join(COLUMNS)), _account(conn)).fetchall()
+        return [_stack(row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def _account(conn):
+    _, region, profile, _ = conn_key(conn)
+    return profile or '', region or ''
+
+
+def _describe(conn, name):
+    try:
+        return scheduler.call(conn.describe_stacks, name)[0]
+    except BotoServerError as err:
+        # Deleted since it was listed
+        if 'does not exist' in err.message:
+            return None
+        raise
+
+
+def _row(stack):
+    last_updated = getattr(stack, 'LastUpdatedTime', None) or str(stack.creation_time)
+    return (stack.stack_name, stack.stack_id, stack.stack_status, stack.description, last_updated,
+            stack_version(stack), json.dumps(dict(stack.tags or {})),
+            json.dumps([[o.key, o.value] for o in stack.outputs or []]))
+
+
+def _stack(row):
+    values = dict(zip(COLUMNS, row))
+    outputs = [SimpleNamespace(key=k, value=v) for k, v in json.loads(values['outputs'])]
+    return SimpleNamespace(stack_name=values['name'], stack_id=values['stack_id'], stack_status=values['status'],
+                           description=values['description'], LastUpdatedTime=values['last_updated'],
+                           tags=json.loads(values['tags']), outputs=outputs)
+
+
+def refresh_regions(inventory, conns, jobs=INVENTORY_MAX_WORKERS):
+    """Refresh the inventory with a connection per region concurrently
+
+    Return a dict of region to refresh() counts, or the error message when the
+    region could not be refreshed.
+    """
+    def refresh(conn):
+        try:
+            return inventory.refresh(conn, jobs)
+        except BotoServerError as err:
+            return err.message
+
+    with ThreadPoolExecutor(max_workers=len(conns) or 1) as executor:
+        return dict(zip(conns, executor.map(refresh, conns.values())))
+
+
+def print_refresh(results):
+    """Print refresh_regions() results, return False if any region failed"""
+    from tabulate import tabulate
+
+    rows = []
+    for region in sorted(results):
+        result = results[region]
+        rows.append([region] + (list(result) + [''] if isinstance(result, tuple) else ['', '', '', result]))
+    print(tabulate(rows, headers=['Region', 'Stacks', 'Described', 'Removed', 'Error']))
+    return all(isinstance(r, tuple) for r in results.values())
@@ -1,130 +1,186 @@
+import atexit
 import os
 import signal
 import sys
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import partial
 
-import boto.cloudformation
-import boto.ec2
-import boto.route53
-import boto.s3
-import boto.vpc
-import pytz
-
-from stacks import aws, cf, cli
-from stacks.config import (config_load, get_default_region_name,
-                           get_region_name, print_config, profile_exists,
-                           validate_properties)
-from stacks.states import FAILED_STACK_STATES, ROLLBACK_STACK_STATES
+from stacks import cli
 
 
 def main():
     for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
         signal.signal(sig, handler)
+    atexit.register(save_lookups)
+
+    run(sys.argv[1:])
+
+
+def run(argv, forward=True):
+    """Run the command argv describes
 
-    parser, args = cli.parse_options()
+    Commands a server can run are sent to it when a socket is given and
+    forward is set.
+    """
+    parser, args = cli.parse_options(argv)
 
     if not args.subcommand:
         parser.print_help()
         sys.exit(0)
 
+    if args.subcommand == 'serve':
+        from stacks import server
+        sys.exit(server.serve(args.socket or server.DEFAULT_SOCKET, partial(run, forward=False)))
+
+    if forward and args.socket:
+        from stacks import server
+        result = server.forward(args.socket, argv) if server.forwardable(args) else None
+        if result is not None:
+            stdout, stderr, code = result
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            sys.exit(code)
+
+    # Modules are imported once the subcommand is known, so commands which do
+    # not talk to AWS or render templates start without loading boto or jinja2
+    from stacks import config as config_module
+    from stacks.config import config_load, print_config, validate_properties
+
+    config_module.config_cache = not args.no_cache
     config_file = vars(args).get('config', None)
     config_dir = vars(args).get('config_dir', None)
     env = vars(args).get('env', None)
     config = config_load(env, config_file, config_dir)
-    now = datetime.now(tz=pytz.UTC)
+    now = datetime.now(tz=timezone.utc)
 
     if args.subcommand == 'config':
         print_config(config, args.property_name, output_format=args.output_format)
         sys.exit(0)
 
-    config['get_ami_id'] = aws.get_ami_id
-    config['get_vpc_id'] = aws.get_vpc_id
-    config['get_zone_id'] = aws.get_zone_id
-    config['get_stack_output'] = aws.get_stack_output
-    config['get_stack_resource'] = aws.get_stack_resource
+    from stacks import aws, cf
+    from stacks.cache import CACHE_DIR, DiskCache, lookup_cache
+    from stacks.states import FAILED_STACK_STATES, ROLLBACK_STACK_STATES
 
-    # Figure out profile value in the following order
-    # - cli arg
-    # - env variable
-    # - default profile if exists
-    if args.profile:
-        profile = args.profile
-    elif os.environ.get('AWS_DEFAULT_PROFILE'):
-        profile = os.environ.get('AWS_DEFAULT_PROFILE')
-    elif profile_exists('default'):
-        profile = 'default'
-    elif args.profile and not profile_exists(args.profile):
-        print('Profile "{}" does not exist.'.format(args.profile))
-        sys.exit(1)
+    lookups = {
+        'get_ami_id': aws.get_ami_id,
+        'get_vpc_id': aws.get_vpc_id,
+        'get_zone_id': aws.get_zone_id,
+        'get_stack_output': aws.get_stack_output,
+        'get_stack_resource': aws.get_stack_resource,
+    }
+    config.update(lookups)
+
+    # --region and --profile take comma separated lists or `all` for read
+    # commands, which are then run for every pair
+    from stacks import fanout
+    targets = None
+    if fanout.is_many(args.region) or fanout.is_many(args.profile):
+        if args.subcommand not in fanout.FANOUT_SUBCOMMANDS or vars(args).get('events_follow'):
+            print('Several regions or profiles can only be given to {}, without --follow.'.format(
+                ', '.join(fanout.FANOUT_SUBCOMMANDS)))
+            sys.exit(1)
+        from stacks.config import list_profiles
+        profiles = fanout.expand(args.profile, list_profiles) if args.profile else [default_profile(args)]
+        targets = []
+        for p in profiles:
+            regions = fanout.expand(args.region, aws.regions) if args.region else [default_region(args, p)]
+            targets.extend((r, p) for r in regions)
+        if not targets or not all(r for r, _ in targets):
+            print('Region is not specified.')
+            sys.exit(1)
+        profile = region = None
     else:
-        profile = None
+        profile = default_profile(args)
+        region = default_region(args, profile)
+        if not region:
+            print('Region is not specified.')
+            sys.exit(1)
 
-    # Figure out region value in the following order
-    # - cli arg
-    # - env variable
-    # - region from config
-    if args.region:
-        region = args.region
-    elif os.environ.get('AWS_DEFAULT_REGION'):
-        region = os.environ.get('AWS_DEFAULT_REGION')
-    elif get_region_name(profile):
-        region = get_region_name(profile)
+    config['region'] = region
+
+    # Set on every run, so a server follows the cache options of each command
+    save_lookups()
+    if args.refresh_cache:
+        lookup_cache.clear()
+    if (args.cache or args.refresh_cache) and not args.no_cache:
+        lookup_cache.store = DiskCache(os.path.join(CACHE_DIR, 'lookups.json'), refresh=args.refresh_cache)
     else:
-        region = get_default_region_name()
+        lookup_cache.store = None
 
-    if not region:
-        print('Region is not specified.')
-        sys.exit(1)
+    cf.template_cache = not args.no_cache
 
-    config['region'] = region
+    # Set on every run, so a server only answers from the inventory when asked
+    if args.from_inventory:
+        from stacks.inventory import Inventory
+        aws.inventory = Inventory()
+    else:
+        aws.inventory = None
 
-    # Not great, but try to catch everything. Above should be refactored in a
-    # function which handles setting up connections to different aws services
-    try:
-        ec2_conn = boto.ec2.connect_to_region(region, profile_name=profile)
-        vpc_conn = boto.vpc.connect_to_region(region, profile_name=profile)
-        cf_conn = boto.cloudformation.connect_to_region(region, profile_name=profile)
-        r53_conn = boto.route53.connect_to_region(region, profile_name=profile)
-        s3_conn = boto.s3.connect_to_region(region, profile_name=profile)
-        config['ec2_conn'] = ec2_conn
-        config['vpc_conn'] = vpc_conn
-        config['cf_conn'] = cf_conn
-        config['r53_conn'] = r53_conn
-        config['s3_conn'] = s3_conn
-    # TODO(alekna): Fix too broad exception
-    except:
-        print(sys.exc_info()[1])
-        sys.exit(1)
+    if targets:
+        fields, func = fanout.command(args, aws.inventory)
+        results = fanout.fan_out(targets, func)
+        if not fanout.print_results(results, fields, vars(args).get('output_format', 'text')):
+            sys.exit(1)
+        sys.exit(0)
+
+    # Connections are opened when first used, so commands only pay for the
+    # services they talk to
+    config.update(aws.connect(region, profile))
+    cf_conn = config['cf_conn']
+
+    if args.subcommand == 'inventory':
+        from stacks import inventory
+        regions = args.regions or [region]
+        conns = {r: aws.connect(r, profile)['cf_conn'] for r in regions}
+        results = inventory.refresh_regions(aws.inventory or inventory.Inventory(), conns, args.jobs)
+        if not inventory.print_refresh(results):
+            sys.exit(1)
 
     if args.subcommand == 'resources':
-        output = cf.stack_resources(cf_conn, args.name, args.logical_id)
-        if output:
-            print(output)
-        cf_conn.close()
+        if args.logical_id:
+            output = cf.stack_resources(cf_conn, args.name, args.logical_id)
+            if output:
+                print(output)
+        else:
+            cf.print_stack_resources(cf_conn, args.name, args.output_format, args.recursive)
 
     if args.subcommand == 'outputs':
-        output = cf.stack_outputs(cf_conn, args.name, args.output_name)
+        output = cf.stack_outputs(cf_conn, args.name, args.output_name, args.output_format, aws.inventory)
         if output:
             print(output)
-        cf_conn.close()
 
     if args.subcommand == 'list':
-        output = cf.list_stacks(cf_conn, args.name, args.verbose)
+        output = cf.list_stacks(cf_conn, args.name, args.verbose, aws.inventory)
         if output:
             print(output)
-        cf_conn.close()
 
     if args.subcommand == 'create' or args.subcommand == 'update':
-        if args.property:
-            properties = validate_properties(args.property)
-            config.update(properties)
+        properties = validate_properties(args.property) if args.property else {}
+        config.update(properties)
 
-        if args.subcommand == 'create':
+        if args.all_envs:
+            from stacks.config import config_load_envs
+            overrides = dict(lookups, region=region, **properties)
+            configs = {e: dict(c, **overrides) for e, c in config_load_envs(config_file, config_dir).items()}
+            if not configs:
+                print('No envs found in config.')
+                sys.exit(1)
+            if not cf.print_env_renders(args.template.name, configs, profile, args.jobs):
+                sys.exit(1)
+        elif args.subcommand == 'create':
             stack_name = cf.create_stack(cf_conn, args.name, args.template, config, dry=args.dry_run)
             if args.events_follow and not args.dry_run:
                 stack_status = cf.print_events(cf_conn, stack_name, args.events_follow)
                 if stack_status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES:
                     sys.exit(1)
+        elif args.change_set and not args.dry_run:
+            from stacks import changeset
+            name = changeset.change_set_name()
+            stack_name = cf.create_stack(cf_conn, args.name, args.template, config, update=True,
+                                         create_on_update=args.create_on_update, change_set=name)
+            change_set = changeset.wait_change_sets(cf_conn, [stack_name], name)[stack_name]
+            if not changeset.print_change_set(stack_name, change_set):
+                sys.exit(1)
         else:
             stack_name = cf.create_stack(cf_conn, args.name, args.template, config, update=True, dry=args.dry_run,
                                          create_on_update=args.create_on_update)
@@ -141,13 +197,132 @@ def main():
                 sys.exit(1)
 
     if args.subcommand == 'events':
-        cf.print_events(cf_conn, args.name, args.events_follow, args.lines)
+        stack_names = cf.match_stack_names(cf_conn, args.name)
+        if not stack_names:
+            print('No stacks match {}'.format(' '.join(args.name)))
+            sys.exit(1)
+        if args.events_follow:
+            if len(stack_names) == 1:
+                statuses = [cf.print_events(cf_conn, stack_names[0], True)]
+            else:
+                statuses = cf.follow_many_events(cf_conn, stack_names, now).values()
+            if any(status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES for status in statuses):
+                sys.exit(1)
+        else:
+            for stack_name in stack_names:
+                if len(stack_names) > 1:
+                    print('{}:'.format(stack_name))
+                cf.print_events(cf_conn, stack_name, False, args.lines)
 
     if args.subcommand == 'diff':
+        from stacks import deploy
+        if args.property:
+            properties = validate_properties(args.property)
+            config.update(properties)
+        templates = deploy.find_templates(args.template)
+        missing = [t for t in templates if not os.path.isfile(t)]
+        if missing or not templates:
+            print('No such template: {}'.format(', '.join(missing)) if missing else 'No templates to diff.')
+            sys.exit(1)
+        if len(templates) == 1 and not os.path.isdir(args.template[0]):
+            with open(templates[0]) as tpl_file:
+                cf.print_stack_diff(cf_conn, args.name, tpl_file, config)
+        else:
+            if args.name:
+                print('Stack name can only be given with a single template.')
+                sys.exit(1)
+            if not cf.print_stacks_diff(cf_conn, templates, config, profile, args.jobs):
+                sys.exit(1)
+
+    if args.subcommand == 'prune-templates':
+        if args.keep_uploaded < 1:
+            print('At least one uploaded template must be kept.')
+            sys.exit(1)
+        expired = cf.prune_templates(config, args.name, args.keep_uploaded)
+        print('Deleted {} uploaded templates.'.format(len(expired)))
+
+    if args.subcommand == 'deploy':
+        from stacks import deploy
         if args.property:
             properties = validate_properties(args.property)
             config.update(properties)
-        cf.print_stack_diff(cf_conn, args.name, args.template, config)
+        templates = deploy.find_templates(args.templates, args.manifest)
+        if not templates:
+            print('No templates to deploy.')
+            sys.exit(1)
+        graph = deploy.build_graph(templates, config)
+        if args.dry_run:
+            deploy.print_plan(graph)
+            sys.exit(0)
+        results = deploy.deploy(cf_conn, graph, config, jobs=args.jobs)
+        if any(status in deploy.FAILED_STATES for status in results.values()):
+            sys.exit(1)
+
+    if args.subcommand == 'plan':
+        from stacks import changeset, deploy
+        if args.property:
+            properties = validate_properties(args.property)
+            config.update(properties)
+        templates = deploy.find_templates(args.templates, args.manifest)
+        if not templates:
+            print('No templates to plan.')
+            sys.exit(1)
+        _, results = changeset.plan(cf_conn, templates, config, jobs=args.jobs)
+        if not changeset.print_plan(results):
+            sys.exit(1)
+
+    if args.subcommand == 'apply':
+        from stacks import changeset
+        stack_names = cf.match_stack_names(cf_conn, args.name)
+        executed = changeset.apply(cf_conn, stack_names)
+        if args.events_follow and executed:
+            statuses = cf.follow_many_events(cf_conn, executed, now, prefix=len(executed) > 1).values()
+            if any(status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES for status in statuses):
+                sys.exit(1)
+        if len(executed) < len(stack_names):
+            sys.exit(1)
+
+
+def save_lookups():
+    """Save lookups of the previous command to disk, if it used the lookup cache"""
+    from stacks.cache import lookup_cache
+
+    if lookup_cache.store is not None:
+        lookup_cache.store.save()
+
+
+def default_profile(args):
+    """Figure out profile value in the following order
+
+    - cli arg
+    - env variable
+    - default profile if exists
+    """
+    from stacks.config import profile_exists
+
+    if args.profile:
+        return args.profile
+    if os.environ.get('AWS_DEFAULT_PROFILE'):
+        return os.environ.get('AWS_DEFAULT_PROFILE')
+    if profile_exists('default'):
+        return 'default'
+    return None
+
+
+def default_region(args, profile):
+    """Figure out region value in the following order
+
+    - cli arg
+    - env variable
+    - region from config
+    """
+    from stacks.config import get_default_region_name, get_region_name
+
+    if args.region:
+        return args.region
+    if os.environ.get('AWS_DEFAULT_REGION'):
+        return os.environ.get('AWS_DEFAULT_REGION')
+    return get_region_name(profile) or get_default_region_name()
 
 
 def handler(signum, _):
@@ -0,0 +1,154 @@
+"""
+Rate limited, throttling aware scheduling of AWS API calls
+
+All boto calls go through one Scheduler, which keeps a token bucket and a
+concurrency cap per service and region, so concurrent work in a process shares
+one request budget instead of every caller backing off on its own.
+"""
+import itertools
+import random
+import threading
+import time
+
+from boto.connection import AWSAuthConnection
+from boto.exception import BotoServerError
+
+THROTTLING_ERROR_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+]
+
+# Requests per second and burst size, by connection class name
+DEFAULT_RATE = (10, 20)
+RATES = {
+    'CloudFormationConnection': (5, 10),
+}
+# Lowest rate a bucket slows down to after being throttled
+MIN_RATE = 0.5
+
+
+class TokenBucket(object):
+    """Token bucket which slows down when throttled and recovers on success"""
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, return seconds spent waiting for it"""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class Scheduler(object):
+    """Run boto calls within per service, region and profile rate and concurrency limits
+
+    Throttled calls are retried with exponential backoff and full jitter.
+    metrics holds call, throttle and wait counters per (service, region, profile).
+    """
+
+    def __init__(self, rates=None, max_concurrency=8, retries=6, backoff_base=1, backoff_cap=30):
+        self.rates = dict(RATES, **(rates or {}))
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.workers = 1
+        self.metrics = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def reset(self, workers=1):
+        """Drop limits, metrics and the lock inherited from a parent process
+
+        The process is one of workers processes which share the request budget,
+        so each gets an equal part of every rate and burst.
+        """
+        self.workers = workers
+        self.metrics = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        """Call a bound boto method with args and kwargs, return its result"""
+        key = service_key(method)
+        bucket, semaphore = self._get_limits(key)
+
+        for attempt in itertools.count():
+            self._count(key, 'waited', bucket.acquire())
+            with semaphore:
+                self._count(key, 'calls')
+                try:
+                    result = method(*args, **kwargs)
+                except BotoServerError as err:
+                    if not is_throttling_error(err) or attempt >= self.retries:
+                        raise
+                    self._count(key, 'throttled')
+                    bucket.throttled()
+                else:
+                    bucket.succeeded()
+                    return result
+            sleep = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            print('Being throttled. Retrying after {:.1f} seconds..'.format(sleep), flush=True)
+            time.sleep(sleep)
+
+    def _get_limits(self, key):
+        with self._lock:
+            if key not in self._limits:
+                rate, burst = self.rates.get(key[0], DEFAULT_RATE)
+                rate, burst = rate / self.workers, max(1, burst / self.workers)
+                self._limits[key] = TokenBucket(rate, burst), threading.BoundedSemaphore(self.max_concurrency)
+                self.metrics[key] = {'calls': 0, 'throttled': 0, 'waited': 0}
+            return self._limits[key]
+
+    def _count(self, key, metric, value=1):
+        with self._lock:
+            self.metrics[key][metric] += value
+
+
+def is_throttling_error(err):
+    return err.code in THROTTLING_ERROR_CODES or 'Rate exceeded' in str(err.message)
+
+
+def service_key(method):
+    """Return (service, region, profile) a bound boto method talks to
+
+    Objects like S3 keys are followed to the connection they were made with.
+    Accounts are throttled separately, so each profile gets its own limits.
+    """
+    obj = getattr(method, '__self__', None)
+    conn = obj
+    while conn is not None and not isinstance(conn, AWSAuthConnection):
+        conn = getattr(conn, 'connection', None) or getattr(conn, 'bucket', None)
+    conn = conn or obj
+    region = getattr(getattr(conn, 'region', None), 'name', None)
+    return conn.__class__.__name__, region, getattr(conn, 'profile_name', None)
+
+
+scheduler = Scheduler()
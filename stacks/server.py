@@ -0,0 +1,141 @@
+"""
+Run commands in a long running server process
+
+`stacks serve` keeps AWS connections, lookup caches and compiled templates
+alive between commands. Read-only commands of clients given the server socket
+are forwarded to it and print the same output and exit with the same code as
+when run locally.
+"""
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from stacks import cli
+from stacks.cache import CACHE_DIR
+
+DEFAULT_SOCKET = os.path.join(CACHE_DIR, 'stacks.sock')
+# Subcommands clients forward, create only when it is a dry run
+FORWARDED_SUBCOMMANDS = ['outputs', 'resources', 'config', 'diff', 'create']
+
+
+def forwardable(args):
+    """Return True if the command of parsed args can be run by a server"""
+    if args.subcommand not in FORWARDED_SUBCOMMANDS:
+        return False
+    return args.subcommand != 'create' or args.dry_run or args.all_envs
+
+
+def forward(socket_path, argv):
+    """Run a command on the server, return its (stdout, stderr, exit code)
+
+    None is returned when the server can not be reached.
+    """
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile('rb') as f:
+                response = json.loads(f.read().decode())
+    except (OSError, ValueError):
+        return None
+    return response['stdout'], response['stderr'], response['code']
+
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server running commands with run(argv)
+
+    Commands change the working directory, environment and standard streams of
+    the process, so they run one at a time. Commands clients would not forward
+    are refused, whoever sends them.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, run):
+        self.run = run
+        self.lock = threading.Lock()
+        super().__init__(socket_path, CommandHandler)
+
+    def execute(self, argv, cwd, env):
+        """Run a command as if started in cwd with env, return (stdout, stderr, exit code)"""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with self.lock, _environ(cwd, env), contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                _, args = cli.parse_options(argv)
+                if not forwardable(args):
+                    print('The server only runs read-only commands.', file=sys.stderr)
+                    sys.exit(1)
+                self.run(argv)
+                code = 0
+            except SystemExit as err:
+                code = _exit_code(err.code)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+        return stdout.getvalue(), stderr.getvalue(), code
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+        except ValueError:
+            return
+        stdout, stderr, code = self.server.execute(request['argv'], request['cwd'], request['env'])
+        self.wfile.write(json.dumps({'stdout': stdout, 'stderr': stderr, 'code': code}).encode())
+
+
+def serve(socket_path, run):
+    """Serve commands on a Unix socket until stopped"""
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    if os.path.exists(socket_path):
+        if forward(socket_path, ['--version']) is not None:
+            print('A server is already listening on {}'.format(socket_path))
+            return 1
+        os.unlink(socket_path)
+
+    # Commands run with the server's AWS credentials, so only its user may connect
+    umask = os.umask(0o177)
+    try:
+        server = CommandServer(socket_path, run)
+    finally:
+        os.umask(umask)
+
+    print('Serving on {}'.format(socket_path), flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return 0
+
+
+@contextlib.contextmanager
+def _environ(cwd, env):
+    old_cwd, old_env = os.getcwd(), dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(old_env)
+        os.chdir(old_cwd)
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
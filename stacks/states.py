@@ -21,3 +21,5 @@ IN_PROGRESS_STACK_STATES = [
     'UPDATE_ROLLBACK_IN_PROGRESS',
     'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
 ]
+ACTIVE_STACK_STATES = (FAILED_STACK_STATES + COMPLETE_STACK_STATES +
+                       IN_PROGRESS_STACK_STATES + ROLLBACK_STACK_STATES)
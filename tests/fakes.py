@@ -0,0 +1,257 @@
+"""
+Recording stand-ins for boto connections
+
+moto no longer intercepts boto2 connections, so tests that need to count API
+calls use these instead.
+"""
+import hashlib
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from boto.exception import BotoServerError
+
+from stacks import cf, config
+
+# Wall clock comparisons are flaky on loaded machines, so they only run when asked
+benchmark = unittest.skipUnless(os.environ.get('STACKS_BENCHMARKS'), 'set STACKS_BENCHMARKS to run benchmarks')
+
+
+def isolate_template_caches(test):
+    """Point compiled and rendered template caches of cf at a temporary
+    directory for the life of a test, return the directory
+
+    Jinja environments remember their cache directory, so they are dropped too.
+    Caching is switched on and eviction may run again.
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    test.addCleanup(tmpdir.cleanup)
+    for name, value in [('JINJA_CACHE_DIR', os.path.join(tmpdir.name, 'jinja')),
+                        ('RENDER_CACHE_DIR', os.path.join(tmpdir.name, 'render')),
+                        ('template_cache', True),
+                        ('_template_caches_pruned', False)]:
+        patcher = mock.patch.object(cf, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    cf._jinja_envs.clear()
+    test.addCleanup(cf._jinja_envs.clear)
+    return tmpdir.name
+
+
+def isolate_config_cache(test):
+    """Point the config cache at a temporary file for the life of a test"""
+    tmpdir = tempfile.TemporaryDirectory()
+    test.addCleanup(tmpdir.cleanup)
+    for name, value in [('CONFIG_CACHE_FILE', os.path.join(tmpdir.name, 'config.pickle')),
+                        ('config_cache', True),
+                        ('_config_cache', None)]:
+        patcher = mock.patch.object(config, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return tmpdir.name
+
+
+class ResultSet(list):
+    def __init__(self, items=(), next_token=None):
+        super().__init__(items)
+        self.next_token = next_token
+
+
+def make_stack(name, status='CREATE_COMPLETE', tags=None, outputs=None, **kwargs):
+    outputs = [SimpleNamespace(key=k, value=v) for k, v in (outputs or {}).items()]
+    description = kwargs.pop('description', None)
+    return SimpleNamespace(stack_name=name, stack_id='arn:aws:cloudformation:::stack/{}'.format(name),
+                           stack_status=status, tags=tags or {}, outputs=outputs,
+                           description=description, template_description=description,
+                           creation_time=datetime(2020, 1, 1), **kwargs)
+
+
+class FakeCFConnection:
+    """CloudFormation connection serving stacks from memory, one call per page"""
+
+    def __init__(self, stacks=(), page_size=100, resources=None, events=None, templates=None):
+        self.stacks = list(stacks)
+        self.page_size = page_size
+        self.resources = resources or {}
+        # Template bodies by stack name
+        self.templates = templates or {}
+        # Resource changes change sets of a stack report, and change sets by
+        # (stack name, change set name)
+        self.changes = {}
+        self.change_sets = {}
+        # Stack events by stack name, newest first like the API returns them
+        self.events = events or {}
+        self.calls = []
+
+    def _page(self, items, next_token):
+        start = int(next_token or 0)
+        end = start + self.page_size
+        return ResultSet(items[start:end], str(end) if end < len(items) else None)
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.calls.append('DescribeStacks')
+        if stack_name_or_id is None:
+            live = [s for s in self.stacks if s.stack_status != 'DELETE_COMPLETE']
+            return self._page(live, next_token)
+        for s in self.stacks:
+            if stack_name_or_id in (s.stack_name, s.stack_id) and s.stack_status != 'DELETE_COMPLETE':
+                return ResultSet([s])
+        raise BotoServerError(400, 'Bad Request', 'Stack with id {} does not exist'.format(stack_name_or_id))
+
+    def list_stacks(self, stack_status_filters=None, next_token=None):
+        self.calls.append('ListStacks')
+        stacks = [s for s in self.stacks if not stack_status_filters or s.stack_status in stack_status_filters]
+        return self._page(stacks, next_token)
+
+    def _resources(self, stack_name):
+        """Resources are given as physical ID or (physical ID, type) by logical ID"""
+        resources = []
+        for logical_id, physical_id in self.resources.get(stack_name, {}).items():
+            resource_type = 'AWS::CloudFormation::WaitConditionHandle'
+            if isinstance(physical_id, tuple):
+                physical_id, resource_type = physical_id
+            resources.append(SimpleNamespace(logical_resource_id=logical_id, physical_resource_id=physical_id,
+                                             resource_type=resource_type, resource_status='CREATE_COMPLETE'))
+        return resources
+
+    def describe_stack_resources(self, stack_name_or_id=None, logical_resource_id=None, physical_resource_id=None):
+        self.calls.append('DescribeStackResources')
+        resources = self._resources(stack_name_or_id)
+        if logical_resource_id:
+            resources = [r for r in resources if r.logical_resource_id == logical_resource_id]
+        return ResultSet(resources)
+
+    def list_stack_resources(self, stack_name_or_id, next_token=None):
+        self.calls.append('ListStackResources')
+        if stack_name_or_id.startswith('arn:'):
+            stack_name_or_id = stack_name_or_id.split('/')[1]
+        if stack_name_or_id not in self.resources:
+            raise BotoServerError(400, 'Bad Request', 'Stack with id {} does not exist'.format(stack_name_or_id))
+        return self._page(self._resources(stack_name_or_id), next_token)
+
+    def create_stack(self, stack_name, tags=None, **kwargs):
+        self.calls.append('CreateStack')
+        self.stacks.append(make_stack(stack_name, 'CREATE_IN_PROGRESS', tags=dict(tags or {})))
+
+    def update_stack(self, stack_name, tags=None, **kwargs):
+        self.calls.append('UpdateStack')
+        stack = next(s for s in self.stacks if s.stack_name == stack_name)
+        if stack.stack_status not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'):
+            raise BotoServerError(400, 'Bad Request', 'Stack:{} is in {} state and can not be updated.'.format(
+                stack_name, stack.stack_status))
+        stack.stack_status = 'UPDATE_IN_PROGRESS'
+        stack.tags = dict(tags or {})
+
+    def describe_stack_events(self, stack_name_or_id=None, next_token=None):
+        self.calls.append('DescribeStackEvents')
+        if stack_name_or_id not in self.events and all(s.stack_name != stack_name_or_id for s in self.stacks):
+            raise BotoServerError(400, 'Bad Request', 'Stack [{}] does not exist'.format(stack_name_or_id))
+        return self._page(self.events.get(stack_name_or_id, []), next_token)
+
+    def get_template(self, stack_name_or_id):
+        self.calls.append('GetTemplate')
+        if stack_name_or_id not in self.templates:
+            raise BotoServerError(400, 'Bad Request', 'Stack with id {} does not exist'.format(stack_name_or_id))
+        return {'GetTemplateResponse': {'GetTemplateResult': {'TemplateBody': self.templates[stack_name_or_id]}}}
+
+    def _do_request(self, action, params, path, method):
+        """Serve change set calls, change sets are ready when described the second time"""
+        self.calls.append(action)
+        key = params.get('StackName'), params.get('ChangeSetName')
+        if action == 'CreateChangeSet':
+            changes = self.changes.get(key[0], [])
+            self.change_sets[key] = {
+                'ChangeSetName': key[1], 'StackName': key[0], 'Status': 'CREATE_PENDING', 'ExecutionStatus':
+                'UNAVAILABLE', 'CreationTime': len(self.change_sets), 'Tags': params, 'Changes': [
+                    {'Type': 'Resource', 'ResourceChange': dict(zip(
+                        ['Action', 'LogicalResourceId', 'ResourceType', 'Replacement'], c))} for c in changes],
+            }
+            return {'CreateChangeSetResponse': {'CreateChangeSetResult': {'Id': 'arn:{}:{}'.format(*key)}}}
+        if key not in self.change_sets and action != 'ListChangeSets':
+            raise BotoServerError(400, 'Bad Request', 'ChangeSet [{}] does not exist'.format(key[1]))
+        if action == 'DescribeChangeSet':
+            change_set = self.change_sets[key]
+            if change_set['Status'] == 'CREATE_PENDING':
+                change_set['Status'] = 'CREATE_IN_PROGRESS'
+            elif not change_set['Changes']:
+                change_set.update(Status='FAILED', StatusReason="The submitted information didn't contain "
+                                                                "changes. Submit different information.")
+            else:
+                change_set.update(Status='CREATE_COMPLETE', ExecutionStatus='AVAILABLE')
+            return {'DescribeChangeSetResponse': {'DescribeChangeSetResult': dict(change_set)}}
+        if action == 'ListChangeSets':
+            summaries = [dict(cs, Changes=None) for (stack, _), cs in self.change_sets.items() if stack == key[0]]
+            return {'ListChangeSetsResponse': {'ListChangeSetsResult': {'Summaries': summaries}}}
+        if action == 'ExecuteChangeSet':
+            self.change_sets[key]['ExecutionStatus'] = 'EXECUTE_IN_PROGRESS'
+        elif action == 'DeleteChangeSet':
+            del self.change_sets[key]
+        return {}
+
+    def add_event(self, stack_name, logical_id, status, resource_type='AWS::EC2::VPC', timestamp=None):
+        """Record a new stack event, with a naive UTC timestamp like boto returns"""
+        events = self.events.setdefault(stack_name, [])
+        if timestamp is None:
+            timestamp = events[0].timestamp + timedelta(seconds=1) if events else datetime(2020, 1, 1)
+        events.insert(0, SimpleNamespace(event_id='{}-{}'.format(stack_name, len(events)), timestamp=timestamp,
+                                         resource_status=status, resource_type=resource_type,
+                                         logical_resource_id=logical_id, resource_status_reason=None))
+
+
+class FakeKey:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+        self.last_modified = None
+
+    def set_contents_from_string(self, contents):
+        self.bucket.calls.append('PutObject')
+        self.etag = '"{}"'.format(hashlib.md5(contents.encode()).hexdigest())
+        self.last_modified = '2020-01-01T00:00:{:02d}.000Z'.format(len(self.bucket.keys))
+        self.bucket.keys[self.name] = self
+
+    def generate_url(self, expires_in):
+        return 'https://{}.s3.amazonaws.com/{}'.format(self.bucket.name, self.name)
+
+
+class FakeBucket:
+    """S3 bucket keeping keys in memory, listed page_size keys at a time"""
+
+    def __init__(self, name, page_size=1000):
+        self.name = name
+        self.page_size = page_size
+        self.keys = {}
+        self.calls = []
+
+    def new_key(self, key_name):
+        return FakeKey(self, key_name)
+
+    def get_key(self, key_name):
+        self.calls.append('HeadObject')
+        return self.keys.get(key_name)
+
+    def get_all_keys(self, prefix='', marker=''):
+        self.calls.append('ListObjects')
+        names = sorted(n for n in self.keys if n.startswith(prefix) and n > marker)
+        page = ResultSet([self.keys[n] for n in names[:self.page_size]])
+        page.is_truncated = len(names) > self.page_size
+        return page
+
+    def delete_keys(self, keys, quiet=False):
+        self.calls.append('DeleteObjects')
+        for name in keys:
+            del self.keys[name]
+
+
+class FakeS3Connection:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_bucket(self, bucket_name, validate=True):
+        return self.bucket
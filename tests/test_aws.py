@@ -0,0 +1,92 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+from stacks import aws
+from stacks.cache import conn_key, lookup_cache
+from tests.fakes import FakeCFConnection, make_stack
+
+
+class TestLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        lookup_cache.clear()
+        stack = make_stack('net', outputs={'VpcId': 'vpc-1', 'SubnetId': 'subnet-1'}, tags={'Env': 'dev'})
+        self.conn = FakeCFConnection([stack], resources={'net': {'VPC': 'vpc-1'}})
+
+    def test_get_stack_output_one_describe_per_stack(self):
+        for _ in range(10):
+            self.assertEqual(aws.get_stack_output(self.conn, 'net', 'VpcId'), 'vpc-1')
+        self.assertEqual(aws.get_stack_output(self.conn, 'net', 'SubnetId'), 'subnet-1')
+        self.assertEqual(aws.get_stack_tag(self.conn, 'net', 'Env'), 'dev')
+        self.assertEqual(self.conn.calls, ['DescribeStacks'])
+        self.assertEqual((lookup_cache.hits, lookup_cache.misses), (11, 1))
+
+    def test_get_stack_output_missing_key(self):
+        with self.assertRaises(RuntimeError):
+            aws.get_stack_output(self.conn, 'net', 'Missing')
+
+    def test_get_stack_resource(self):
+        self.assertEqual(aws.get_stack_resource(self.conn, 'net', 'VPC'), 'vpc-1')
+        self.assertIsNone(aws.get_stack_resource(self.conn, 'net', 'Subnet'))
+        self.assertEqual(self.conn.calls, ['ListStackResources'])
+
+    def test_get_vpc_id_keeps_connection_open(self):
+        conn = mock.Mock()
+        conn.get_all_vpcs.return_value = [SimpleNamespace(id='vpc-1')]
+        self.assertEqual(aws.get_vpc_id(conn, 'main'), 'vpc-1')
+        self.assertEqual(aws.get_vpc_id(conn, 'main'), 'vpc-1')
+        conn.get_all_vpcs.assert_called_once_with(filters={'tag:Name': 'main'})
+        conn.close.assert_not_called()
+
+
+class TestLazyConnection(unittest.TestCase):
+
+    def setUp(self):
+        lookup_cache.clear()
+        self.conn = FakeCFConnection([make_stack('net', outputs={'VpcId': 'vpc-1'})])
+        self.module = SimpleNamespace(connect_to_region=mock.Mock(return_value=self.conn))
+        self.import_module = mock.Mock(return_value=self.module)
+        patcher = mock.patch.object(aws, 'importlib', SimpleNamespace(import_module=self.import_module))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connects_on_first_use_only(self):
+        lazy = aws.LazyConnection('boto.cloudformation', 'eu-west-1', 'dev')
+        lazy.close()
+        self.import_module.assert_not_called()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outputs = list(executor.map(lambda _: aws.get_stack_output(lazy, 'net', 'VpcId'), range(16)))
+        self.assertEqual(outputs, ['vpc-1'] * 16)
+        self.module.connect_to_region.assert_called_once_with('eu-west-1', profile_name='dev')
+
+    def test_keyed_without_connecting(self):
+        with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'AKIA1'}):
+            lazy = aws.LazyConnection('boto.cloudformation', 'eu-west-1', 'dev')
+        self.assertEqual(conn_key(lazy), ('boto.cloudformation', 'eu-west-1', 'dev', 'AKIA1'))
+        self.assertNotIsInstance(lazy, FakeCFConnection)
+        self.import_module.assert_not_called()
+
+    def test_connections_kept_apart_by_credentials(self):
+        self.addCleanup(aws._connections.clear)
+        with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'AKIA1'}):
+            first = aws.connect('eu-west-1', 'dev')
+            self.assertEqual(aws.connect('eu-west-1', 'dev'), first)
+        with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'AKIA2'}):
+            other = aws.connect('eu-west-1', 'dev')
+        self.assertIsNot(other['cf_conn'], first['cf_conn'])
+        self.assertNotEqual(conn_key(other['cf_conn']), conn_key(first['cf_conn']))
+
+    def test_unknown_region(self):
+        self.module.connect_to_region.return_value = None
+        lazy = aws.LazyConnection('boto.cloudformation', 'nowhere-1', None)
+        with mock.patch('builtins.print'), self.assertRaises(SystemExit) as err:
+            lazy.describe_stacks()
+        self.assertEqual(err.exception.code, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
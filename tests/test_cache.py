@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from stacks import aws, cache
+from stacks.cache import DiskCache, LookupCache, stack_version
+from tests.fakes import FakeCFConnection, make_stack
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, 'stacks', 'lookups.json')
+        self.stack = make_stack('net', outputs={'VpcId': 'vpc-1'})
+        self.conn = FakeCFConnection([self.stack])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run(self, refresh=False):
+        """Simulate one stacks invocation"""
+        store = DiskCache(self.fname, refresh=refresh)
+        with mock.patch.object(aws, 'lookup_cache', LookupCache(store)):
+            value = aws.lookup_cache.get(('vpc', cache.conn_key(self.conn), 'main'), self._find_vpc)
+            output = aws.get_stack_output(self.conn, 'net', 'VpcId')
+        store.save()
+        return value, output
+
+    def _find_vpc(self):
+        self.conn.calls.append('DescribeVpcs')
+        return ['vpc-1']
+
+    def test_lookup_persisted_across_runs(self):
+        self.assertEqual(self._run(), (['vpc-1'], 'vpc-1'))
+        self.assertEqual(self._run(), (['vpc-1'], 'vpc-1'))
+        self.assertEqual(self.conn.calls, ['DescribeVpcs', 'DescribeStacks', 'DescribeStacks'])
+
+    def test_stack_lookups_not_persisted(self):
+        self._run()
+        self.stack.outputs[0].value = 'vpc-2'
+        self.stack.LastUpdatedTime = '2021-01-01T00:00:00Z'
+        self.assertEqual(self._run()[1], 'vpc-2')
+
+    def test_refresh(self):
+        self._run()
+        self._run(refresh=True)
+        self.assertEqual(self.conn.calls.count('DescribeVpcs'), 2)
+
+    def test_ttl_expired(self):
+        self._run()
+        with mock.patch.dict(cache.CACHE_TTLS, {'vpc': 0}):
+            self._run()
+        self.assertEqual(self.conn.calls.count('DescribeVpcs'), 2)
+
+    def test_credentials_kept_apart(self):
+        other = FakeCFConnection([make_stack('net', outputs={'VpcId': 'vpc-other'})])
+        self.conn.aws_access_key_id = 'AKIA1'
+        other.aws_access_key_id = 'AKIA2'
+        self.assertNotEqual(cache.conn_key(self.conn), cache.conn_key(other))
+        lookups = LookupCache(DiskCache(self.fname))
+        with mock.patch.object(aws, 'lookup_cache', lookups):
+            self.assertEqual(aws.get_stack_output(self.conn, 'net', 'VpcId'), 'vpc-1')
+            self.assertEqual(aws.get_stack_output(other, 'net', 'VpcId'), 'vpc-other')
+
+    def test_stack_change_invalidates(self):
+        lookups = LookupCache()
+        with mock.patch.object(aws, 'lookup_cache', lookups):
+            aws.get_stack_output(self.conn, 'net', 'VpcId')
+            self.stack.LastUpdatedTime = '2021-01-01T00:00:00Z'
+            lookups.observe_stack(self.conn, 'net', stack_version(self.stack))
+            aws.get_stack_output(self.conn, 'net', 'VpcId')
+        self.assertEqual(self.conn.calls, ['DescribeStacks'] * 2)
+
+    def test_failed_lookup_not_cached(self):
+        lookups = LookupCache(DiskCache(self.fname))
+        self.assertIsNone(lookups.get(('ami', None, 'missing'), lambda: None))
+        self.assertFalse(lookups.store.dirty)
+
+    def test_memory_ttl_expired(self):
+        lookups = LookupCache()
+        with mock.patch.object(aws, 'lookup_cache', lookups):
+            aws.get_stack_output(self.conn, 'net', 'VpcId')
+            aws.get_stack_output(self.conn, 'net', 'VpcId')
+            with mock.patch.dict(cache.CACHE_TTLS, {'stack': 0}):
+                aws.get_stack_output(self.conn, 'net', 'VpcId')
+        self.assertEqual(self.conn.calls, ['DescribeStacks'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,29 @@
+import json
+import os
+import threading
+import time
 import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
 
+import jinja2
+import pytz
 from boto import cloudformation, s3
 from moto import mock_cloudformation
 
 from stacks import cf
+from stacks.cache import LookupCache
+from stacks.scheduler import Scheduler
+from tests.fakes import (FakeBucket, FakeCFConnection, FakeS3Connection, benchmark,
+                         isolate_template_caches, make_stack)
 
 
 class TestTemplate(unittest.TestCase):
 
+    def setUp(self):
+        isolate_template_caches(self)
+
     def test_gen_valid_template(self):
         config = {'env': 'dev', 'test_tag': 'testing'}
         tpl_file = open('tests/fixtures/valid_template.yaml')
@@ -41,10 +57,151 @@ class TestTemplate(unittest.TestCase):
         self.assertEqual(len(errors), 1)
 
 
+class TestTemplateCompilation(unittest.TestCase):
+
+    def setUp(self):
+        isolate_template_caches(self)
+        self.addCleanup(self._new_process)
+        self._new_process()
+        self.config = {'env': 'dev', 'test_tag': 'testing'}
+
+    def _new_process(self):
+        cf._jinja_envs.clear()
+        cf._templates.clear()
+
+    def _gen_template(self):
+        with open('tests/fixtures/valid_template.yaml') as tpl_file:
+            return cf.gen_template(tpl_file, self.config)
+
+    def test_template_parsed_once(self):
+        with mock.patch.object(jinja2.Environment, 'parse', autospec=True, side_effect=jinja2.Environment.parse) as parse:
+            first = self._gen_template()
+            self.assertEqual(self._gen_template(), first)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_bytecode_cache_across_processes(self):
+        first = self._gen_template()
+        self._new_process()
+        with mock.patch.object(jinja2.Environment, 'parse') as parse:
+            self.assertEqual(self._gen_template(), first)
+        parse.assert_not_called()
+
+    def test_missing_properties_from_cache(self):
+        self._gen_template()
+        self._new_process()
+        self.config = {'env': 'dev'}
+        with self.assertRaises(SystemExit) as err:
+            self._gen_template()
+        self.assertEqual(err.exception.code, 1)
+
+    def _render_key(self, config):
+        env = cf._jinja_env('tests/fixtures/render')
+        with open('tests/fixtures/render/main.yaml') as f:
+            return cf.render_cache_key(env, 'main.yaml', f.read(), config)
+
+    def test_render_cache_hit(self):
+        first = self._gen_template()
+        self._new_process()
+        with mock.patch('stacks.helpers.load_template_docs') as load:
+            self.assertEqual(self._gen_template(), first)
+        load.assert_not_called()
+
+    def test_render_cache_key(self):
+        config = {'env': 'dev', 'team': 'web', 'unused': 1}
+        key = self._render_key(config)
+        self.assertIsNotNone(key)
+        self.assertEqual(self._render_key(dict(config, unused=2)), key)
+        # Variables used by included templates are part of the key
+        self.assertNotEqual(self._render_key(dict(config, team='db')), key)
+
+    def test_render_cache_key_lookups_not_cached(self):
+        self.assertIsNone(self._render_key({'env': 'dev', 'team': lambda: 'web'}))
+
+    def test_no_cache(self):
+        cf.template_cache = False
+        first = self._gen_template()
+        self._new_process()
+        with mock.patch.object(jinja2.Environment, 'parse', autospec=True, side_effect=jinja2.Environment.parse) as parse:
+            self.assertEqual(self._gen_template(), first)
+        self.assertEqual(parse.call_count, 1)
+        self.assertFalse(os.path.exists(cf.RENDER_CACHE_DIR))
+        self.assertFalse(os.path.exists(cf.JINJA_CACHE_DIR))
+
+    def test_unused_entries_evicted(self):
+        os.makedirs(cf.RENDER_CACHE_DIR)
+        expired = time.time() - cf.TEMPLATE_CACHE_MAX_AGE - 1
+        stale = os.path.join(cf.RENDER_CACHE_DIR, 'stale.json')
+        used = os.path.join(cf.RENDER_CACHE_DIR, 'used.json')
+        for fname in (stale, used):
+            with open(fname, 'w') as f:
+                f.write('[]')
+            os.utime(fname, (expired, expired))
+        self.assertEqual(cf._load_rendered('used'), ())
+        self._gen_template()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(used))
+
+
+def synthetic_template(resources):
+    return {
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Resources': {
+            'Instance{}'.format(i): {
+                'Type': 'AWS::EC2::Instance',
+                'Properties': {
+                    'ImageId': {'Ref': 'ImageId'},
+                    'SubnetId': {'Fn::GetAtt': ['Subnet', 'SubnetId']},
+                    'Tags': [{'Key': 'Name', 'Value': {'Fn::Join': ['-', ['instance', str(i)]]}}],
+                },
+            } for i in range(resources)
+        },
+    }
+
+
+class TestValidateTemplate(unittest.TestCase):
+
+    def test_errors(self):
+        tpl = {
+            'Description': 'x' * (cf.MAX_DESCRIPTION_BYTES + 1),
+            'Resources': {'Topic': {'Properties': {'TopicName': None, 'Tags': [None, {'Ref': ''}]}}},
+        }
+        self.assertEqual(cf.validate_template(tpl), [
+            '/Description longer than 1024 bytes is not allowed in templates',
+            "/Resources/Topic/Properties/Tags/0 'null' values are not allowed in templates",
+            "/Resources/Topic/Properties/Tags/1 'Ref' target must be a non-empty string",
+            "/Resources/Topic/Properties/TopicName 'null' values are not allowed in templates",
+        ])
+
+    def test_resource_limit(self):
+        self.assertEqual(cf.validate_template(synthetic_template(cf.MAX_RESOURCES)), [])
+        self.assertEqual(len(cf.validate_template(synthetic_template(cf.MAX_RESOURCES + 1))), 1)
+
+    def test_validate_builds_paths_of_offending_values_only(self):
+        tpl = synthetic_template(5000)
+        tpl['Resources']['Instance7']['Properties']['KeyName'] = None
+        with mock.patch.object(cf, '_template_path', wraps=cf._template_path) as template_path:
+            errors = cf.validate_template(tpl)
+        self.assertIn("/Resources/Instance7/Properties/KeyName 'null' values are not allowed in templates", errors)
+        self.assertEqual(template_path.call_count, 1)
+
+    @benchmark
+    def test_validate_benchmark(self):
+        tpl = synthetic_template(5000)
+        start = time.perf_counter()
+        recursive_errors = [k for k, v in cf.traverse_template(tpl) if v is None]
+        recursive_time = time.perf_counter() - start
+        start = time.perf_counter()
+        errors = cf.validate_template(tpl)
+        iterative_time = time.perf_counter() - start
+        self.assertEqual((recursive_errors, len(errors)), ([], 1))
+        self.assertLess(iterative_time, recursive_time)
+
+
 @mock_cloudformation
 class TestStackActions(unittest.TestCase):
 
     def setUp(self):
+        isolate_template_caches(self)
         self.config = {
             'env': 'unittest',
             'custom_tag': 'custom-tag-value',
@@ -97,5 +254,410 @@ class TestStackActions(unittest.TestCase):
         self.assertEqual('b08c2e9d7003f62ba8ffe5c985c50a63', stack.tags['MD5Sum'])
 
 
+class TestStackStatus(unittest.TestCase):
+
+    def setUp(self):
+        cf._stack_status_cache.clear()
+        # An account with years of deleted stacks, listed 100 per page
+        history = [make_stack('old-{}'.format(i), 'DELETE_COMPLETE') for i in range(5000)]
+        self.conn = FakeCFConnection(history + [make_stack('web', 'UPDATE_IN_PROGRESS')])
+
+    def test_get_stack_status_single_call_per_poll(self):
+        self.assertEqual(cf.get_stack_status(self.conn, 'web'), 'UPDATE_IN_PROGRESS')
+        self.assertEqual(self.conn.calls, ['DescribeStacks'])
+
+    def test_get_stack_status_cached(self):
+        cf.get_stack_status(self.conn, 'web')
+        cf.get_stack_status(self.conn, 'web')
+        self.assertEqual(len(self.conn.calls), 1)
+
+    def test_get_stack_status_deleted_stack(self):
+        self.assertIsNone(cf.get_stack_status(self.conn, 'old-1'))
+        # Fallback lists live stacks only, so history is never paged through
+        self.assertEqual(self.conn.calls, ['DescribeStacks', 'ListStacks'])
+
+    def test_stack_exists(self):
+        self.assertTrue(cf.stack_exists(self.conn, 'web'))
+        self.assertFalse(cf.stack_exists(self.conn, 'missing'))
+
+
+class TestListStacks(unittest.TestCase):
+
+    def setUp(self):
+        stacks = [make_stack('app-{}'.format(i), tags={'Env': 'prod'}, description='App')
+                  for i in range(800)]
+        self.conn = FakeCFConnection(stacks + [make_stack('gone', 'DELETE_COMPLETE')])
+
+    def test_list_stacks_all_pages(self):
+        output = cf.list_stacks(self.conn)
+        self.assertEqual(len(output.splitlines()), 800)
+        self.assertEqual(self.conn.calls, ['ListStacks'] * 8)
+
+    def test_list_stacks_verbose_no_per_stack_calls(self):
+        output = cf.list_stacks(self.conn, 'app-1*', verbose=True)
+        self.assertIn('prod', output.splitlines()[0])
+        self.assertEqual(self.conn.calls, ['DescribeStacks'] * 8)
+
+
+class TestFollowEvents(unittest.TestCase):
+
+    def setUp(self):
+        cf._stack_status_cache.clear()
+        self.conn = FakeCFConnection([make_stack('web', 'UPDATE_IN_PROGRESS')], page_size=10)
+        # Long history from earlier deployments
+        for i in range(100):
+            self.conn.add_event('web', 'Old{}'.format(i), 'CREATE_COMPLETE')
+        self.conn.add_event('web', 'web', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack')
+        self.from_dt = self.conn.events['web'][0].timestamp.replace(tzinfo=pytz.UTC)
+        # Events arriving while the stack updates, one list per poll
+        self.progress = [
+            [('VPC', 'UPDATE_IN_PROGRESS')],
+            [],
+            [],
+            [('VPC', 'UPDATE_COMPLETE'), ('web', 'UPDATE_COMPLETE')],
+        ]
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+        for logical_id, status in self.progress.pop(0):
+            resource_type = 'AWS::CloudFormation::Stack' if logical_id == 'web' else 'AWS::EC2::VPC'
+            self.conn.add_event('web', logical_id, status, resource_type)
+
+    def test_follow_events(self):
+        self.sleeps = []
+        fake_time = SimpleNamespace(sleep=self._sleep, monotonic=time.monotonic)
+        with mock.patch.object(cf, 'time', fake_time), mock.patch('builtins.print') as printed:
+            status = cf.print_events(self.conn, 'web', True, from_dt=self.from_dt)
+        self.assertEqual(status, 'UPDATE_COMPLETE')
+        output = '\n'.join(call.args[0] for call in printed.call_args_list)
+        self.assertEqual(output.count('UPDATE_IN_PROGRESS'), 2)
+        self.assertNotIn('Old', output)
+        # One events page per poll, history is never paged through again
+        self.assertEqual(self.conn.calls.count('DescribeStackEvents'), 5)
+        self.assertEqual(self.conn.calls.count('DescribeStacks'), 1)
+        # Idle polls back off, activity resets the interval
+        self.assertEqual(self.sleeps, [cf.EVENTS_POLL_MIN, cf.EVENTS_POLL_MIN,
+                                       cf.EVENTS_POLL_MIN * 1.5, cf.EVENTS_POLL_MIN * 1.5 ** 2])
+
+    def test_get_new_events_high_water_mark(self):
+        from_dt = datetime.fromtimestamp(0, tz=pytz.UTC)
+        events, mark = cf.get_new_events(self.conn, 'web', (from_dt, set()))
+        self.assertEqual(len(events), 101)
+        self.assertEqual(events[-1].logical_resource_id, 'web')
+        self.conn.calls.clear()
+        events, mark = cf.get_new_events(self.conn, 'web', mark)
+        self.assertEqual((events, self.conn.calls), ([], ['DescribeStackEvents']))
+        self.assertEqual(len(mark[1]), 1)
+
+
+class TestFollowManyEvents(unittest.TestCase):
+
+    def setUp(self):
+        cf._stack_status_cache.clear()
+        self.conn = FakeCFConnection([make_stack('dev-net', 'UPDATE_IN_PROGRESS'),
+                                      make_stack('dev-app', 'UPDATE_IN_PROGRESS'),
+                                      make_stack('prod-app')])
+        self.conn.add_event('dev-net', 'dev-net', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack',
+                            datetime(2020, 1, 1, 0, 0, 1))
+        self.conn.add_event('dev-app', 'dev-app', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack',
+                            datetime(2020, 1, 1, 0, 0, 2))
+        self.conn.add_event('dev-net', 'dev-net', 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack',
+                            datetime(2020, 1, 1, 0, 0, 3))
+
+    def _sleep(self, seconds):
+        self.conn.add_event('dev-app', 'dev-app', 'UPDATE_ROLLBACK_COMPLETE', 'AWS::CloudFormation::Stack')
+
+    def test_match_stack_names(self):
+        names = cf.match_stack_names(self.conn, ['*-app', 'dev-net', 'dev-*'])
+        self.assertEqual(names, ['dev-app', 'prod-app', 'dev-net'])
+        self.assertEqual(self.conn.calls, ['ListStacks'])
+
+    def test_follow_many_events(self):
+        from_dt = datetime.fromtimestamp(0, tz=pytz.UTC)
+        fake_time = SimpleNamespace(sleep=self._sleep, monotonic=time.monotonic)
+        with mock.patch.object(cf, 'time', fake_time), mock.patch('builtins.print') as printed:
+            statuses = cf.follow_many_events(self.conn, ['dev-net', 'dev-app'], from_dt)
+        self.assertEqual(statuses, {'dev-net': 'UPDATE_COMPLETE', 'dev-app': 'UPDATE_ROLLBACK_COMPLETE'})
+        lines = '\n'.join(call.args[0] for call in printed.call_args_list).splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['dev-net', 'dev-app', 'dev-net', 'dev-app'])
+        # Finished stacks are not polled again
+        self.assertEqual(self.conn.calls.count('DescribeStackEvents'), 3)
+
+    def test_deleted_stack_does_not_end_others(self):
+        self.conn.stacks[0].stack_status = 'DELETE_IN_PROGRESS'
+        self.conn.add_event('dev-net', 'dev-net', 'DELETE_IN_PROGRESS', 'AWS::CloudFormation::Stack',
+                            datetime(2020, 1, 1, 0, 0, 4))
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                del self.conn.stacks[0], self.conn.events['dev-net']
+            else:
+                self._sleep(seconds)
+
+        from_dt = datetime.fromtimestamp(0, tz=pytz.UTC)
+        fake_time = SimpleNamespace(sleep=sleep, monotonic=time.monotonic)
+        with mock.patch.object(cf, 'time', fake_time), mock.patch('builtins.print') as printed:
+            statuses = cf.follow_many_events(self.conn, ['dev-net', 'dev-app'], from_dt)
+        self.assertEqual(statuses, {'dev-net': 'DELETE_COMPLETE', 'dev-app': 'UPDATE_ROLLBACK_COMPLETE'})
+        self.assertIn(mock.call('Stack dev-net does not exist', flush=True), printed.call_args_list)
+        self.assertEqual(len(sleeps), 2)
+
+
+class TestUploadTemplate(unittest.TestCase):
+
+    def setUp(self):
+        cf._template_buckets.clear()
+        self.bucket = FakeBucket('dev-stacks-us-east-1', page_size=3)
+        self.config = {'env': 'dev', 'region': 'us-east-1', 's3_conn': FakeS3Connection(self.bucket)}
+
+    def test_unchanged_template_not_uploaded_again(self):
+        url = cf.upload_template(self.config, '{"a": 1}', 'web')
+        self.assertEqual(cf.upload_template(self.config, '{"a": 1}', 'web'), url)
+        self.assertEqual(self.bucket.calls, ['HeadObject', 'PutObject', 'HeadObject'])
+        self.assertEqual(list(self.bucket.keys), ['dev/web/' + cf._calc_md5('{"a": 1}')])
+
+    def test_prune_templates(self):
+        for i in range(7):
+            cf.upload_template(self.config, '{{"web": {}}}'.format(i), 'web')
+        cf.upload_template(self.config, '{"db": 1}', 'db')
+        foreign = ['dev/notes.txt', 'dev/web/README', 'dev/web/{}/old'.format(cf._calc_md5('{"web": 0}'))]
+        for name in foreign:
+            self.bucket.new_key(name).set_contents_from_string('x')
+        expired = cf.prune_templates(self.config, keep=2)
+        self.assertEqual(len(expired), 5)
+        remaining = sorted(self.bucket.keys)
+        kept = ['dev/db/' + cf._calc_md5('{"db": 1}'),
+                'dev/web/' + cf._calc_md5('{"web": 5}'),
+                'dev/web/' + cf._calc_md5('{"web": 6}')]
+        self.assertEqual(remaining, sorted(foreign + kept))
+
+
+class TestUpdateStack(unittest.TestCase):
+
+    def setUp(self):
+        isolate_template_caches(self)
+        cf._stack_status_cache.clear()
+        self.config = {'env': 'unittest', 'custom_tag': 'custom-tag-value', 'region': 'us-east-1'}
+        self.conn = FakeCFConnection()
+
+    def _update(self, **kwargs):
+        with open('tests/fixtures/create_stack_template.yaml') as tpl_file:
+            return cf.create_stack(self.conn, None, tpl_file, self.config, update=True, **kwargs)
+
+    def _create(self, status='CREATE_COMPLETE'):
+        self._update(create_on_update=True)
+        self.conn.stacks[0].stack_status = status
+
+    def test_create_on_update(self):
+        self._update(create_on_update=True)
+        self.assertEqual(self.conn.calls, ['DescribeStacks', 'CreateStack'])
+
+    def test_unchanged_stack_not_updated(self):
+        self._create()
+        self.conn.calls.clear()
+        with mock.patch('builtins.print'), self.assertRaises(SystemExit) as err:
+            self._update()
+        self.assertEqual(err.exception.code, 0)
+        self.assertEqual(self.conn.calls, ['DescribeStacks'])
+
+    def test_unchanged_stack_not_complete_not_skipped(self):
+        for status in ['ROLLBACK_COMPLETE', 'CREATE_IN_PROGRESS']:
+            with self.subTest(status=status):
+                self.conn = FakeCFConnection()
+                self._create(status)
+                with mock.patch('builtins.print') as print_mock, self.assertRaises(SystemExit) as err:
+                    self._update()
+                self.assertEqual(err.exception.code, 1)
+                self.assertIn('can not be updated', print_mock.call_args[0][0])
+                self.assertEqual(self.conn.calls[-1], 'UpdateStack')
+
+    def test_changed_tags_updated(self):
+        self._create()
+        self.config['custom_tag'] = 'changed'
+        self._update()
+        self.assertEqual(self.conn.calls[-1], 'UpdateStack')
+        self.assertEqual(self.conn.stacks[0].tags['Test'], 'changed')
+
+
+class TestStackResources(unittest.TestCase):
+
+    def setUp(self):
+        app = {'Res{:03}'.format(i): 'res-{}'.format(i) for i in range(250)}
+        app['Db'] = ('arn:aws:cloudformation:eu-west-1:123:stack/app-db/1', cf.NESTED_STACK_TYPE)
+        resources = {
+            'app': app,
+            'app-db': {'Instance': 'i-1', 'Cache': ('arn:aws:cloudformation:eu-west-1:123:stack/app-db-cache/2',
+                                                    cf.NESTED_STACK_TYPE)},
+            'app-db-cache': {'Cluster': 'c-1'},
+        }
+        self.conn = FakeCFConnection(page_size=100, resources=resources)
+
+    def test_all_pages_listed(self):
+        rows = list(cf.iter_stack_resources(self.conn, 'app'))
+        self.assertEqual(len(rows), 251)
+        self.assertEqual(self.conn.calls, ['ListStackResources'] * 3)
+
+    def test_recursive(self):
+        rows = list(cf.iter_stack_resources(self.conn, 'app', recursive=True))
+        self.assertEqual(len(rows), 254)
+        self.assertEqual(sorted((name, r.logical_resource_id) for name, r in rows if name != 'app'),
+                         [('app-db', 'Cache'), ('app-db', 'Instance'), ('app-db-cache', 'Cluster')])
+
+    def test_missing_stack(self):
+        with mock.patch('builtins.print'), self.assertRaises(SystemExit) as err:
+            cf.print_stack_resources(self.conn, 'missing', 'json', recursive=True)
+        self.assertEqual(err.exception.code, 1)
+
+    def test_json_and_tsv_output(self):
+        with mock.patch('builtins.print') as print_mock:
+            cf.print_stack_resources(self.conn, 'app-db', 'json', recursive=True)
+        rows = [json.loads(c[0][0]) for c in print_mock.call_args_list]
+        self.assertIn({'stack': 'app-db-cache', 'logical_id': 'Cluster', 'physical_id': 'c-1',
+                       'type': 'AWS::CloudFormation::WaitConditionHandle', 'status': 'CREATE_COMPLETE'}, rows)
+
+        with mock.patch('builtins.print') as print_mock:
+            cf.print_stack_resources(self.conn, 'app-db-cache', 'tsv')
+        print_mock.assert_called_once_with(
+            'app-db-cache\tCluster\tc-1\tAWS::CloudFormation::WaitConditionHandle\tCREATE_COMPLETE', flush=True)
+
+    def test_outputs_json(self):
+        conn = FakeCFConnection([make_stack('net', outputs={'VpcId': 'vpc-1'})])
+        self.assertEqual(cf.stack_outputs(conn, 'net', None, 'json'), '{"key": "VpcId", "value": "vpc-1"}')
+        self.assertEqual(cf.stack_outputs(conn, 'net', 'VpcId', 'tsv'), 'vpc-1')
+
+
+class TestRenderEnvs(unittest.TestCase):
+
+    TEMPLATE = '---\nname: queue\n---\nResources:\n  Queue:\n    Type: AWS::SQS::Queue\n' \
+               '    Properties:\n      QueueName: {{ env }}-{{ suffix }}\n'
+
+    def setUp(self):
+        self.tmpdir = isolate_template_caches(self)
+        self.connect = mock.patch.object(cf.aws, 'connect', return_value={})
+        self.connect.start()
+        self.addCleanup(self.connect.stop)
+
+        self.template = os.path.join(self.tmpdir, 'queue.yaml')
+        with open(self.template, 'w') as f:
+            f.write(self.TEMPLATE)
+        self.configs = {'dev': {'env': 'dev', 'suffix': 'a', 'region': 'eu-west-1'},
+                        'prod': {'env': 'prod', 'suffix': 'b' * 60000, 'region': 'eu-west-1'},
+                        'test': {'env': 'test', 'region': 'eu-west-1'}}
+
+    def test_render_envs(self):
+        results = cf.render_envs(self.template, self.configs, jobs=2)
+        self.assertEqual(results['dev'], ('queue', len(json.dumps(
+            {'Resources': {'Queue': {'Properties': {'QueueName': 'dev-a'}, 'Type': 'AWS::SQS::Queue'}}},
+            indent=2, sort_keys=True)), []))
+        self.assertGreater(results['prod'][1], cf.MAX_TEMPLATE_BODY_BYTES)
+        self.assertEqual(results['prod'][2], [])
+        self.assertEqual(results['test'], (None, None, ['Required properties not set: suffix']))
+
+    def test_worker_drops_inherited_state(self):
+        parent = {key: object() for key in cf.aws.CONNECTIONS}
+        held_lock = threading.Lock()
+        held_lock.acquire()
+        lookups, calls = LookupCache(), Scheduler()
+        lookups.get(('stack', None, 'net'), lambda: {'version': 1})
+        lookups._lock = held_lock
+        calls._lock = held_lock
+        patchers = [mock.patch.object(cf.aws, '_connections', {('eu-west-1', None, None): parent}),
+                    mock.patch.object(cf.aws, '_connections_lock', threading.Lock()),
+                    mock.patch.object(cf, 'lookup_cache', lookups),
+                    mock.patch.object(cf, 'scheduler', calls),
+                    mock.patch.object(cf, '_render_config', None)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.connect.stop()
+        cf._stack_status_cache[None, 'net'] = (time.monotonic(), 'CREATE_COMPLETE')
+
+        with mock.patch.dict(os.environ, {}, clear=True):
+            cf._init_render_worker({'region': 'eu-west-1'}, None, 4)
+        self.assertIsInstance(cf._render_config['cf_conn'], cf.aws.LazyConnection)
+        self.assertIsNot(cf._render_config['cf_conn'], parent['cf_conn'])
+        self.assertEqual((lookups._values, lookups.hits + lookups.misses), ({}, 0))
+        self.assertEqual(cf._stack_status_cache, {})
+        self.assertFalse(calls._lock.locked())
+        # Workers share the request budget of one process
+        bucket, _ = calls._get_limits(('CloudFormationConnection', 'eu-west-1', None))
+        self.assertEqual((bucket.max_rate, bucket.burst), (1.25, 2.5))
+        self.assertEqual(cf._render_workers(None, 1), 1)
+        self.assertEqual(cf._render_workers(8, 3), 3)
+
+    def test_render_error_fails_one_env(self):
+        with open(self.template, 'w') as f:
+            f.write(self.TEMPLATE.replace('{{ suffix }}', '{{ sizes.web.count }}'))
+        self.configs['dev']['sizes'] = {'web': {'count': 2}}
+        self.configs['prod']['sizes'] = {}
+        self.configs['test']['sizes'] = {'web': {'count': 1}}
+        results = cf.render_envs(self.template, self.configs, jobs=2)
+        self.assertEqual([results[env][2] for env in ['dev', 'test']], [[], []])
+        self.assertEqual(results['prod'][:2], (None, None))
+        self.assertIn("'dict object' has no attribute 'web'", results['prod'][2][0])
+
+    def test_print_summary(self):
+        with mock.patch('builtins.print') as print_mock:
+            self.assertFalse(cf.print_env_renders(self.template, self.configs, jobs=2))
+        self.assertTrue(print_mock.call_args_list[0][0][0].startswith('ERROR: test: '))
+        summary = print_mock.call_args_list[-1][0][0].split('\n')
+        self.assertEqual(summary[0].split(), ['Env', 'Stack', 'Size', 'Errors'])
+        self.assertEqual([line.split()[0] for line in summary[1:]], ['dev', 'prod', 'test'])
+        self.assertEqual(summary[3].split()[-1], '1')
+
+
+class TestDiffStacks(unittest.TestCase):
+
+    TEMPLATE = '---\nname: {name}\n---\nResources:\n  Queue:\n    Type: AWS::SQS::Queue\n' \
+               '    Properties:\n      QueueName: {{{{ env }}}}-{queue}\n'
+
+    def setUp(self):
+        self.tmpdir = isolate_template_caches(self)
+        patcher = mock.patch.object(cf.aws, 'connect', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.templates = []
+        for name, queue in [('same', 'a'), ('changed', 'b'), ('missing', 'c')]:
+            fname = os.path.join(self.tmpdir, name + '.yaml')
+            with open(fname, 'w') as f:
+                f.write(self.TEMPLATE.format(name=name, queue=queue))
+            self.templates.append(fname)
+
+        live = {'Resources': {'Queue': {'Type': 'AWS::SQS::Queue', 'Properties': {'QueueName': 'dev-a'}}}}
+        self.conn = FakeCFConnection(templates={'same': json.dumps(live),
+                                                'changed': 'Resources:\n  Queue:\n    Type: AWS::SQS::Queue\n'})
+        self.config = {'env': 'dev', 'cf_conn': self.conn}
+
+    def test_diff_stacks(self):
+        results = cf.diff_stacks(self.conn, self.templates, self.config, jobs=2)
+        same, changed, missing = (results[t] for t in self.templates)
+        self.assertEqual(same, ('same', [], []))
+        self.assertEqual(changed[0], 'changed')
+        self.assertEqual(changed[1], [('+', ('Resources', 'Queue', 'Properties'), None, {'QueueName': 'dev-b'})])
+        self.assertEqual(missing[0], 'missing')
+        self.assertIsNone(missing[1])
+        self.assertEqual(sorted(self.conn.calls), ['GetTemplate'] * 3)
+
+    def test_print_summary(self):
+        with mock.patch('builtins.print') as print_mock:
+            self.assertFalse(cf.print_stacks_diff(self.conn, self.templates, self.config, jobs=2))
+        summary = print_mock.call_args_list[-1][0][0].split('\n')
+        self.assertEqual(summary[0].split(), ['Stack', 'Template', 'Status', 'Changes'])
+        self.assertEqual([line.split()[2] for line in summary[1:]], ['unchanged', 'changed', 'error'])
+
+    def test_render_error_fails_one_template(self):
+        broken = os.path.join(self.tmpdir, 'broken.yaml')
+        with open(broken, 'w') as f:
+            f.write('---\nname: broken\n---\nResources: {{ sizes.web.count }}\n')
+        self.config['sizes'] = {}
+        results = cf.diff_stacks(self.conn, self.templates + [broken], self.config, jobs=2)
+        self.assertEqual(results[broken][:2], (None, None))
+        self.assertIn('web', results[broken][2][0])
+        self.assertEqual(results[self.templates[0]], ('same', [], []))
+
+
 if __name__ == '__main__':
     unittest.main()
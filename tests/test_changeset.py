@@ -0,0 +1,115 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from boto.exception import BotoServerError
+
+from stacks import cf, changeset
+from tests.fakes import FakeCFConnection, isolate_template_caches, make_stack
+
+TEMPLATE = '''---
+name: {name}
+---
+Resources:
+  Queue:
+    Type: AWS::SQS::Queue
+'''
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = isolate_template_caches(self)
+        self.sleep = mock.Mock()
+        patcher = mock.patch.object(changeset, 'time', SimpleNamespace(sleep=self.sleep))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cf._stack_status_cache.clear()
+
+        self.templates = []
+        for name in ['web', 'db', '']:
+            fname = os.path.join(self.tmpdir, (name or 'unnamed') + '.yaml')
+            with open(fname, 'w') as f:
+                f.write(TEMPLATE.format(name=name))
+            self.templates.append(fname)
+        self.conn = FakeCFConnection([make_stack('web'), make_stack('db')])
+        self.conn.changes['web'] = [('Modify', 'Instance', 'AWS::EC2::Instance', 'True'),
+                                    ('Modify', 'Group', 'AWS::EC2::SecurityGroup', 'False'),
+                                    ('Add', 'Queue', 'AWS::SQS::Queue', None)]
+        self.config = {'env': 'dev'}
+
+    def test_plan(self):
+        with mock.patch('builtins.print'):
+            name, results = changeset.plan(self.conn, self.templates, self.config)
+        web, db, unnamed = (results[t] for t in self.templates)
+        self.assertEqual(web[0], 'web')
+        self.assertEqual(web[1]['Status'], 'CREATE_COMPLETE')
+        self.assertEqual(db[1]['Status'], 'FAILED')
+        self.assertEqual(unnamed, (None, None))
+
+        # Both change sets were described together in two rounds, with one wait
+        self.assertEqual(self.conn.calls.count('DescribeChangeSet'), 4)
+        self.sleep.assert_called_once_with(changeset.CHANGE_SET_POLL_MIN)
+        # The change set without changes was cleaned up
+        self.assertEqual(list(self.conn.change_sets), [('web', name)])
+
+    def test_describe_error_fails_one_stack(self):
+        do_request = self.conn._do_request
+
+        def denied(action, params, *args):
+            if action == 'DescribeChangeSet' and params['StackName'] == 'web':
+                raise BotoServerError(403, 'Forbidden', 'Access denied')
+            return do_request(action, params, *args)
+
+        with mock.patch('builtins.print'), mock.patch.object(self.conn, '_do_request', side_effect=denied):
+            _, results = changeset.plan(self.conn, self.templates, self.config)
+        web, db = results[self.templates[0]], results[self.templates[1]]
+        self.assertEqual((web[0], web[1]['Status'], web[1]['StatusReason']), ('web', 'FAILED', 'Access denied'))
+        self.assertEqual(db[1]['Status'], 'FAILED')
+        with mock.patch('builtins.print') as print_mock:
+            self.assertFalse(changeset.print_plan(results))
+        lines = [c[0][0] for c in print_mock.call_args_list]
+        self.assertIn('web: FAILED Access denied', lines)
+        self.assertIn('db: no changes', lines)
+
+    def test_render_error_fails_one_template(self):
+        with open(self.templates[1], 'w') as f:
+            f.write(TEMPLATE.format(name='db') + "    Properties:\n"
+                    "      QueueName: {{ get_stack_output(cf_conn, 'net', 'Id') }}\n")
+
+        def get_stack_output(*args):
+            raise RuntimeError('Id output not found')
+
+        self.config.update(get_stack_output=get_stack_output, cf_conn=self.conn)
+        with mock.patch('builtins.print') as print_mock:
+            _, results = changeset.plan(self.conn, self.templates, self.config)
+        self.assertEqual(results[self.templates[1]], (None, None))
+        self.assertEqual(results[self.templates[0]][1]['Status'], 'CREATE_COMPLETE')
+        self.assertIn(mock.call('{}: Id output not found'.format(self.templates[1])), print_mock.call_args_list)
+
+    def test_print_plan(self):
+        with mock.patch('builtins.print'):
+            _, results = changeset.plan(self.conn, self.templates, self.config)
+        with mock.patch('builtins.print') as print_mock:
+            self.assertFalse(changeset.print_plan(results))
+        lines = [c[0][0] for c in print_mock.call_args_list]
+        self.assertIn('db: no changes', lines)
+        self.assertIn('web: 1 add, 1 modify, 1 replace', lines)
+        self.assertTrue(any(line.endswith('unable to create change set') for line in lines))
+
+    def test_apply_latest_change_set(self):
+        changeset.create_change_set(self.conn, 'web', 'stacks-1', template_body='{}')
+        changeset.create_change_set(self.conn, 'web', 'stacks-2', template_body='{}')
+        for name in ['stacks-1', 'stacks-2']:
+            self.conn.change_sets['web', name].update(Status='CREATE_COMPLETE', ExecutionStatus='AVAILABLE')
+
+        with mock.patch('builtins.print'):
+            executed = changeset.apply(self.conn, ['web', 'db'])
+        self.assertEqual(executed, ['web'])
+        self.assertEqual(self.conn.change_sets['web', 'stacks-2']['ExecutionStatus'], 'EXECUTE_IN_PROGRESS')
+        self.assertEqual(self.conn.change_sets['web', 'stacks-1']['ExecutionStatus'], 'AVAILABLE')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,19 @@
+import os
+import time
 import unittest
 import uuid
+from unittest import mock
+
+import yaml
 
 from stacks import config
+from tests.fakes import benchmark, isolate_config_cache
 
 
 class TestConfig(unittest.TestCase):
+    def setUp(self):
+        isolate_config_cache(self)
+
     def test_load_yaml_valid_file(self):
         y = config._load_yaml('tests/fixtures/load_yaml.yaml')
         print(y)
@@ -39,6 +48,11 @@ class TestConfig(unittest.TestCase):
         region = config.get_default_region_name()
         self.assertIsNone(region)
 
+    def test_list_profiles(self):
+        config.AWS_CREDENTIALS_FILE = 'tests/fixtures/aws_credentials'
+        config.AWS_CONFIG_FILE = 'tests/fixtures/aws_config'
+        self.assertEqual(config.list_profiles(), ['default', 'bar'])
+
     def test_config_load_no_file(self):
         cfg = config.config_load('myenv')
         self.assertIsInstance(cfg, dict)
@@ -78,6 +92,9 @@ class TestConfig(unittest.TestCase):
 
 
 class TestPrintConfig(unittest.TestCase):
+    def setUp(self):
+        isolate_config_cache(self)
+
     def test_print_config(self):
         config_file = 'tests/fixtures/config_flat.yaml'
         cfg = config.config_load('myenv', config_file)
@@ -87,5 +104,134 @@ class TestPrintConfig(unittest.TestCase):
         self.assertEqual(cfg['zero'], 0)
 
 
+CONFIG_FILE = '''common:
+  vpc_cidr: 10.{0}.0.0/16
+  key_{0}: common-{0}
+  nested:
+    subnets: [a, b, c]
+    tags: {{team: team-{0}, owner: owner-{0}}}
+dev:
+  key_{0}: dev-{0}
+prod:
+  key_{0}: prod-{0}
+'''
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = isolate_config_cache(self)
+        self.config_dir = os.path.join(tmpdir, 'config.d')
+        os.mkdir(self.config_dir)
+
+    def _new_process(self):
+        config._config_cache = None
+
+    def _write(self, i, content=None):
+        fname = os.path.join(self.config_dir, '{:04}.yaml'.format(i))
+        with open(fname, 'w') as f:
+            f.write(content or CONFIG_FILE.format(i))
+        # Look older than the racy window, like files which were not just written
+        mtime = time.time() - 60 + i / 1000
+        os.utime(fname, (mtime, mtime))
+
+    def _load(self, env='dev'):
+        with mock.patch.object(config.yaml, 'load', wraps=yaml.load) as load:
+            cfg = config.config_load(env, None, self.config_dir)
+        return cfg, load.call_count
+
+    def test_only_changed_files_parsed(self):
+        for i in range(10):
+            self._write(i)
+        cold, parsed = self._load()
+        self.assertEqual(parsed, 10)
+
+        self._new_process()
+        warm, parsed = self._load()
+        self.assertEqual((warm, parsed), (cold, 0))
+
+        self._write(3, 'dev:\n  key_3: changed\n')
+        changed, parsed = self._load()
+        self.assertEqual(parsed, 1)
+        self.assertEqual(changed['key_3'], 'changed')
+
+        prod, parsed = self._load('prod')
+        self.assertEqual((prod['key_5'], parsed), ('prod-5', 0))
+
+    def test_all_envs_parsed_once(self):
+        for i in range(10):
+            self._write(i)
+        self._write(10, 'common:\n  key_10: common-10\nstaging:\n  key_10: staging-10\n')
+        with mock.patch.object(config.yaml, 'load', wraps=yaml.load) as load:
+            envs = config.config_load_envs(None, self.config_dir)
+        self.assertEqual(load.call_count, 11)
+        self.assertEqual(sorted(envs), ['dev', 'prod', 'staging'])
+        self.assertEqual(envs['staging']['key_10'], 'staging-10')
+        self.assertEqual(envs['staging']['key_5'], 'common-5')
+        self.assertEqual(envs['prod']['env'], 'prod')
+        self.assertEqual(envs['dev'], self._load('dev')[0])
+
+    def test_envs_need_common_section(self):
+        self._write(1)
+        self._write(2, 'tags:\n  team: web\nsizes:\n  web: 2\n')
+        self.assertEqual(sorted(config.config_load_envs(None, self.config_dir)), ['dev', 'prod'])
+
+    def test_touched_file_not_parsed(self):
+        self._write(1)
+        self._load()
+        self._write(1)
+        self.assertEqual(self._load()[1], 0)
+
+    def test_cached_config_is_a_copy(self):
+        self._write(1)
+        cfg, _ = self._load()
+        cfg['nested']['subnets'].append('d')
+        self.assertEqual(self._load()[0]['nested']['subnets'], ['a', 'b', 'c'])
+
+    def test_no_cache(self):
+        self._write(1)
+        config.config_cache = False
+        self.assertEqual(self._load()[1], 1)
+        self.assertEqual(self._load()[1], 1)
+        self.assertFalse(os.path.exists(config.CONFIG_CACHE_FILE))
+
+    def test_removed_files_pruned(self):
+        for i in range(3):
+            self._write(i)
+        self._load()
+        os.unlink(os.path.join(self.config_dir, '0001.yaml'))
+        self._load()
+        self._new_process()
+        self.assertEqual(sorted(os.path.basename(p) for p in config._load_config_cache()['files']),
+                         ['0000.yaml', '0002.yaml'])
+
+    def test_1000_files_parsed_once(self):
+        for i in range(1000):
+            self._write(i)
+        cold, parsed = self._load()
+        self.assertEqual(parsed, 1000)
+
+        self._new_process()
+        warm, parsed = self._load()
+        self.assertEqual((warm, parsed), (cold, 0))
+
+    @benchmark
+    def test_benchmark_1000_files(self):
+        for i in range(1000):
+            self._write(i)
+
+        start = time.perf_counter()
+        cold, _ = self._load()
+        cold_time = time.perf_counter() - start
+
+        self._new_process()
+        start = time.perf_counter()
+        warm, parsed = self._load()
+        warm_time = time.perf_counter() - start
+
+        self.assertEqual(warm, cold)
+        self.assertLess(warm_time, cold_time / 5)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from stacks import deploy
+from tests.fakes import isolate_template_caches
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    def setUp(self):
+        isolate_template_caches(self)
+        self.config = {'env': 'dev', 'cf_conn': None, 'with_db': False}
+
+    def test_template_dependencies(self):
+        deps = deploy.template_dependencies('tests/fixtures/deploy/app.yaml', self.config)
+        # Lookups in branches which are not rendered count too
+        self.assertEqual(deps, {'dev-net', 'dev-db', 'shared-dns'})
+
+    def test_unresolvable_names_skipped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tpl_fname = os.path.join(tmpdir, 'loop.yaml')
+            with open(tpl_fname, 'w') as f:
+                f.write("{% for s in stacks %}{{ get_stack_output(cf_conn, s.name, 'Id') }}{% endfor %}\n"
+                        "{{ get_stack_output(cf_conn, env ~ '-net', 'VpcId') }}\n")
+            self.assertEqual(deploy.template_dependencies(tpl_fname, self.config), {'dev-net'})
+
+    def test_build_graph(self):
+        templates = deploy.find_templates(['tests/fixtures/deploy'])
+        graph = deploy.build_graph(templates, self.config)
+        self.assertEqual(graph['dev-net'], ('tests/fixtures/deploy/net.yaml', set()))
+        self.assertEqual(graph['dev-db'][1], {'dev-net'})
+        # Stacks which are not deployed together are left out
+        self.assertEqual(graph['dev-app'][1], {'dev-net', 'dev-db'})
+
+    def test_render_error_reported(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tpl_fname = os.path.join(tmpdir, 'broken.yaml')
+            with open(tpl_fname, 'w') as f:
+                f.write('---\nname: {{ sizes.web.name }}\n---\n')
+            with mock.patch('builtins.print') as print_mock, self.assertRaises(SystemExit) as err:
+                deploy.build_graph([tpl_fname], dict(self.config, sizes={}))
+        self.assertEqual(err.exception.code, 1)
+        self.assertIn("has no attribute 'web'", print_mock.call_args[0][0])
+
+    def test_cycle(self):
+        graph = {'a': ('a.yaml', {'b'}), 'b': ('b.yaml', {'a'})}
+        with self.assertRaises(SystemExit) as err:
+            deploy._check_cycles(graph)
+        self.assertEqual(err.exception.code, 1)
+
+
+class TestDeploy(unittest.TestCase):
+
+    graph = {
+        'net': ('net.yaml', set()),
+        'dns': ('dns.yaml', set()),
+        'db': ('db.yaml', {'net'}),
+        'app': ('app.yaml', {'net', 'db', 'dns'}),
+    }
+
+    def test_deploy_order(self):
+        deployed = []
+
+        def deploy_stack(conn, name, tpl_fname, config):
+            deployed.append(name)
+            return 'CREATE_COMPLETE'
+
+        with mock.patch.object(deploy, '_deploy_stack', deploy_stack):
+            results = deploy.deploy(None, self.graph, {}, jobs=4)
+        self.assertEqual(set(results.values()), {'CREATE_COMPLETE'})
+        self.assertLess(deployed.index('net'), deployed.index('db'))
+        self.assertEqual(deployed[-1], 'app')
+
+    def test_failed_dependency_skips_dependents(self):
+        def deploy_stack(conn, name, tpl_fname, config):
+            return 'ROLLBACK_COMPLETE' if name == 'db' else 'CREATE_COMPLETE'
+
+        with mock.patch.object(deploy, '_deploy_stack', deploy_stack):
+            results = deploy.deploy(None, self.graph, {}, jobs=2)
+        self.assertEqual(results['app'], 'SKIPPED')
+        self.assertEqual(results['dns'], 'CREATE_COMPLETE')
+
+    def test_lookup_error_fails_one_stack(self):
+        def create_stack(conn, name, tpl_file, config, **kwargs):
+            if name == 'db':
+                raise RuntimeError('VpcId output not found')
+
+        with mock.patch.object(deploy.cf, 'create_stack', create_stack), \
+                mock.patch.object(deploy.cf, 'get_stack_status', return_value='CREATE_COMPLETE'), \
+                mock.patch('builtins.open', mock.mock_open()), mock.patch('builtins.print') as print_mock:
+            results = deploy.deploy(None, self.graph, {}, jobs=2)
+        self.assertEqual(results, {'net': 'CREATE_COMPLETE', 'dns': 'CREATE_COMPLETE', 'db': 'FAILED',
+                                   'app': 'SKIPPED'})
+        self.assertIn(mock.call('db: VpcId output not found', flush=True), print_mock.call_args_list)
+
+
+if __name__ == '__main__':
+    unittest.main()
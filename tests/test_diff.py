@@ -0,0 +1,65 @@
+import json
+import time
+import unittest
+
+from stacks import diff
+
+LIVE = {
+    'Description': 'web',
+    'Resources': {
+        'Web': {'Type': 'AWS::EC2::Instance', 'Properties': {'ImageId': 'ami-1', 'Tags': [{'Key': 'a'}]}},
+        'Old': {'Type': 'AWS::S3::Bucket'},
+    },
+}
+LOCAL = {
+    'Description': 'web',
+    'Resources': {
+        'Web': {'Type': 'AWS::EC2::Instance', 'Properties': {'ImageId': 'ami-2', 'Tags': [{'Key': 'a'}, {'Key': 'b'}]}},
+        'New': {'Type': 'AWS::SQS::Queue'},
+    },
+}
+
+
+class TestDiffTemplates(unittest.TestCase):
+
+    def test_no_changes(self):
+        self.assertEqual(diff.diff_templates(LIVE, json.loads(json.dumps(LIVE))), [])
+        self.assertEqual(diff.format_diff([]), [])
+
+    def test_changes(self):
+        changes = diff.diff_templates(LIVE, LOCAL)
+        self.assertEqual(changes, [
+            (diff.ADDED, ('Resources', 'New'), None, {'Type': 'AWS::SQS::Queue'}),
+            (diff.REMOVED, ('Resources', 'Old'), {'Type': 'AWS::S3::Bucket'}, None),
+            (diff.CHANGED, ('Resources', 'Web', 'Properties', 'ImageId'), 'ami-1', 'ami-2'),
+            (diff.ADDED, ('Resources', 'Web', 'Properties', 'Tags', 1), None, {'Key': 'b'}),
+        ])
+
+    def test_type_change(self):
+        changes = diff.diff_templates({'Port': 80}, {'Port': '80'})
+        self.assertEqual(changes, [(diff.CHANGED, ('Port',), 80, '80')])
+
+    def test_format_diff(self):
+        lines = diff.format_diff(diff.diff_templates(LIVE, LOCAL))
+        self.assertEqual(lines[:2], ['--- live', '+++ local'])
+        self.assertIn('@@ ~ Resources/Web/Properties/ImageId @@', lines)
+        i = lines.index('@@ ~ Resources/Web/Properties/ImageId @@')
+        self.assertEqual(lines[i + 1:i + 3], ['-"ami-1"', '+"ami-2"'])
+
+    def test_parse_yaml_template(self):
+        body = 'Resources:\n  Web:\n    Properties:\n      ImageId: !Ref ImageId\n'
+        self.assertEqual(diff.parse_template(body),
+                         {'Resources': {'Web': {'Properties': {'ImageId': {'Ref': 'ImageId'}}}}})
+        self.assertEqual(diff.parse_template(json.dumps(LIVE)), LIVE)
+        self.assertIs(diff.parse_template(LIVE), LIVE)
+
+    def test_large_template_is_linear(self):
+        def template(n, image):
+            return {'Resources': {'R{}'.format(i): {'Properties': {'ImageId': image, 'Index': i}}
+                                  for i in range(n)}}
+
+        start = time.perf_counter()
+        changes = diff.diff_templates(template(20000, 'ami-1'), template(20000, 'ami-2'))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(changes), 20000)
+        self.assertLess(elapsed, 5)
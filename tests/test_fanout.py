@@ -0,0 +1,78 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from stacks import fanout
+from tests.fakes import FakeCFConnection, make_stack
+
+REGIONS = ['eu-west-1', 'us-east-1', 'us-west-2']
+PROFILES = ['dev', 'prod']
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.conns = {}
+        for region in REGIONS:
+            for profile in PROFILES:
+                stacks = [make_stack('app', outputs={'Url': '{}.{}'.format(profile, region)})]
+                if region == 'eu-west-1':
+                    stacks.append(make_stack('db', status='UPDATE_COMPLETE'))
+                conn = FakeCFConnection(stacks)
+                conn.add_event('app', 'app', 'CREATE_COMPLETE', 'AWS::CloudFormation::Stack')
+                self.conns[region, profile] = conn
+        self.targets = [(r, p) for p in PROFILES for r in REGIONS]
+        patcher = mock.patch.object(fanout.aws, 'connect',
+                                    side_effect=lambda region, profile: {'cf_conn': self.conns[region, profile]})
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _args(self, subcommand, **kwargs):
+        return SimpleNamespace(subcommand=subcommand, **kwargs)
+
+    def test_expand(self):
+        self.assertTrue(fanout.is_many('eu-west-1,us-east-1'))
+        self.assertTrue(fanout.is_many('all'))
+        self.assertFalse(fanout.is_many('eu-west-1'))
+        self.assertFalse(fanout.is_many(None))
+        self.assertEqual(fanout.expand('eu-west-1, us-east-1,', list), ['eu-west-1', 'us-east-1'])
+        self.assertEqual(fanout.expand('all', lambda: PROFILES), PROFILES)
+
+    def test_list_everywhere(self):
+        fields, func = fanout.command(self._args('list', name='*', verbose=False))
+        results = fanout.fan_out(self.targets, func)
+
+        self.assertEqual([r[:2] for r in results], self.targets)
+        self.assertEqual(self.connect.call_count, 6)
+        self.assertEqual(results[0][2], [['app', 'CREATE_COMPLETE'], ['db', 'UPDATE_COMPLETE']])
+        with mock.patch('builtins.print') as print_:
+            self.assertTrue(fanout.print_results(results, fields))
+        table = print_.call_args[0][0].splitlines()
+        self.assertEqual(table[0].split(), ['Region', 'Profile', 'Name', 'Status'])
+        self.assertEqual(len(table), 2 + 8)
+        self.assertEqual(table[2].split(), ['eu-west-1', 'dev', 'app', 'CREATE_COMPLETE'])
+
+    def test_outputs_report_missing_stacks(self):
+        self.conns['us-west-2', 'prod'].stacks = []
+        fields, func = fanout.command(self._args('outputs', name='app', output_name='Url'))
+        results = fanout.fan_out(self.targets, func)
+        self.assertEqual(results[1], ('us-east-1', 'dev', [['dev.us-east-1']]))
+        self.assertIn('does not exist', results[-1][2])
+
+        with mock.patch('builtins.print') as print_:
+            self.assertFalse(fanout.print_results(results, fields, 'tsv'))
+        lines = [c[0][0] for c in print_.call_args_list]
+        self.assertEqual(lines[0], 'eu-west-1\tdev\tdev.eu-west-1')
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[-1].startswith('us-west-2/prod: '))
+
+    def test_resources_and_events(self):
+        self.conns['eu-west-1', 'dev'].resources = {'app': {'Vpc': 'vpc-1'}}
+        fields, func = fanout.command(self._args('resources', name='app', logical_id=None, recursive=False))
+        self.assertEqual(fields[0], 'stack')
+        self.assertEqual(func(self.conns['eu-west-1', 'dev'])[0][:3], ['app', 'Vpc', 'vpc-1'])
+
+        fields, func = fanout.command(self._args('events', name=['a*'], lines=10))
+        rows = func(self.conns['us-east-1', 'prod'])
+        self.assertEqual(len(fields), len(rows[0]))
+        self.assertEqual((rows[0][0], rows[0][2]), ('app', 'CREATE_COMPLETE'))
@@ -0,0 +1,69 @@
+import time
+import unittest
+
+import yaml
+
+from stacks import helpers
+from tests.fakes import benchmark
+
+TEMPLATE_RESOURCE = '''
+  Instance{0}:
+    Type: AWS::EC2::Instance
+    Properties:
+      ImageId: !Ref ImageId
+      SubnetId: !GetAtt Subnet{0}.SubnetId
+      UserData: !Base64
+        Fn::Sub: |
+          #!/bin/bash
+          echo {0}
+      Tags:
+      - Key: Name
+        Value: !Join [-, [instance, '{0}']]
+'''
+
+
+def scaled_template(resources):
+    return 'Resources:' + ''.join(TEMPLATE_RESOURCE.format(i) for i in range(resources))
+
+
+class TestTemplateLoader(unittest.TestCase):
+
+    def test_intrinsics(self):
+        docs = helpers.load_template_docs(scaled_template(1))
+        properties = docs[0]['Resources']['Instance0']['Properties']
+        self.assertEqual(properties['ImageId'], {'Ref': 'ImageId'})
+        self.assertEqual(properties['SubnetId'], {'Fn::GetAtt': ['Subnet0', 'SubnetId']})
+        self.assertEqual(properties['Tags'][0]['Value'], {'Fn::Join': ['-', ['instance', '0']]})
+
+    def test_global_safe_loader_untouched(self):
+        helpers.load_template_docs('a: !Ref b')
+        with self.assertRaises(yaml.constructor.ConstructorError):
+            yaml.safe_load('a: !Ref b')
+
+    @unittest.skipUnless(yaml.__with_libyaml__, 'PyYAML is built without libyaml')
+    def test_libyaml_loader(self):
+        tpl = scaled_template(30)
+        self.assertTrue(issubclass(helpers.TemplateLoader, yaml.CSafeLoader))
+        self.assertEqual(helpers.load_template_docs(tpl), list(yaml.load_all(tpl, Loader=self._pure_loader())))
+
+    @benchmark
+    @unittest.skipUnless(yaml.__with_libyaml__, 'PyYAML is built without libyaml')
+    def test_libyaml_loader_benchmark(self):
+        tpl = scaled_template(300)
+        start = time.perf_counter()
+        list(yaml.load_all(tpl, Loader=self._pure_loader()))
+        pure_time = time.perf_counter() - start
+        start = time.perf_counter()
+        helpers.load_template_docs(tpl)
+        fast_time = time.perf_counter() - start
+        self.assertLess(fast_time, pure_time)
+
+    def _pure_loader(self):
+        class PureTemplateLoader(yaml.SafeLoader):
+            pass
+        PureTemplateLoader.add_multi_constructor('!', helpers.intrinsics_multi_constructor)
+        return PureTemplateLoader
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import re
+import subprocess
+import sys
+import unittest
+
+# Import time of stacks.main in microseconds, with plenty of room for slow
+# machines. It was about 250ms when it loaded boto and jinja2 up front.
+MAIN_IMPORT_BUDGET = 120000
+HEAVY_MODULES = ['boto', 'jinja2', 'yaml', 'tabulate', 'tzlocal', 'pytz']
+
+
+def import_times(module):
+    """Return a dict of module name to cumulative import time in microseconds"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$', line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_main_import_budget(self):
+        times = import_times('stacks.main')
+        self.assertEqual([m for m in HEAVY_MODULES if m in times], [])
+        self.assertLess(times['stacks.main'], MAIN_IMPORT_BUDGET)
+
+    def test_cf_defers_template_modules(self):
+        times = import_times('stacks.cf')
+        self.assertEqual([m for m in ['jinja2', 'yaml', 'tabulate', 'tzlocal'] if m in times], [])
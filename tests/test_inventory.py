@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from stacks import aws, cf
+from stacks.cache import LookupCache
+from stacks.inventory import Inventory, print_refresh, refresh_regions
+from tests.fakes import FakeCFConnection, make_stack
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, 'stacks', 'inventory.sqlite')
+        self.stacks = [make_stack('stack{:02d}'.format(i), tags={'Env': 'dev'}, outputs={'Id': str(i)},
+                                  description='Stack {}'.format(i)) for i in range(20)]
+        self.conn = FakeCFConnection(self.stacks, page_size=5)
+        self.conn.region = SimpleNamespace(name='eu-west-1')
+        self.inventory = Inventory(self.fname)
+
+    def tearDown(self):
+        self.inventory.close()
+        self.tmpdir.cleanup()
+
+    def test_first_refresh_describes_every_stack(self):
+        self.assertEqual(self.inventory.refresh(self.conn), (20, 20, 0))
+        self.assertEqual(self.conn.calls.count('ListStacks'), 4)
+        self.assertEqual(self.conn.calls.count('DescribeStacks'), 20)
+
+    def test_refresh_describes_only_changed_stacks(self):
+        self.inventory.refresh(self.conn)
+        self.conn.calls = []
+        self.stacks[3].LastUpdatedTime = '2021-01-01T00:00:00Z'
+        self.stacks[3].outputs[0].value = 'new'
+        self.stacks[7].stack_status = 'UPDATE_COMPLETE'
+
+        self.assertEqual(self.inventory.refresh(self.conn), (20, 2, 0))
+        self.assertEqual(self.conn.calls.count('DescribeStacks'), 2)
+        self.assertEqual(self.inventory.stack(self.conn, 'stack03').outputs[0].value, 'new')
+        self.assertEqual(self.inventory.stack(self.conn, 'stack07').stack_status, 'UPDATE_COMPLETE')
+
+    def test_refresh_removes_deleted_stacks(self):
+        self.inventory.refresh(self.conn)
+        self.stacks[0].stack_status = 'DELETE_COMPLETE'
+        self.assertEqual(self.inventory.refresh(self.conn), (19, 0, 1))
+        self.assertIsNone(self.inventory.stack(self.conn, 'stack00'))
+
+    def test_snapshot_persisted_across_runs(self):
+        self.inventory.refresh(self.conn)
+        inventory = Inventory(self.fname)
+        self.conn.calls = []
+        self.assertEqual(inventory.refresh(self.conn), (20, 0, 0))
+        self.assertEqual(self.conn.calls, ['ListStacks'] * 4)
+        inventory.close()
+
+    def test_regions_kept_apart(self):
+        other = FakeCFConnection([make_stack('other')])
+        other.region = SimpleNamespace(name='us-east-1')
+        results = refresh_regions(self.inventory, {'eu-west-1': self.conn, 'us-east-1': other})
+        self.assertEqual(results, {'eu-west-1': (20, 20, 0), 'us-east-1': (1, 1, 0)})
+        self.assertEqual([s.stack_name for s in self.inventory.stacks(other)], ['other'])
+        self.assertIsNone(self.inventory.stack(other, 'stack01'))
+
+    def test_print_refresh_reports_failed_regions(self):
+        with mock.patch('builtins.print') as print_:
+            self.assertFalse(print_refresh({'eu-west-1': (1, 1, 0), 'us-east-1': 'Access denied'}))
+        self.assertIn('Access denied', print_.call_args[0][0])
+
+    def test_list_and_outputs_from_inventory(self):
+        self.inventory.refresh(self.conn)
+        self.conn.calls = []
+        listing = cf.list_stacks(self.conn, 'stack1*', verbose=True, inventory=self.inventory)
+        self.assertEqual(len(listing.splitlines()), 10)
+        self.assertIn('Stack 12', listing)
+        self.assertEqual(cf.stack_outputs(self.conn, 'stack05', 'Id', inventory=self.inventory), '5')
+        self.assertEqual(self.conn.calls, [])
+
+    def test_lookups_from_inventory(self):
+        self.inventory.refresh(self.conn)
+        self.conn.calls = []
+        with mock.patch.object(aws, 'inventory', self.inventory), \
+                mock.patch.object(aws, 'lookup_cache', LookupCache()):
+            self.assertEqual(aws.get_stack_output(self.conn, 'stack09', 'Id'), '9')
+            self.assertEqual(aws.get_stack_tag(self.conn, 'stack09', 'Env'), 'dev')
+            self.assertEqual(self.conn.calls, [])
+            # Stacks missing from the inventory are still looked up
+            self.conn.stacks.append(make_stack('late', outputs={'Id': 'late'}))
+            self.assertEqual(aws.get_stack_output(self.conn, 'late', 'Id'), 'late')
+            self.assertEqual(self.conn.calls, ['DescribeStacks'])
@@ -0,0 +1,101 @@
+import time
+import unittest
+from unittest import mock
+
+from boto.exception import BotoServerError
+
+from stacks import scheduler as scheduler_module
+from stacks.scheduler import Scheduler, TokenBucket
+
+
+def throttling_error():
+    err = BotoServerError(400, 'Bad Request')
+    err.code = 'Throttling'
+    return err
+
+
+class FakeConnection:
+
+    def __init__(self, failures=0, error=throttling_error):
+        self.failures = failures
+        self.error = error
+        self.calls = []
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.calls.append((stack_name_or_id, next_token))
+        if len(self.calls) <= self.failures:
+            raise self.error()
+        return ['stack']
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(rates={'FakeConnection': (1000, 10)}, retries=3, backoff_base=0)
+        self.key = ('FakeConnection', None, None)
+
+    def test_call_passes_kwargs(self):
+        conn = FakeConnection()
+        self.scheduler.call(conn.describe_stacks, 'web', next_token='t')
+        self.assertEqual(conn.calls, [('web', 't')])
+
+    def test_throttled_call_retried(self):
+        conn = FakeConnection(failures=2)
+        with mock.patch('builtins.print'):
+            self.assertEqual(self.scheduler.call(conn.describe_stacks, 'web'), ['stack'])
+        self.assertEqual(self.scheduler.metrics[self.key]['calls'], 3)
+        self.assertEqual(self.scheduler.metrics[self.key]['throttled'], 2)
+
+    def test_gives_up_after_retries(self):
+        conn = FakeConnection(failures=100)
+        with mock.patch('builtins.print'), self.assertRaises(BotoServerError):
+            self.scheduler.call(conn.describe_stacks, 'web')
+        self.assertEqual(len(conn.calls), self.scheduler.retries + 1)
+
+    def test_other_errors_not_retried(self):
+        conn = FakeConnection(failures=1, error=lambda: BotoServerError(400, 'Bad Request', 'does not exist'))
+        with self.assertRaises(BotoServerError):
+            self.scheduler.call(conn.describe_stacks, 'web')
+        self.assertEqual(len(conn.calls), 1)
+
+    def test_profiles_limited_separately(self):
+        dev, prod = FakeConnection(), FakeConnection()
+        dev.profile_name, prod.profile_name = 'dev', 'prod'
+        self.scheduler.call(dev.describe_stacks, 'web')
+        self.scheduler.call(prod.describe_stacks, 'web')
+        self.assertEqual(self.scheduler.metrics[('FakeConnection', None, 'dev')]['calls'], 1)
+        self.assertEqual(self.scheduler.metrics[('FakeConnection', None, 'prod')]['calls'], 1)
+
+    def test_workers_share_rates(self):
+        self.scheduler.call(FakeConnection().describe_stacks, 'web')
+        self.scheduler.reset(workers=20)
+        self.assertEqual(self.scheduler.metrics, {})
+        bucket, _ = self.scheduler._get_limits(self.key)
+        # Bursts never drop below one request, which could never be made
+        self.assertEqual((bucket.max_rate, bucket.burst), (50, 1))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate_limited_after_burst(self):
+        bucket = TokenBucket(rate=50, burst=5)
+        start = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        # 5 tokens come from the burst, the other 5 at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_throttled_slows_down_and_recovers(self):
+        bucket = TokenBucket(rate=8, burst=1)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 4)
+        for _ in range(30):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 8)
+        for _ in range(10):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, scheduler_module.MIN_RATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
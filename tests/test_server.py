@@ -0,0 +1,96 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+from functools import partial
+from unittest import mock
+
+from stacks import aws, cache, main, server
+from stacks.cache import DiskCache
+from tests.fakes import FakeCFConnection, isolate_config_cache
+
+CONFIG = os.path.abspath('tests/fixtures/config_flat.yaml')
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        isolate_config_cache(self)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.socket_path = os.path.join(tmpdir.name, 'stacks.sock')
+        self.server = server.CommandServer(self.socket_path, partial(main.run, forward=False))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_forward_matches_local_run(self):
+        argv = ['config', '-c', CONFIG, '-o', 'json']
+        local = io.StringIO()
+        with contextlib.redirect_stdout(local), self.assertRaises(SystemExit) as err:
+            main.run(argv, forward=False)
+        self.assertEqual(err.exception.code, 0)
+
+        self.assertEqual(server.forward(self.socket_path, argv), (local.getvalue(), '', 0))
+
+    def test_forward_exit_code(self):
+        stdout, stderr, code = server.forward(self.socket_path, ['config', '--no-such-option'])
+        self.assertEqual(code, 2)
+        self.assertIn('unrecognized arguments', stderr)
+
+    def test_write_commands_refused(self):
+        for argv in [['create', '-t', CONFIG], ['delete', 'web', '-y'], ['apply', 'web']]:
+            stdout, stderr, code = server.forward(self.socket_path, argv)
+            self.assertEqual(code, 1)
+            self.assertIn('only runs read-only commands', stderr)
+
+    def test_unreachable_server(self):
+        self.assertIsNone(server.forward(self.socket_path + '.missing', ['config']))
+
+    def test_forwardable(self):
+        args = main.cli.parse_options(['create', '-t', CONFIG, '-d'])[1]
+        self.assertTrue(server.forwardable(args))
+        args = main.cli.parse_options(['create', '-t', CONFIG])[1]
+        self.assertFalse(server.forwardable(args))
+        args = main.cli.parse_options(['delete', 'web'])[1]
+        self.assertFalse(server.forwardable(args))
+
+
+class TestCacheOptions(unittest.TestCase):
+    """Commands a server runs each follow their own cache options"""
+
+    def setUp(self):
+        isolate_config_cache(self)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        for name, value in [('CACHE_DIR', tmpdir.name), ('lookup_cache', cache.LookupCache())]:
+            patcher = mock.patch.object(cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(aws, 'connect', return_value={'cf_conn': FakeCFConnection()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, *options):
+        with mock.patch('builtins.print'):
+            main.run(['-r', 'eu-west-1'] + list(options) + ['list'], forward=False)
+        return cache.lookup_cache.store
+
+    def test_store_set_on_every_run(self):
+        self.assertIsInstance(self._run('--cache'), cache.DiskCache)
+        self.assertIsNone(self._run('--cache', '--no-cache'))
+        self.assertIsNone(self._run())
+
+    def test_refresh_on_later_run(self):
+        store = self._run('--cache')
+        store.set(('vpc', None, 'main'), ['vpc-1'])
+        cache.lookup_cache.get(('vpc', None, 'main'), lambda: ['vpc-1'])
+        self.assertIsNot(self._run('--refresh-cache'), store)
+        self.assertEqual(cache.lookup_cache.store.entries, {})
+        self.assertEqual(cache.lookup_cache.hits + cache.lookup_cache.misses, 0)
+        # Lookups of the previous command were saved
+        self.assertIn('vpc', DiskCache(os.path.join(cache.CACHE_DIR, 'lookups.json')).entries.popitem()[0])